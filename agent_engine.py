@@ -3,6 +3,7 @@
 # 可手動觸發，也可排程自動跑
 
 import os, json, time, threading, requests
+import http_client
 from world_manager import (
     load_characters, load_world, save_world,
     build_character_context, add_event, update_character_state
@@ -43,33 +44,28 @@ def get_log(limit: int = 50) -> list:
 
 # ── LLM 呼叫 ──
 def call_llm(messages: list, max_tokens: int = 600) -> str:
-    wait = 5
-    for attempt in range(3):
-        try:
-            r = requests.post(
-                GROQ_API_URL,
-                headers={
-                    "Authorization": f"Bearer {GROQ_API_KEY}",
-                    "Content-Type":  "application/json"
-                },
-                json={
-                    "model":       GROQ_MODEL,
-                    "messages":    messages,
-                    "max_tokens":  max_tokens,
-                    "temperature": 0.8,
-                },
-                timeout=60
-            )
-            if r.status_code == 429:
-                time.sleep(int(r.headers.get("retry-after", wait)))
-                wait *= 2; continue
-            r.raise_for_status()
-            return r.json()["choices"][0]["message"]["content"]
-        except Exception as e:
-            if attempt < 2:
-                time.sleep(wait); wait *= 2; continue
-            return f"[LLM 錯誤: {e}]"
-    return "[超過重試次數]"
+    # 重試 / Retry-After / 退避由 http_client 統一處理
+    try:
+        r = http_client.post(
+            GROQ_API_URL,
+            headers={
+                "Authorization": f"Bearer {GROQ_API_KEY}",
+                "Content-Type":  "application/json"
+            },
+            json={
+                "model":       GROQ_MODEL,
+                "messages":    messages,
+                "max_tokens":  max_tokens,
+                "temperature": 0.8,
+            },
+            timeout=60
+        )
+        if r.status_code == 429:
+            return "[超過重試次數]"
+        r.raise_for_status()
+        return r.json()["choices"][0]["message"]["content"]
+    except Exception as e:
+        return f"[LLM 錯誤: {e}]"
 
 # ── 網路搜尋 ──
 def agent_search(query: str) -> str:
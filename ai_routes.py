@@ -1,5 +1,6 @@
 # ai_routes.py — 主路由（聊天/設定/Session/World/Video）
 import os, json, time, base64, requests, math, re, threading
+import http_client
 from flask import request, Response, render_template, session, jsonify
 
 # 共用工具
@@ -51,6 +52,8 @@ def register_ai_routes(app):
         except Exception:
             rag_doc_ids = []
         model_id      = (request.form.get("model_id") or "").strip() or None
+        retriever     = request.form.get("retriever") or None
+        hedge         = {"1": True, "0": False}.get(request.form.get("hedge"))   # 未帶 = 看 HEDGE_STREAMS 設定
         file_obj      = request.files.get("file")
         file_data     = None
         use_vision    = False
@@ -60,10 +63,9 @@ def register_ai_routes(app):
             if m and m.get("vision"):
                 use_vision = True
 
-        # RAG 向量搜尋
-        rag_context = ""
-        if rag_doc_ids and text:
-            rag_context = rag_search(text, rag_doc_ids)
+        # 檢索內容候選（世界狀態 + RAG），依模型的 token 預算一起打包
+        from context_packer import pack
+        candidates = []
 
         # 判斷是否為劇本角色（system_prompt 含 char_id 標記）
         char_id_for_world = (request.form.get("char_id") or "").strip() or None
@@ -79,10 +81,19 @@ def register_ai_routes(app):
                 from world_context_builder import build_full_context
                 world_ctx = build_full_context(char_id_for_world)
                 if world_ctx:
-                    system_prompt = world_ctx + "\n\n" + system_prompt
+                    candidates.append({"source": "world", "text": world_ctx, "score": 1.0})
             except Exception:
                 pass
 
+        # RAG 向量搜尋
+        if rag_doc_ids and text:
+            candidates += rag_candidates(text, rag_doc_ids, mode=retriever)
+
+        packed, ctx_report = pack(candidates, context_budget(model_id))
+        world_ctx = "\n\n".join(p["text"] for p in packed if p["source"] == "world")
+        if world_ctx:
+            system_prompt = world_ctx + "\n\n" + system_prompt
+        rag_context = format_rag_context(packed)
         if rag_context:
             system_prompt += f"\n\n{rag_context}"
 
@@ -121,7 +132,10 @@ def register_ai_routes(app):
 
         # 自動判斷：如果 model_id 是 OpenRouter 格式（含 / 或 :free），強制走 engine_manager
         _is_openrouter_model = bool(model_id and ("/" in model_id or ":free" in model_id or ":nitro" in model_id))
+        # 沒選引擎照舊直接走 Groq；明確選了自動模式才交給 engine_manager 依延遲路由（視覺請求仍走 Groq）
         _actual_engine = (get_engine() if _ENGINE_OK else None) or "groq"
+        if _actual_engine == "auto" and use_vision:
+            _actual_engine = "groq"
         _actual_model  = model_id or "llama-3.3-70b-versatile"
         if _is_openrouter_model and _ENGINE_OK:
             _actual_engine  = "openrouter"
@@ -137,7 +151,8 @@ def register_ai_routes(app):
             actual_engine = _actual_engine
             try:
                 if _use_engine_mgr:
-                    stream_fn = lambda: stream_ai(messages, model=model_id)
+                    stream_fn = lambda: stream_ai(messages, engine_id="openrouter" if _is_openrouter_model else None,
+                                                  model=model_id, hedge=hedge)
                 else:
                     stream_fn = lambda: stream_groq(messages, use_vision, model_id=model_id)
                 for item in stream_fn():
@@ -154,7 +169,8 @@ def register_ai_routes(app):
                 import traceback; traceback.print_exc()
                 yield f"\n[錯誤: {str(e)[:300]}]".encode("utf-8")
 
-        return Response(generate(), mimetype="text/plain; charset=utf-8")
+        return Response(generate(), mimetype="text/plain; charset=utf-8",
+                        headers={"X-Context-Budget": json.dumps(ctx_report, separators=(",", ":"))})
       except Exception as _e:
         import traceback; traceback.print_exc()
         return jsonify({"error": str(_e)}), 500
@@ -173,6 +189,7 @@ def register_ai_routes(app):
         text        = (data.get("message") or "").strip()
         role_ids    = data.get("role_ids", [])
         rag_doc_ids = data.get("rag_doc_ids", [])
+        retriever   = data.get("retriever")
         do_search   = data.get("search", False)
 
         if not text:
@@ -188,7 +205,7 @@ def register_ai_routes(app):
         # RAG 搜尋（全代理共用）
         rag_context = ""
         if rag_doc_ids:
-            rag_context = rag_search(text, rag_doc_ids)
+            rag_context = rag_search(text, rag_doc_ids, mode=retriever)
 
         # 網路搜尋（全代理共用）
         search_context = ""
@@ -316,11 +333,11 @@ def register_ai_routes(app):
 
     @app.route("/ai/engines", methods=["GET"])
     def engines_status():
-        """回傳所有引擎狀態"""
+        """回傳所有引擎狀態 + 路由決策（routing：政策、各引擎 EWMA / 斷路器、最近一次選擇）"""
         if not _ENGINE_OK:
             return jsonify({"error": "engine_manager 載入失敗", "detail": _ENGINE_ERR}), 500
         ping_engines()   # 背景更新
-        return jsonify(get_status())
+        return jsonify(dict(get_status(), routing=get_routing()))
 
     @app.route("/ai/engines/models", methods=["GET"])
     def engines_models():
@@ -333,15 +350,15 @@ def register_ai_routes(app):
     def engines_select():
         """
         手動切換引擎
-        body: {"engine": "groq"} 或 {"engine": null} (自動)
+        body: {"engine": "groq"}、{"engine": "auto"}（依延遲路由）或 {"engine": null}（預設，直接走 Groq）
         """
         if not _ENGINE_OK:
             return jsonify({"error": "engine_manager 載入失敗", "detail": _ENGINE_ERR}), 500
         data = request.get_json(force=True) or {}
-        engine_id = data.get("engine")  # None = 自動
+        engine_id = data.get("engine")  # "auto" = 依延遲路由，None = 預設
         try:
             set_engine(engine_id)
-            return jsonify({"ok": True, "engine": engine_id or "auto"})
+            return jsonify({"ok": True, "engine": engine_id or "groq"})
         except ValueError as e:
             return jsonify({"error": str(e)}), 400
 
@@ -351,7 +368,13 @@ def register_ai_routes(app):
         if not _ENGINE_OK:
             return jsonify({"engine": "groq", "mode": "direct"})
         eid = get_engine()
-        return jsonify({"engine": eid or "auto", "mode": "auto" if not eid else "manual"})
+        mode = "auto" if eid == "auto" else ("manual" if eid else "default")
+        return jsonify({"engine": eid or "groq", "mode": mode})
+
+    @app.route("/ai/engines/http", methods=["GET"])
+    def engines_http():
+        """供應商連線池監控：每個 host 的請求 / 重試 / 錯誤數、新建連線數與重用次數"""
+        return jsonify(http_client.stats())
     # ══════════════════════════════════════════════════════════════
     # 世界引擎 API（時間推進 / 天氣 / 場景）
     # ══════════════════════════════════════════════════════════════
@@ -581,7 +604,7 @@ def register_ai_routes(app):
                 # 串流輸出 AI 分析
                 yield "data: " + json.dumps({"type":"start"}) + "\n\n"
 
-                with requests.post(
+                with http_client.post(
                     "https://api.groq.com/openai/v1/chat/completions",
                     headers=headers, json=payload, stream=True, timeout=120
                 ) as r:
@@ -1,5 +1,6 @@
 # ai_utils.py — 共用工具函數，不含路由
 import os, json, time, base64, requests, math, re, threading
+import http_client
 
 __all__ = [
     # 底線開頭（import * 預設不匯出）
@@ -10,10 +11,12 @@ __all__ = [
     '_ENGINE_OK', '_ENGINE_ERR',
     # engine_manager 函數（_ENGINE_OK=True 時才有值）
     'stream_ai', 'get_status', 'set_engine', 'get_engine',
-    'get_models_by_engine', 'ping_engines',
+    'get_models_by_engine', 'ping_engines', 'get_routing',
     # 一般名稱
     'load_roles', 'save_roles',
-    'load_rag_index', 'save_rag_index', 'chunk_text', 'rag_search',
+    'load_rag_index', 'chunk_text', 'rag_search',
+    'rag_candidates', 'format_rag_context', 'context_budget',
+    'rag_add_doc', 'rag_delete_docs',
     'ai_rate_limited', 'web_search',
     'all_models', 'load_custom_models', 'save_custom_models',
     'stream_groq', 'call_groq_once', 'build_user_message',
@@ -35,8 +38,16 @@ def _get_messages(sid, system_prompt):
     """從 SQLite 讀取對話歷史，重組成 messages 格式"""
     try:
         from database import get_chat_history
-        rows = get_chat_history(sid, limit=20)
-        rows = list(reversed(rows))  # 舊到新
+        from context_packer import estimate_tokens, HISTORY_BUDGET
+        rows = get_chat_history(sid, limit=20)   # 舊到新
+        # 由新到舊累加，超過 HISTORY_BUDGET 就捨棄更舊的（至少保留最新一則）
+        kept, used = [], 0
+        for row in reversed(rows):
+            used += estimate_tokens(row["content"])
+            if kept and used > HISTORY_BUDGET:
+                break
+            kept.append(row)
+        rows = list(reversed(kept))  # 舊到新
         msgs = [{"role":"system","content":system_prompt}]
         for row in rows:
             msgs.append({"role": row["role"], "content": row["content"]})
@@ -86,6 +97,7 @@ try:
     get_engine            = getattr(_em, "get_engine")
     get_models_by_engine  = getattr(_em, "get_models_by_engine")
     ping_engines          = getattr(_em, "ping_engines")
+    get_routing           = getattr(_em, "get_routing")
     _ENGINE_OK = True
 except Exception as _e:
     import traceback as _tb; _tb.print_exc()
@@ -199,27 +211,25 @@ def save_roles(roles):
 # RAG：文件永久儲存 + TF-IDF 向量搜尋
 # ═══════════════════════════════════════
 def load_rag_index():
-    try:
-        with open(RAG_INDEX,"r",encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return []
-
-def save_rag_index(index):
-    with open(RAG_INDEX,"w",encoding="utf-8") as f:
-        json.dump(index, f, ensure_ascii=False, indent=2)
+    """文件清單（rag_docs 表，見 rag_store.py）"""
+    from rag_store import list_docs
+    return list_docs()
 
 def chunk_text(text, size=400, overlap=80):
-    """把長文切成有重疊的小塊"""
-    chunks, i = [], 0
-    while i < len(text):
-        chunks.append(text[i:i+size])
-        i += size - overlap
-    return chunks
+    """把長文切成有重疊的小塊（段落 / 句子感知，見 chunk_store.split_text）"""
+    from chunk_store import split_chunks
+    return split_chunks(text, size, overlap)
 
-def tokenize(text):
-    """簡單斷詞（支援中英文）"""
-    return re.findall(r'[\u4e00-\u9fff]|[a-zA-Z0-9]+', text.lower())
+def rag_add_doc(name, text):
+    """存 blob + 切段 + 建索引（同內容已上傳過就沿用），回傳文件 dict"""
+    from rag_store import add_doc
+    return add_doc(name, text)
+
+def rag_delete_docs(doc_ids):
+    from rag_store import delete_docs
+    return delete_docs(doc_ids)
+
+from rag_store import tokenize
 
 def tfidf_search(query, chunks, top_k=4):
     """純 Python TF-IDF，找最相關的 chunks"""
@@ -252,35 +262,37 @@ def tfidf_search(query, chunks, top_k=4):
     scores.sort(reverse=True)
     return [chunk for score, idx, chunk in scores[:top_k] if score > 0]
 
-def rag_search(query, doc_ids=None):
-    """從指定文件（或所有文件）搜尋相關段落"""
-    index = load_rag_index()
-    if doc_ids:
-        docs = [d for d in index if d["id"] in doc_ids]
-    else:
-        docs = index
-    
-    all_chunks = []
-    for doc in docs:
-        path = os.path.join(RAG_DIR, doc["filename"])
-        try:
-            with open(path,"r",encoding="utf-8") as f:
-                text = f.read()
-            chunks = chunk_text(text)
-            all_chunks.extend([(c, doc["name"]) for c in chunks])
-        except Exception:
-            continue
-    
-    if not all_chunks:
-        return ""
-    
-    chunks_only = [c for c,_ in all_chunks]
-    top = tfidf_search(query, chunks_only)
-    
-    if not top:
+RAG_CANDIDATES = 8   # 先多取候選，再由 context_packer 依 token 預算挑選
+
+def rag_candidates(query, doc_ids=None, mode=None, top_k=RAG_CANDIDATES):
+    """
+    從指定文件（或所有文件）搜尋相關段落（查詢上傳時建好的索引），回傳 context_packer 的候選格式
+    mode：keyword / dense / hybrid（None = 環境變數 RETRIEVER，預設 keyword）
+    """
+    from rag_store import search, doc_keys, ensure_indexed
+    keys = doc_keys(doc_ids or None)
+    # 舊版上傳搬進 blob 的文件還沒有索引，補建一次
+    ensure_indexed(keys)
+    return [{"source": "rag", "text": r["text"], "score": r["score"],
+             "doc": r["doc_id"], "start": r["char_start"], "end": r["char_end"]}
+            for r in search(query, keys, top_k=top_k, mode=mode)]
+
+def format_rag_context(packed):
+    texts = [p["text"] for p in packed if p["source"] == "rag"]
+    if not texts:
         return ""
-    
-    return "以下是從文件搜尋到的相關內容：\n\n" + "\n\n---\n".join(top)
+    return "以下是從文件搜尋到的相關內容：\n\n" + "\n\n---\n".join(texts)
+
+def rag_search(query, doc_ids=None, mode=None, budget=None):
+    """搜尋 + 依 token 預算打包（去除重疊段落、截到句子邊界），budget 預設 SOURCE_BUDGET"""
+    from context_packer import pack, SOURCE_BUDGET
+    packed, _ = pack(rag_candidates(query, doc_ids, mode), budget or SOURCE_BUDGET)
+    return format_rag_context(packed)
+
+def context_budget(model_id=None):
+    """該模型的檢索內容 token 預算（自訂模型可設定 context_budget）"""
+    from context_packer import budget_for
+    return budget_for(model_id or GROQ_MODEL_TEXT, all_models())
 
 # ═══════════════════════════════════════
 # Rate Limit
@@ -335,7 +347,7 @@ def call_groq_once(messages, use_vision=False, model_id=None):
         model = model_id
     else:
         model = GROQ_MODEL_VISION if use_vision else GROQ_MODEL_TEXT
-    r = requests.post(
+    r = http_client.post(
         GROQ_API_URL,
         headers={"Authorization":f"Bearer {GROQ_API_KEY}","Content-Type":"application/json"},
         json={"model":model,"messages":messages,"max_tokens":1024,"temperature":0.7},
@@ -352,11 +364,11 @@ def stream_groq(messages, use_vision=False, model_id=None):
         model = model_id
     else:
         model = GROQ_MODEL_VISION if use_vision else GROQ_MODEL_TEXT
-    r = requests.post(
+    r = http_client.post(
         GROQ_API_URL,
         headers={"Authorization":f"Bearer {GROQ_API_KEY}","Content-Type":"application/json"},
         json={"model":model,"messages":messages,"stream":True,"max_tokens":2048},
-        stream=True, timeout=90
+        stream=True, timeout=90, retries=0   # 互動對話不在這裡等 Retry-After，429 直接回報
     )
     if not r.ok:
         try:
@@ -373,25 +385,26 @@ def stream_groq(messages, use_vision=False, model_id=None):
         else:
             raise ValueError(f"❌ API 錯誤 {r.status_code}：{msg[:200]}")
     buffer = ""
-    for line in r.iter_lines(decode_unicode=False):
-        if not line:
-            continue
-        try:
-            line_str = line.decode("utf-8")
-        except Exception:
-            continue
-        if line_str.startswith("data: "):
-            data_str = line_str[6:].strip()
-            if data_str == "[DONE]":
-                break
+    with r:   # 串流中斷也要把連線還給連線池
+        for line in r.iter_lines(decode_unicode=False):
+            if not line:
+                continue
             try:
-                chunk = json.loads(data_str)
-                content = chunk["choices"][0].get("delta",{}).get("content","")
-                if content:
-                    buffer += content
-                    yield content, buffer
+                line_str = line.decode("utf-8")
             except Exception:
                 continue
+            if line_str.startswith("data: "):
+                data_str = line_str[6:].strip()
+                if data_str == "[DONE]":
+                    break
+                try:
+                    chunk = json.loads(data_str)
+                    content = chunk["choices"][0].get("delta",{}).get("content","")
+                    if content:
+                        buffer += content
+                        yield content, buffer
+                except Exception:
+                    continue
 
 # ═══════════════════════════════════════
 # 建構訊息
@@ -0,0 +1,226 @@
+"""
+chat_archive.py — 冷資料封存：閒置太久的對話搬到按月份分檔的封存資料庫
+- data/archive/chat_YYYYMM.db（以 session 最後活動月份分檔）
+- chat_sessions 列保留在主資料庫（列表不受影響），只搬 chat_history，
+  chat_sessions.archived_in 記錄封存檔名
+- 讀取封存對話時才 ATTACH 該檔，查完即 DETACH
+- 排程：python chat_archive.py run [天數] [每批 session 數] [最多批數]
+"""
+import os
+import time
+from database import connection, transaction, _keyset, DB_PATH
+from db_pool import get_pool
+
+ARCHIVE_DIR    = os.path.join(os.path.dirname(DB_PATH), "archive")
+DEFAULT_DAYS   = 90
+DEFAULT_BATCH  = 50
+BATCH_PAUSE    = 0.1   # 每批之間讓出寫鎖（秒）
+
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chat_history (
+    id          INTEGER PRIMARY KEY,
+    session_id  TEXT    NOT NULL,
+    role        TEXT    NOT NULL,
+    content     TEXT    NOT NULL,
+    character_id TEXT,
+    model_id    TEXT,
+    created_at  TEXT    NOT NULL
+)"""
+
+def archive_path(name):
+    return os.path.join(ARCHIVE_DIR, f"{name}.db")
+
+def _archive_name(last_active):
+    """'2024-01-31 12:00:00' → 'chat_202401'"""
+    ym = (last_active or time.strftime("%Y-%m"))[:7].replace("-", "")
+    return f"chat_{ym}"
+
+def _ensure_archive(name):
+    path = archive_path(name)
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    with get_pool(path).transaction() as conn:
+        conn.execute(ARCHIVE_SCHEMA)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_session ON chat_history(session_id)")
+    return path
+
+class _attached:
+    """with _attached(conn, path): ... 期間封存檔掛在 arch 名下"""
+    def __init__(self, conn, path):
+        self.conn, self.path = conn, path
+
+    def __enter__(self):
+        self.conn.execute("ATTACH DATABASE ? AS arch", (self.path,))
+        return self.conn
+
+    def __exit__(self, *exc):
+        if self.conn.in_transaction:
+            self.conn.rollback()
+        self.conn.execute("DETACH DATABASE arch")
+
+# ══════════════════════════════════════
+# 搬移
+# ══════════════════════════════════════
+def archive_session(session_id):
+    """
+    把單一 session 的訊息搬到封存檔，回傳搬移筆數
+    兩段式：先在封存檔 commit（INSERT OR REPLACE，可重跑），再從主庫刪除並標記；
+    中途當機最多留下重複資料，不會遺失。兩段都只處理 id <= 第一段開始時的最大 id，
+    中間新寫入的訊息留在主庫，不會沒複製就被刪掉
+    """
+    with connection() as conn:
+        row = conn.execute(
+            "SELECT archived_in, updated_at FROM chat_sessions WHERE session_id=?", (session_id,)
+        ).fetchone()
+    if not row:
+        return 0
+    name = row["archived_in"] or _archive_name(row["updated_at"])
+    path = _ensure_archive(name)
+
+    with connection() as conn:
+        max_id = conn.execute("SELECT MAX(id) FROM chat_history WHERE session_id=?",
+                              (session_id,)).fetchone()[0]
+        if max_id is None:
+            return 0
+        with _attached(conn, path):
+            moved = conn.execute("""
+                INSERT OR REPLACE INTO arch.chat_history
+                SELECT id, session_id, role, content, character_id, model_id, created_at
+                FROM main.chat_history WHERE session_id=? AND id<=?
+            """, (session_id, max_id)).rowcount
+            conn.commit()
+
+    with transaction() as conn:
+        keep = conn.execute(
+            "SELECT msg_count, last_at, last_preview, updated_at FROM chat_sessions WHERE session_id=?",
+            (session_id,)
+        ).fetchone()
+        conn.execute("DELETE FROM chat_history WHERE session_id=? AND id<=?", (session_id, max_id))
+        # 刪除 trigger 會把摘要歸零，這裡還原（訊息只是換地方放）
+        conn.execute("""
+            UPDATE chat_sessions SET msg_count=?, last_at=?, last_preview=?, updated_at=?, archived_in=?
+            WHERE session_id=?
+        """, (keep["msg_count"], keep["last_at"], keep["last_preview"], keep["updated_at"],
+              name, session_id))
+    return moved
+
+def find_candidates(days=DEFAULT_DAYS, limit=DEFAULT_BATCH):
+    """閒置超過 days 天、主庫仍有訊息的 session（走 idx_sessions_updated）"""
+    with connection() as conn:
+        rows = conn.execute("""
+            SELECT s.session_id FROM chat_sessions s
+            WHERE s.updated_at < datetime('now','localtime', ?)
+              AND EXISTS (SELECT 1 FROM chat_history h WHERE h.session_id = s.session_id)
+            ORDER BY s.updated_at
+            LIMIT ?
+        """, (f"-{int(days)} days", limit)).fetchall()
+    return [r["session_id"] for r in rows]
+
+def run_archive(days=DEFAULT_DAYS, batch=DEFAULT_BATCH, max_batches=None, log=print):
+    """分批搬移，每個 session 各自一個短 transaction；回傳統計"""
+    sessions = messages = batches = 0
+    while max_batches is None or batches < max_batches:
+        ids = find_candidates(days, batch)
+        if not ids:
+            break
+        for sid in ids:
+            messages += archive_session(sid)
+            sessions += 1
+        batches += 1
+        if log:
+            log(f"  第 {batches} 批：累計 {sessions} 個對話、{messages} 則訊息")
+        time.sleep(BATCH_PAUSE)
+    return {"sessions": sessions, "messages": messages, "batches": batches}
+
+def restore_session(session_id):
+    """封存的對話搬回主庫（例如重新變成常用對話）"""
+    with connection() as conn:
+        row = conn.execute("SELECT archived_in FROM chat_sessions WHERE session_id=?", (session_id,)).fetchone()
+    if not row or not row["archived_in"]:
+        return 0
+    path = archive_path(row["archived_in"])
+    if not os.path.exists(path):
+        return 0
+    with connection() as conn:
+        with _attached(conn, path):
+            keep = conn.execute(
+                "SELECT msg_count, last_at, last_preview, updated_at FROM main.chat_sessions WHERE session_id=?",
+                (session_id,)
+            ).fetchone()
+            moved = conn.execute("""
+                INSERT OR IGNORE INTO main.chat_history
+                SELECT * FROM arch.chat_history WHERE session_id=?
+            """, (session_id,)).rowcount
+            conn.execute("""
+                UPDATE main.chat_sessions SET msg_count=?, last_at=?, last_preview=?, updated_at=?,
+                       archived_in=NULL WHERE session_id=?
+            """, (keep["msg_count"], keep["last_at"], keep["last_preview"], keep["updated_at"], session_id))
+            conn.commit()
+    with get_pool(path).transaction() as conn:
+        conn.execute("DELETE FROM chat_history WHERE session_id=?", (session_id,))
+    return moved
+
+# ══════════════════════════════════════
+# 讀取 / 刪除（database.py 在 session 已封存時呼叫）
+# ══════════════════════════════════════
+def read_history(session_id, archive, limit=100, offset=0, before_id=None, after_id=None):
+    """主庫 + 封存檔合併查詢，行為與 database.get_chat_history 相同（舊到新）"""
+    path = archive_path(archive)
+    if not os.path.exists(path):
+        base, params = "SELECT * FROM chat_history WHERE session_id=?", [session_id]
+    else:
+        base = """SELECT * FROM (
+                      SELECT * FROM main.chat_history WHERE session_id=?
+                      UNION ALL
+                      SELECT * FROM arch.chat_history WHERE session_id=?
+                  ) WHERE 1=1"""
+        params = [session_id, session_id]
+    q, params, asc = _keyset(base, params, before_id, after_id, limit, offset)
+    with connection() as conn:
+        if os.path.exists(path):
+            with _attached(conn, path):
+                rows = conn.execute(q, params).fetchall()
+        else:
+            rows = conn.execute(q, params).fetchall()
+    if not asc:
+        rows = reversed(rows)
+    return [dict(r) for r in rows]
+
+def delete_archived(session_id, archive):
+    path = archive_path(archive)
+    if os.path.exists(path):
+        with get_pool(path).transaction() as conn:
+            conn.execute("DELETE FROM chat_history WHERE session_id=?", (session_id,))
+
+def archive_stats():
+    files = []
+    if os.path.isdir(ARCHIVE_DIR):
+        for fn in sorted(os.listdir(ARCHIVE_DIR)):
+            if fn.endswith(".db"):
+                files.append({"name": fn[:-3], "size": os.path.getsize(os.path.join(ARCHIVE_DIR, fn))})
+    with connection() as conn:
+        n = conn.execute("SELECT COUNT(*) FROM chat_sessions WHERE archived_in IS NOT NULL").fetchone()[0]
+    return {"archived_sessions": n, "files": files}
+
+if __name__ == "__main__":
+    import sys
+    cmd = sys.argv[1] if len(sys.argv) > 1 else ""
+
+    if cmd == "run":
+        days        = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_DAYS
+        batch       = int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_BATCH
+        max_batches = int(sys.argv[4]) if len(sys.argv) > 4 else None
+        print(f"封存閒置超過 {days} 天的對話（每批 {batch} 個）...")
+        r = run_archive(days, batch, max_batches)
+        print(f"完成：{r['sessions']} 個對話、{r['messages']} 則訊息，共 {r['batches']} 批")
+
+    elif cmd == "restore" and len(sys.argv) > 2:
+        print(f"還原 {sys.argv[2]}：{restore_session(sys.argv[2])} 則訊息")
+
+    elif cmd == "stats":
+        s = archive_stats()
+        print(f"已封存對話：{s['archived_sessions']}")
+        for f in s["files"]:
+            print(f"  {f['name']}  {f['size'] / 1024 / 1024:.1f} MB")
+
+    else:
+        print("用法：python chat_archive.py run [天數] [每批數量] [最多批數] | restore <session_id> | stats")
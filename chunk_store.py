@@ -0,0 +1,162 @@
+"""
+chunk_store.py — 文件段落表（KB / RAG 共用）
+- 上傳 / 新增文件時切段一次，寫入 chunks，所有檢索路徑直接讀
+- chunk_docs 記錄每份文件的內容 hash；內容沒變就不重切
+- 切段以段落 → 句子為單位（中英文標點皆可），超長句子才硬切
+- source：'kb'（kb_docs.id）或 'rag'（rag_docs 的內容 hash，見 rag_store.py）
+"""
+import re
+import hashlib
+from database import connection
+
+DEFAULT_SIZE = 400
+PARA_FLUSH   = 0.5    # 目前段落已達 size 的一半時，遇到新段落就換塊
+
+# 句尾：中文標點（可接收尾引號 / 括號）、英文句點問號驚嘆號後接空白
+_SENT_END = re.compile(r'[。！？；…]+[」』”’）)]*|[.!?;]+["\')\]]*(?=\s)')
+_PARA_SEP = re.compile(r'\n\s*\n|\n')
+
+def content_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+# ══════════════════════════════════════
+# 切段
+# ══════════════════════════════════════
+def _units(text, size):
+    """把全文拆成 (start, end, 是否為段落開頭) 的句子單位，超過 size 的句子硬切"""
+    units = []
+    pos = 0
+    for para in _PARA_SEP.split(text):
+        start = text.find(para, pos)
+        pos = start + len(para)
+        if not para.strip():
+            continue
+        first = True
+        s = start
+        bounds = [start + m.end() for m in _SENT_END.finditer(para)] + [pos]
+        for e in bounds:
+            if e <= s:
+                continue
+            seg = text[s:e]
+            lead = len(seg) - len(seg.lstrip())
+            seg_s, seg_e = s + lead, s + len(seg.rstrip())
+            s = e
+            if seg_s >= seg_e:
+                continue
+            while seg_e - seg_s > size:
+                units.append((seg_s, seg_s + size, first))
+                first = False
+                seg_s += size
+            units.append((seg_s, seg_e, first))
+            first = False
+    return units
+
+def split_text(text, size=DEFAULT_SIZE, overlap=0):
+    """
+    段落 / 句子感知切段，回傳 [(start, end), ...]（text[start:end] 即段落內容）
+    overlap > 0 時，下一塊從上一塊結尾往回不超過 overlap 字元的完整句子開始
+    """
+    units = _units(text, size)
+    spans, cur = [], []
+    for u in units:
+        if cur:
+            length = u[1] - cur[0][0]
+            para_break = u[2] and cur[-1][1] - cur[0][0] >= size * PARA_FLUSH
+            if length > size or para_break:
+                spans.append((cur[0][0], cur[-1][1]))
+                keep = []
+                if overlap:
+                    for prev in reversed(cur):
+                        if cur[-1][1] - prev[0] > overlap or u[1] - prev[0] > size:
+                            break
+                        keep.insert(0, prev)
+                    if len(keep) == len(cur):
+                        keep = []
+                cur = keep
+        cur.append(u)
+    if cur:
+        spans.append((cur[0][0], cur[-1][1]))
+    return spans
+
+def split_sentences(text):
+    """句子邊界 [(start, end), ...]（不硬切長句；context_packer 截斷用）"""
+    return [(s, e) for s, e, _ in _units(text, len(text) + 1)]
+
+def split_chunks(text, size=DEFAULT_SIZE, overlap=0):
+    return [text[s:e] for s, e in split_text(text, size, overlap)]
+
+# ══════════════════════════════════════
+# 段落表
+# ══════════════════════════════════════
+def ensure_chunks(conn, source, doc_id, text, count_tokens, size=DEFAULT_SIZE, overlap=0):
+    """
+    內容 hash 沒變就直接回傳既有段落，否則重切並覆寫
+    回傳 [(chunk_id, text, n_tokens), ...]（依 ordinal）
+    count_tokens：各來源自己的斷詞計數（BM25 / TF-IDF 長度正規化用）
+    """
+    doc_id = str(doc_id)
+    h = content_hash(text)
+    row = conn.execute(
+        "SELECT content_hash, size, overlap FROM chunk_docs WHERE source=? AND doc_id=?",
+        (source, doc_id)
+    ).fetchone()
+    if row and (row["content_hash"], row["size"], row["overlap"]) == (h, size, overlap):
+        return [tuple(r) for r in conn.execute(
+            "SELECT id, text, n_tokens FROM chunks WHERE source=? AND doc_id=? ORDER BY ordinal",
+            (source, doc_id))]
+
+    spans = []
+    for start, end in split_text(text, size, overlap):
+        spans.append((start, end, count_tokens(text[start:end])))
+    return write_chunks(conn, source, doc_id, text, spans, size, overlap)
+
+def write_chunks(conn, source, doc_id, text, spans, size=DEFAULT_SIZE, overlap=0):
+    """
+    直接寫入已切好的段落 spans=[(start, end, n_tokens), ...]（批次匯入在 worker 行程切好）
+    回傳 [(chunk_id, text, n_tokens), ...]
+    """
+    doc_id = str(doc_id)
+    conn.execute("DELETE FROM chunks WHERE source=? AND doc_id=?", (source, doc_id))
+    result = []
+    for i, (s, e, n) in enumerate(spans):
+        chunk = text[s:e]
+        cid = conn.execute(
+            "INSERT INTO chunks (source, doc_id, ordinal, text, n_tokens, char_start, char_end) VALUES (?,?,?,?,?,?,?)",
+            (source, doc_id, i, chunk, n, s, e)
+        ).lastrowid
+        result.append((cid, chunk, n))
+    conn.execute("""
+        INSERT INTO chunk_docs (source, doc_id, content_hash, size, overlap, n_chunks)
+        VALUES (?,?,?,?,?,?)
+        ON CONFLICT(source, doc_id) DO UPDATE SET
+            content_hash=excluded.content_hash, size=excluded.size, overlap=excluded.overlap,
+            n_chunks=excluded.n_chunks, chunked_at=datetime('now','localtime')
+    """, (source, doc_id, content_hash(text), size, overlap, len(result)))
+    return result
+
+def drop_chunks(conn, source, doc_id):
+    conn.execute("DELETE FROM chunks     WHERE source=? AND doc_id=?", (source, str(doc_id)))
+    conn.execute("DELETE FROM chunk_docs WHERE source=? AND doc_id=?", (source, str(doc_id)))
+
+def get_chunks(source, doc_ids):
+    """多份文件的段落：{doc_id: [dict, ...]}；沒切過的文件不在結果裡"""
+    doc_ids = [str(d) for d in doc_ids]
+    if not doc_ids:
+        return {}
+    with connection() as conn:
+        rows = conn.execute(f"""
+            SELECT id, doc_id, ordinal, text, n_tokens, char_start, char_end FROM chunks
+            WHERE source=? AND doc_id IN ({','.join('?' * len(doc_ids))})
+            ORDER BY doc_id, ordinal
+        """, [source] + doc_ids).fetchall()
+    out = {}
+    for r in rows:
+        out.setdefault(r["doc_id"], []).append(dict(r))
+    return out
+
+def chunk_count(source, doc_id):
+    with connection() as conn:
+        row = conn.execute(
+            "SELECT n_chunks FROM chunk_docs WHERE source=? AND doc_id=?", (source, str(doc_id))
+        ).fetchone()
+    return row["n_chunks"] if row else 0
@@ -0,0 +1,39 @@
+"""
+conftest.py — pytest 共用 fixture
+db：每個測試一個獨立的 SQLite 檔（tmp_path），資料 / 索引 / blob / 封存目錄都指到同一個暫存目錄，
+    各模組的行程內快取清空後才建表
+"""
+import os
+import pytest
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    import database
+    import kb_manager
+    import rag_store
+    import sparse_index
+    import chat_archive
+    import ingest
+    import query_cache
+
+    path = str(tmp_path / "chatroom.db")
+    monkeypatch.setattr(database,     "DB_PATH",      path)
+    monkeypatch.setattr(kb_manager,   "DB_PATH",      path)
+    monkeypatch.setattr(rag_store,    "BLOB_DIR",     str(tmp_path / "rag_blobs"))
+    monkeypatch.setattr(rag_store,    "LEGACY_INDEX", str(tmp_path / "rag_index.json"))
+    monkeypatch.setattr(rag_store,    "LEGACY_DIR",   str(tmp_path / "rag_docs"))
+    monkeypatch.setattr(sparse_index, "INDEX_DIR",    str(tmp_path / "index"))
+    monkeypatch.setattr(chat_archive, "ARCHIVE_DIR",  str(tmp_path / "archive"))
+    monkeypatch.setattr(ingest,       "INGEST_DIR",   str(tmp_path / "ingest"))
+
+    sparse_index._loaded.clear()
+    rag_store._cache.invalidate()
+    for cache in list(query_cache._caches.values()):
+        cache.clear()
+    database._settings_cache.invalidate()
+
+    database.init_db()
+    kb_manager.init_kb()
+    rag_store.init_rag()
+    yield path
+    sparse_index._loaded.clear()
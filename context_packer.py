@@ -0,0 +1,121 @@
+"""
+context_packer.py — 依 token 預算打包檢索內容（世界狀態 / KB / RAG）
+- 每個候選帶 source、text、score；分數先除以該來源的最高分，再全域排序依序放進預算
+- 同一份文件的段落範圍重疊（RAG 切段 overlap）時去掉重疊部分；
+  其餘與已選內容的 5-gram 重複比例 ≥ DUP_THRESHOLD 視為近似重複直接丟掉
+- 放不下的段落截到句子邊界；剩餘預算少於 MIN_PIECE_TOKENS 就不再截
+- 回傳打包結果 + 各來源用量報告（候選數、放入數、token、截斷 / 重複 / 超出預算數）
+"""
+import os
+import re
+import math
+from chunk_store import split_sentences
+
+DEFAULT_BUDGET = int(os.environ.get("CONTEXT_BUDGET", 3000))   # 單次對話的檢索內容上限
+SOURCE_BUDGET  = int(os.environ.get("SOURCE_BUDGET", 1500))    # 只有單一來源時（rag_search / build_kb_context）
+HISTORY_BUDGET = int(os.environ.get("HISTORY_BUDGET", 2000))   # 對話歷史上限（見 ai_utils._get_messages）
+MODEL_BUDGETS  = {                                            # 小模型 / TPM 額度低的模型給少一點
+    "llama-3.1-8b-instant": 1500,
+    "gemma2-9b-it":         1500,
+    "mixtral-8x7b-32768":   6000,
+}
+SOURCE_SHARES    = {"world": 0.6}   # 單一來源最多用掉預算的比例
+DUP_THRESHOLD    = 0.8
+SHINGLE          = 5
+MIN_PIECE_TOKENS = 24
+
+_CJK_CHAR = re.compile(r'[\u3000-\u303f\u3400-\u9fff\uff00-\uffef]')
+_SPACE    = re.compile(r'\s+')
+
+def budget_for(model_id=None, models=None):
+    """models：all_models() 清單；自訂模型可用 context_budget 欄位覆寫"""
+    for m in models or []:
+        if m.get("id") == model_id and m.get("context_budget"):
+            return int(m["context_budget"])
+    return MODEL_BUDGETS.get(model_id, DEFAULT_BUDGET)
+
+def estimate_tokens(text):
+    """粗估：中日文全形字元 1 字 ≈ 1 token，其餘約 4 字元 1 token"""
+    if not text:
+        return 0
+    cjk = len(_CJK_CHAR.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+def trim_to_sentences(text, max_tokens):
+    """保留開頭放得進 max_tokens 的完整句子；第一句就放不下時回傳空字串"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    end, used = 0, 0
+    for s, e in split_sentences(text):
+        used += estimate_tokens(text[end:e])
+        if used > max_tokens:
+            break
+        end = e
+    return text[:end].rstrip()
+
+def _shingles(text):
+    t = _SPACE.sub("", text.lower())
+    return {t[i:i + SHINGLE] for i in range(max(len(t) - SHINGLE + 1, 1))}
+
+def _cut_overlap(c, spans):
+    """同文件已選段落的範圍重疊：去掉開頭 / 結尾重疊的部分，完全被涵蓋時回傳 None"""
+    text, s, e = c["text"], c["start"], c["end"]
+    for ss, se in spans:
+        if ss <= s and e <= se:
+            return None
+        if ss <= s < se < e:
+            text, s = text[se - s:], se
+        elif s < ss < e <= se:
+            text, e = text[:ss - s], ss
+    return text.strip() or None
+
+def pack(candidates, budget=None, shares=None):
+    """
+    candidates：[{"source", "text", "score", 可選 "doc" / "start" / "end" 及其他欄位}, ...]
+    回傳 (packed, report)
+      packed：放進預算的候選（dict 副本，text 可能已截斷，附 tokens / trimmed），依排序先後
+      report：{"budget", "used", "sources": {source: {...}}}
+    """
+    budget = DEFAULT_BUDGET if budget is None else budget
+    shares = SOURCE_SHARES if shares is None else shares
+    top = {}
+    for c in candidates:
+        top[c["source"]] = max(top.get(c["source"], 0), c.get("score") or 0)
+    sources = {src: {"candidates": 0, "packed": 0, "tokens": 0,
+                     "trimmed": 0, "duplicates": 0, "over_budget": 0} for src in top}
+    for c in candidates:
+        sources[c["source"]]["candidates"] += 1
+    order = sorted(range(len(candidates)), key=lambda i: (
+        -((candidates[i].get("score") or 0) / (top[candidates[i]["source"]] or 1)), i))
+
+    packed, seen, spans, used = [], set(), {}, 0
+    for i in order:
+        c = candidates[i]
+        st = sources[c["source"]]
+        text = c["text"]
+        if c.get("doc") is not None and c.get("start") is not None:
+            text = _cut_overlap(c, spans.get((c["source"], c["doc"]), []))
+        sh = _shingles(text) if text else None
+        if not text or len(sh & seen) >= DUP_THRESHOLD * len(sh):
+            st["duplicates"] += 1
+            continue
+        room = budget - used
+        if c["source"] in shares:
+            room = min(room, int(budget * shares[c["source"]]) - st["tokens"])
+        tokens = estimate_tokens(text)
+        trimmed = False
+        if tokens > room:
+            text = trim_to_sentences(text, room) if room >= MIN_PIECE_TOKENS else ""
+            if not text:
+                st["over_budget"] += 1
+                continue
+            tokens, trimmed = estimate_tokens(text), True
+            st["trimmed"] += 1
+        packed.append(dict(c, text=text, tokens=tokens, trimmed=trimmed))
+        seen |= _shingles(text) if trimmed else sh
+        if not trimmed and c.get("doc") is not None and c.get("start") is not None:
+            spans.setdefault((c["source"], c["doc"]), []).append((c["start"], c["end"]))
+        st["packed"] += 1
+        st["tokens"] += tokens
+        used += tokens
+    return packed, {"budget": budget, "used": used, "sources": sources}
@@ -5,23 +5,365 @@ database.py — SQLite 資料庫管理
 import sqlite3
 import json
 import os
+import re
+import base64
+import time
+import hashlib
+import threading
 from datetime import datetime
+from db_pool import get_pool
+from db_writer import get_writer
 
 DB_PATH = os.path.join(os.path.dirname(__file__), "data", "chatroom.db")
 
-def get_conn():
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA foreign_keys=ON")
-    return conn
+def connection():
+    """從連線池借一條連線（讀取用）：with connection() as conn: ..."""
+    return get_pool(DB_PATH).connection()
+
+def transaction():
+    """寫入用：正常結束 commit，發生例外 rollback"""
+    return get_pool(DB_PATH).transaction()
+
+def _write(sql, params=(), wait=False):
+    """
+    單筆寫入：DB_WRITE_BEHIND 開啟時交給 writer 執行緒合併 commit
+    wait=True 會等到該批 commit 並回傳 lastrowid
+    """
+    w = get_writer(DB_PATH)
+    if w is None:
+        with transaction() as conn:
+            return conn.execute(sql, params).lastrowid
+    fut = w.submit(sql, params)
+    return fut.result() if wait else None
+
+def _sync_writes():
+    """讀取 / 刪除前確保佇列中的寫入已落地（沒有待寫入時不等待）"""
+    w = get_writer(DB_PATH)
+    if w is not None and w.pending():
+        w.flush()
+
+# ══════════════════════════════════════
+# 游標分頁（keyset pagination）
+# ══════════════════════════════════════
+# 以 id 為鍵：WHERE <分組欄位>=? AND id<? ORDER BY id DESC LIMIT ?
+# SQLite 的次要索引尾端自帶 rowid，idx_chat_session / idx_records_table / idx_events_type
+# 實際上就是 (session_id, id) / (table_name, id) / (event_type, id)，每頁都是一次 O(log n) seek
+def encode_cursor(direction, row_id):
+    """direction: 'before'（較舊）或 'after'（較新）"""
+    raw = json.dumps({"d": direction, "id": int(row_id)}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    """回傳 {"before_id": n} 或 {"after_id": n}；格式錯誤丟 ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        row_id = int(data["id"])
+        direction = data["d"]
+    except Exception:
+        raise ValueError("cursor 格式錯誤")
+    if direction == "before":
+        return {"before_id": row_id}
+    if direction == "after":
+        return {"after_id": row_id}
+    raise ValueError("cursor 格式錯誤")
+
+def _keyset(q, params, before_id, after_id, limit, offset=0):
+    """
+    幫 q 加上 id 範圍、排序與 LIMIT，回傳 (sql, params, asc)
+    after_id 時以 ASC 查詢（asc=True），呼叫端依需要自行反轉
+    """
+    if after_id is not None:
+        q += " AND id>? ORDER BY id ASC LIMIT ?"
+        return q, params + [after_id, limit], True
+    if before_id is not None:
+        q += " AND id<?"; params = params + [before_id]
+    q += " ORDER BY id DESC LIMIT ?"
+    params = params + [limit]
+    if offset and before_id is None:
+        q += " OFFSET ?"; params.append(offset)   # 舊 API 相容，深頁請改用 cursor
+    return q, params, False
 
 def init_db():
-    """建立所有資料表（首次執行）"""
-    conn = get_conn()
-    c = conn.cursor()
+    """建立所有資料表（首次執行），並套用尚未執行的 migration"""
+    with transaction() as conn:
+        _create_schema(conn.cursor())
+        apply_migrations(conn, MIGRATIONS)
+
+def apply_migrations(conn, migrations):
+    """
+    依序執行尚未套用的 migration（記錄在 schema_migrations）
+    migrations: [(名稱, fn(conn)), ...]，名稱全域唯一，kb_manager 也共用
+    """
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        name        TEXT PRIMARY KEY,
+        applied_at  TEXT NOT NULL DEFAULT (datetime('now','localtime'))
+    )""")
+    done = {r[0] for r in conn.execute("SELECT name FROM schema_migrations")}
+    for name, fn in migrations:
+        if name in done:
+            continue
+        if fn(conn) is False:   # 環境不支援（例如沒有 FTS5），下次啟動再試
+            continue
+        conn.execute("INSERT INTO schema_migrations (name) VALUES (?)", (name,))
+
+def _column_names(conn, table):
+    return {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+
+SESSION_PREVIEW_CHARS = 60
+
+def _m_session_summary(conn):
+    """chat_sessions 加上 msg_count / last_at / last_preview，由 trigger 維護"""
+    cols = _column_names(conn, "chat_sessions")
+    if "msg_count" not in cols:
+        conn.execute("ALTER TABLE chat_sessions ADD COLUMN msg_count INTEGER NOT NULL DEFAULT 0")
+    if "last_at" not in cols:
+        conn.execute("ALTER TABLE chat_sessions ADD COLUMN last_at TEXT")
+    if "last_preview" not in cols:
+        conn.execute("ALTER TABLE chat_sessions ADD COLUMN last_preview TEXT")
+
+    # 舊資料回填（一次性）
+    conn.execute(f"""
+        UPDATE chat_sessions SET
+            msg_count    = (SELECT COUNT(*) FROM chat_history h WHERE h.session_id = chat_sessions.session_id),
+            last_at      = (SELECT MAX(h.created_at) FROM chat_history h WHERE h.session_id = chat_sessions.session_id),
+            last_preview = (SELECT substr(h.content, 1, {SESSION_PREVIEW_CHARS}) FROM chat_history h
+                            WHERE h.session_id = chat_sessions.session_id ORDER BY h.id DESC LIMIT 1)
+    """)
+    # updated_at 改為「最後活動時間」＝ 列表排序鍵
+    conn.execute("UPDATE chat_sessions SET updated_at = COALESCE(last_at, created_at)")
+
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_chat_history_ins AFTER INSERT ON chat_history
+    BEGIN
+        UPDATE chat_sessions SET
+            msg_count    = msg_count + 1,
+            last_at      = NEW.created_at,
+            last_preview = substr(NEW.content, 1, {SESSION_PREVIEW_CHARS}),
+            updated_at   = NEW.created_at
+        WHERE session_id = NEW.session_id;
+    END""")
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_chat_history_del AFTER DELETE ON chat_history
+    BEGIN
+        UPDATE chat_sessions SET
+            msg_count    = max(msg_count - 1, 0),
+            last_at      = (SELECT created_at FROM chat_history
+                            WHERE session_id = OLD.session_id ORDER BY id DESC LIMIT 1),
+            last_preview = (SELECT substr(content, 1, {SESSION_PREVIEW_CHARS}) FROM chat_history
+                            WHERE session_id = OLD.session_id ORDER BY id DESC LIMIT 1)
+        WHERE session_id = OLD.session_id;
+        UPDATE chat_sessions SET updated_at = COALESCE(last_at, created_at)
+        WHERE session_id = OLD.session_id;
+    END""")
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_chat_history_upd AFTER UPDATE OF content ON chat_history
+    WHEN NEW.id = (SELECT MAX(id) FROM chat_history WHERE session_id = NEW.session_id)
+    BEGIN
+        UPDATE chat_sessions SET last_preview = substr(NEW.content, 1, {SESSION_PREVIEW_CHARS})
+        WHERE session_id = NEW.session_id;
+    END""")
+    # session 列晚於訊息建立時（例如舊版 'default'），從既有訊息補算一次
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_chat_sessions_ins AFTER INSERT ON chat_sessions
+    WHEN EXISTS (SELECT 1 FROM chat_history WHERE session_id = NEW.session_id)
+    BEGIN
+        UPDATE chat_sessions SET
+            msg_count    = (SELECT COUNT(*) FROM chat_history WHERE session_id = NEW.session_id),
+            last_at      = (SELECT created_at FROM chat_history
+                            WHERE session_id = NEW.session_id ORDER BY id DESC LIMIT 1),
+            last_preview = (SELECT substr(content, 1, {SESSION_PREVIEW_CHARS}) FROM chat_history
+                            WHERE session_id = NEW.session_id ORDER BY id DESC LIMIT 1)
+        WHERE session_id = NEW.session_id;
+        UPDATE chat_sessions SET updated_at = COALESCE(last_at, created_at)
+        WHERE session_id = NEW.session_id;
+    END""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_updated ON chat_sessions(updated_at DESC, created_at DESC)")
+
+# custom_records 全文索引：只收 JSON 的值（不含 key / 標點），trigram 支援中文子字串
+RECORD_TEXT_SQL = """(SELECT group_concat(value, ' ') FROM json_tree(
+    CASE WHEN json_valid({col}) THEN {col} ELSE '{{}}' END)
+    WHERE type IN ('text','integer','real'))"""
+
+def _fts_tokenizer(conn):
+    """trigram 需要 SQLite 3.34+，沒有就退回 unicode61；沒有 FTS5 回傳 None"""
+    for tok in ("trigram", "unicode61"):
+        try:
+            conn.execute(f"CREATE VIRTUAL TABLE temp._fts_probe USING fts5(x, tokenize='{tok}')")
+            conn.execute("DROP TABLE temp._fts_probe")
+            return tok
+        except sqlite3.OperationalError:
+            continue
+    return None
+
+def _m_records_fts(conn):
+    tok = _fts_tokenizer(conn)
+    if tok is None:
+        return False
+    conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS custom_records_fts USING fts5(body, tokenize='{tok}')")
+    new_text = RECORD_TEXT_SQL.format(col="NEW.data")
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_records_fts_ins AFTER INSERT ON custom_records
+    BEGIN
+        INSERT INTO custom_records_fts (rowid, body) VALUES (NEW.id, {new_text});
+    END""")
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_records_fts_upd AFTER UPDATE OF data ON custom_records
+    BEGIN
+        DELETE FROM custom_records_fts WHERE rowid = OLD.id;
+        INSERT INTO custom_records_fts (rowid, body) VALUES (NEW.id, {new_text});
+    END""")
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_records_fts_del AFTER DELETE ON custom_records
+    BEGIN
+        DELETE FROM custom_records_fts WHERE rowid = OLD.id;
+    END""")
+    conn.execute("DELETE FROM custom_records_fts")
+    conn.execute(f"""
+        INSERT INTO custom_records_fts (rowid, body)
+        SELECT id, {RECORD_TEXT_SQL.format(col="data")} FROM custom_records
+    """)
+
+def _m_custom_field_indexes(conn):
+    for r in conn.execute("SELECT name, fields FROM custom_tables").fetchall():
+        _create_field_indexes(conn, r["name"], json.loads(r["fields"] or "[]"))
+
+def _m_custom_table_counts(conn):
+    """custom_tables.record_count 由 trigger 維護，列表不必逐表 COUNT"""
+    if "record_count" not in _column_names(conn, "custom_tables"):
+        conn.execute("ALTER TABLE custom_tables ADD COLUMN record_count INTEGER NOT NULL DEFAULT 0")
+    conn.execute("""
+        UPDATE custom_tables SET record_count = COALESCE(
+            (SELECT cnt FROM (SELECT table_name, COUNT(*) AS cnt FROM custom_records GROUP BY table_name) c
+             WHERE c.table_name = custom_tables.name), 0)
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_records_count_ins AFTER INSERT ON custom_records
+    BEGIN
+        UPDATE custom_tables SET record_count = record_count + 1 WHERE name = NEW.table_name;
+    END""")
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_records_count_del AFTER DELETE ON custom_records
+    BEGIN
+        UPDATE custom_tables SET record_count = max(record_count - 1, 0) WHERE name = OLD.table_name;
+    END""")
+    # add_record 不檢查資料表是否存在；資料表晚建立時補算既有記錄
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_custom_tables_ins AFTER INSERT ON custom_tables
+    BEGIN
+        UPDATE custom_tables SET record_count =
+            (SELECT COUNT(*) FROM custom_records WHERE table_name = NEW.name)
+        WHERE id = NEW.id;
+    END""")
+
+def create_version_triggers(conn, table, name, when=None):
+    """
+    table 有任何 INSERT / UPDATE / DELETE 時，change_versions[name] 加一（跨行程可見）
+    when：額外條件，{row} 會換成 NEW / OLD，例如 "{row}.source = 'rag'"
+    """
+    for ev in ("INSERT", "UPDATE", "DELETE"):
+        cond = f"WHEN {when.format(row='OLD' if ev == 'DELETE' else 'NEW')}" if when else ""
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_ver_{ev.lower()} AFTER {ev} ON {table} {cond}
+        BEGIN
+            INSERT INTO change_versions (name, version) VALUES ('{name}', 1)
+            ON CONFLICT(name) DO UPDATE SET version = version + 1;
+        END""")
+
+def get_version(name, conn=None):
+    """讀取 change_versions[name]，沒有記錄時為 0"""
+    if conn is None:
+        with connection() as conn:
+            return get_version(name, conn)
+    row = conn.execute("SELECT version FROM change_versions WHERE name=?", (name,)).fetchone()
+    return row[0] if row else 0
+
+def _m_change_versions(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS change_versions (
+        name     TEXT PRIMARY KEY,
+        version  INTEGER NOT NULL DEFAULT 0
+    )""")
+    create_version_triggers(conn, "settings", "settings")
 
+def _m_chat_archive(conn):
+    """封存到 data/archive/*.db 的對話記錄檔名（見 chat_archive.py）"""
+    if "archived_in" not in _column_names(conn, "chat_sessions"):
+        conn.execute("ALTER TABLE chat_sessions ADD COLUMN archived_in TEXT")
+
+def _m_chunks(conn):
+    """KB / RAG 共用的段落表（見 chunk_store.py），chunk_docs 記錄切段時的內容 hash"""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS chunks (
+        id          INTEGER PRIMARY KEY,
+        source      TEXT    NOT NULL,
+        doc_id      TEXT    NOT NULL,
+        ordinal     INTEGER NOT NULL,
+        text        TEXT    NOT NULL,
+        n_tokens    INTEGER NOT NULL,
+        char_start  INTEGER NOT NULL,
+        char_end    INTEGER NOT NULL,
+        UNIQUE (source, doc_id, ordinal)
+    )""")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS chunk_docs (
+        source        TEXT    NOT NULL,
+        doc_id        TEXT    NOT NULL,
+        content_hash  TEXT    NOT NULL,
+        size          INTEGER NOT NULL,
+        overlap       INTEGER NOT NULL,
+        n_chunks      INTEGER NOT NULL,
+        chunked_at    TEXT    NOT NULL DEFAULT (datetime('now','localtime')),
+        PRIMARY KEY (source, doc_id)
+    )""")
+
+def _m_rag_postings(conn):
+    """RAG 段落詞頻（見 rag_store.py），以 (doc_id, term) 開頭只讀選定文件 × 查詢詞"""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS rag_postings (
+        doc_id      TEXT    NOT NULL,
+        term        TEXT    NOT NULL,
+        chunk_id    INTEGER NOT NULL,
+        tf          INTEGER NOT NULL,
+        PRIMARY KEY (doc_id, term, chunk_id)
+    ) WITHOUT ROWID""")
+
+def _m_rag_index_version(conn):
+    """RAG 文件切段有變動時 change_versions['rag_index'] 加一（稀疏矩陣 / 查詢快取用）"""
+    create_version_triggers(conn, "chunk_docs", "rag_index", when="{row}.source = 'rag'")
+
+def _m_ingest_jobs(conn):
+    """批次匯入工作（見 ingest.py）；files 為逐檔結果的 JSON 陣列，多個 worker 行程都能輪詢"""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS ingest_jobs (
+        id           TEXT    PRIMARY KEY,
+        target       TEXT    NOT NULL,
+        status       TEXT    NOT NULL DEFAULT 'receiving',
+        total        INTEGER NOT NULL DEFAULT 0,
+        processed    INTEGER NOT NULL DEFAULT 0,
+        imported     INTEGER NOT NULL DEFAULT 0,
+        failed       INTEGER NOT NULL DEFAULT 0,
+        files        TEXT    NOT NULL DEFAULT '[]',
+        error        TEXT,
+        created_at   TEXT    NOT NULL DEFAULT (datetime('now','localtime')),
+        finished_at  TEXT
+    )""")
+
+MIGRATIONS = [
+    ("003_session_summary",     _m_session_summary),
+    ("005_records_fts",         _m_records_fts),
+    ("006_custom_field_indexes", _m_custom_field_indexes),
+    ("007_custom_table_counts", _m_custom_table_counts),
+    ("008_change_versions",     _m_change_versions),
+    ("010_chat_archive",        _m_chat_archive),
+    ("013_chunks",              _m_chunks),
+    ("014_rag_postings",        _m_rag_postings),
+    ("015_rag_index_version",   _m_rag_index_version),
+    ("018_ingest_jobs",         _m_ingest_jobs),
+]
+
+def _create_schema(c):
     # ── 聊天記錄 ──
     c.execute("""
     CREATE TABLE IF NOT EXISTS chat_history (
@@ -99,92 +441,135 @@ def init_db():
     )""")
     c.execute("CREATE INDEX IF NOT EXISTS idx_records_table ON custom_records(table_name)")
 
-    conn.commit()
-    conn.close()
-
 # ══════════════════════════════════════
 # 聊天記錄
 # ══════════════════════════════════════
 def save_chat_message(session_id, role, content, character_id=None, model_id=None):
-    conn = get_conn()
-    conn.execute(
+    _write(
         "INSERT INTO chat_history (session_id,role,content,character_id,model_id) VALUES (?,?,?,?,?)",
         (session_id, role, content, character_id, model_id)
     )
-    conn.commit()
-    conn.close()
-
-def get_chat_history(session_id="default", limit=100, offset=0):
-    conn = get_conn()
-    rows = conn.execute(
-        "SELECT * FROM chat_history WHERE session_id=? ORDER BY id DESC LIMIT ? OFFSET ?",
-        (session_id, limit, offset)
-    ).fetchall()
-    conn.close()
-    return [dict(r) for r in reversed(rows)]
+
+def get_chat_history(session_id="default", limit=100, offset=0, before_id=None, after_id=None):
+    """
+    回傳舊到新的訊息
+    before_id：往前翻（比它舊的最新 limit 筆）；after_id：往後翻（比它新的最舊 limit 筆）
+    """
+    q, params, asc = _keyset("SELECT * FROM chat_history WHERE session_id=?", [session_id],
+                             before_id, after_id, limit, offset)
+    _sync_writes()
+    with connection() as conn:
+        arch = conn.execute(
+            "SELECT archived_in FROM chat_sessions WHERE session_id=?", (session_id,)).fetchone()
+        if not (arch and arch[0]):
+            rows = conn.execute(q, params).fetchall()
+    if arch and arch[0]:
+        from chat_archive import read_history   # 已封存：掛上封存檔合併查詢
+        return read_history(session_id, arch[0], limit, offset, before_id, after_id)
+    if not asc:
+        rows = reversed(rows)
+    return [dict(r) for r in rows]
+
+# ── 設定快取 ──
+# 讀取走記憶體；本行程 set_setting 立即失效，
+# 其他 worker 行程的寫入靠 change_versions['settings']（trigger 維護）偵測，
+# 最多每 SETTINGS_CHECK_SECONDS 秒查一次版本號
+SETTINGS_CHECK_SECONDS = float(os.environ.get("SETTINGS_CHECK_SECONDS", 1.0))
+
+class _SettingsCache:
+    def __init__(self):
+        self._lock    = threading.Lock()
+        self._values  = None
+        self._version = None
+        self._checked = 0.0
+        self._gen     = 0        # invalidate() 加一；開始得比較早的重新載入不得覆蓋
+        self.stats = {"hits": 0, "version_checks": 0, "reloads": 0, "dropped": 0}
+
+    def values(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._values is not None and now - self._checked < SETTINGS_CHECK_SECONDS:
+                self.stats["hits"] += 1
+                return self._values
+            gen = self._gen
+        with connection() as conn:
+            version = get_version("settings", conn)
+            with self._lock:
+                self.stats["version_checks"] += 1
+                if self._values is not None and version == self._version:
+                    self._checked = now
+                    return self._values
+            rows = conn.execute("SELECT key, value FROM settings").fetchall()
+        values = {r["key"]: r["value"] for r in rows}
+        with self._lock:
+            if gen != self._gen:
+                # 讀取期間有 set_setting：這份可能是舊值，不存（下一次呼叫重新載入）
+                self.stats["dropped"] += 1
+                return values
+            self.stats["reloads"] += 1
+            self._values, self._version, self._checked = values, version, now
+        return values
+
+    def invalidate(self):
+        with self._lock:
+            self._gen   += 1
+            self._values = None
+
+_settings_cache = _SettingsCache()
 
 def get_setting(key, default=""):
-    conn = get_conn()
-    row = conn.execute("SELECT value FROM settings WHERE key=?", (key,)).fetchone()
-    conn.close()
-    return row["value"] if row else default
+    values = _settings_cache.values()
+    return values[key] if key in values else default
 
 def set_setting(key, value):
-    conn = get_conn()
-    conn.execute("""
-        INSERT OR REPLACE INTO settings (key, value, updated_at)
-        VALUES (?, ?, datetime('now','localtime'))
-    """, (key, value))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO settings (key, value, updated_at)
+            VALUES (?, ?, datetime('now','localtime'))
+        """, (key, value))
+    _settings_cache.invalidate()
 
 def get_all_settings():
-    conn = get_conn()
-    rows = conn.execute("SELECT key, value FROM settings").fetchall()
-    conn.close()
-    return {r["key"]: r["value"] for r in rows}
+    return dict(_settings_cache.values())
 
 def create_session(session_id, title="新對話", char_id=None):
-    conn = get_conn()
-    conn.execute("""
+    _write("""
         INSERT OR IGNORE INTO chat_sessions (session_id, title, char_id, created_at, updated_at)
         VALUES (?, ?, ?, datetime('now','localtime'), datetime('now','localtime'))
     """, (session_id, title, char_id))
-    conn.commit()
-    conn.close()
 
 def update_session_title(session_id, title):
-    conn = get_conn()
-    conn.execute("""
-        INSERT OR REPLACE INTO chat_sessions (session_id, title, updated_at)
+    _write("""
+        INSERT INTO chat_sessions (session_id, title, updated_at)
         VALUES (?, ?, datetime('now','localtime'))
+        ON CONFLICT(session_id) DO UPDATE SET title = excluded.title
     """, (session_id, title))
-    conn.commit()
-    conn.close()
 
 def get_session(session_id):
-    conn = get_conn()
-    row = conn.execute("SELECT * FROM chat_sessions WHERE session_id=?", (session_id,)).fetchone()
-    conn.close()
+    _sync_writes()
+    with connection() as conn:
+        row = conn.execute("SELECT * FROM chat_sessions WHERE session_id=?", (session_id,)).fetchone()
     return dict(row) if row else None
 
 def list_chat_sessions():
-    """列出所有對話（含還沒訊息的新 session）"""
+    """
+    列出所有對話（含還沒訊息的新 session）
+    msg_count / last_at / last_preview 由 trigger 維護，走 idx_sessions_updated
+    """
     from datetime import datetime
-    conn = get_conn()
-    rows = conn.execute("""
-        SELECT
-            s.session_id,
-            COALESCE(s.title, '新對話') as title,
-            COUNT(h.id) as msg_count,
-            COALESCE(MAX(h.created_at), s.created_at) as last_at,
-            s.char_id
-        FROM chat_sessions s
-        LEFT JOIN chat_history h ON s.session_id = h.session_id
-        GROUP BY s.session_id
-        ORDER BY last_at DESC, s.created_at DESC
-    """).fetchall()
-    conn.close()
+    _sync_writes()
+    with connection() as conn:
+        rows = conn.execute("""
+            SELECT
+                session_id,
+                COALESCE(title, '新對話') as title,
+                msg_count,
+                COALESCE(last_at, created_at) as last_at,
+                last_preview,
+                char_id
+            FROM chat_sessions
+            ORDER BY updated_at DESC, created_at DESC
+        """).fetchall()
     result = []
     for r in rows:
         d = dict(r)
@@ -194,28 +579,28 @@ def list_chat_sessions():
     return result
 
 def delete_chat_session(session_id):
-    conn = get_conn()
-    conn.execute("DELETE FROM chat_history WHERE session_id=?", (session_id,))
-    conn.execute("DELETE FROM chat_sessions WHERE session_id=?", (session_id,))
-    conn.commit()
-    conn.close()
+    _sync_writes()
+    with transaction() as conn:
+        arch = conn.execute(
+            "SELECT archived_in FROM chat_sessions WHERE session_id=?", (session_id,)).fetchone()
+        conn.execute("DELETE FROM chat_history WHERE session_id=?", (session_id,))
+        conn.execute("DELETE FROM chat_sessions WHERE session_id=?", (session_id,))
+    if arch and arch[0]:
+        from chat_archive import delete_archived
+        delete_archived(session_id, arch[0])
 
 # ══════════════════════════════════════
 # 任務管理
 # ══════════════════════════════════════
 def create_task(title, description="", priority="medium", assigned_to=None, due_date=None, tags=None):
-    conn = get_conn()
-    c = conn.execute(
-        "INSERT INTO tasks (title,description,priority,assigned_to,due_date,tags) VALUES (?,?,?,?,?,?)",
-        (title, description, priority, assigned_to, due_date, json.dumps(tags or []))
-    )
-    task_id = c.lastrowid
-    conn.commit()
-    conn.close()
-    return task_id
+    with transaction() as conn:
+        c = conn.execute(
+            "INSERT INTO tasks (title,description,priority,assigned_to,due_date,tags) VALUES (?,?,?,?,?,?)",
+            (title, description, priority, assigned_to, due_date, json.dumps(tags or []))
+        )
+        return c.lastrowid
 
 def get_tasks(status=None, assigned_to=None):
-    conn = get_conn()
     q = "SELECT * FROM tasks WHERE 1=1"
     params = []
     if status:
@@ -223,8 +608,8 @@ def get_tasks(status=None, assigned_to=None):
     if assigned_to:
         q += " AND assigned_to=?"; params.append(assigned_to)
     q += " ORDER BY CASE priority WHEN 'high' THEN 1 WHEN 'medium' THEN 2 ELSE 3 END, created_at DESC"
-    rows = conn.execute(q, params).fetchall()
-    conn.close()
+    with connection() as conn:
+        rows = conn.execute(q, params).fetchall()
     result = []
     for r in rows:
         d = dict(r)
@@ -240,41 +625,35 @@ def update_task(task_id, **kwargs):
     kwargs["updated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     sets = ", ".join(f"{k}=?" for k in kwargs)
     vals = list(kwargs.values()) + [task_id]
-    conn = get_conn()
-    conn.execute(f"UPDATE tasks SET {sets} WHERE id=?", vals)
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute(f"UPDATE tasks SET {sets} WHERE id=?", vals)
 
 def delete_task(task_id):
-    conn = get_conn()
-    conn.execute("DELETE FROM tasks WHERE id=?", (task_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("DELETE FROM tasks WHERE id=?", (task_id,))
 
 # ══════════════════════════════════════
 # 事件歷史
 # ══════════════════════════════════════
 def add_event(title, description="", event_type="general", participants=None, outcome="", importance="normal"):
-    conn = get_conn()
-    c = conn.execute(
+    return _write(
         "INSERT INTO events (title,description,event_type,participants,outcome,importance) VALUES (?,?,?,?,?,?)",
-        (title, description, event_type, json.dumps(participants or []), outcome, importance)
+        (title, description, event_type, json.dumps(participants or []), outcome, importance),
+        wait=True
     )
-    eid = c.lastrowid
-    conn.commit()
-    conn.close()
-    return eid
 
-def get_events(event_type=None, limit=50):
-    conn = get_conn()
+def get_events(event_type=None, limit=50, before_id=None, after_id=None):
+    """新到舊；before_id / after_id 為游標分頁"""
     q = "SELECT * FROM events WHERE 1=1"
     params = []
     if event_type:
         q += " AND event_type=?"; params.append(event_type)
-    q += " ORDER BY created_at DESC LIMIT ?"
-    params.append(limit)
-    rows = conn.execute(q, params).fetchall()
-    conn.close()
+    q, params, asc = _keyset(q, params, before_id, after_id, limit)
+    _sync_writes()
+    with connection() as conn:
+        rows = conn.execute(q, params).fetchall()
+    if asc:
+        rows.reverse()
     result = []
     for r in rows:
         d = dict(r)
@@ -283,78 +662,172 @@ def get_events(event_type=None, limit=50):
     return result
 
 def delete_event(event_id):
-    conn = get_conn()
-    conn.execute("DELETE FROM events WHERE id=?", (event_id,))
-    conn.commit()
-    conn.close()
+    _sync_writes()
+    with transaction() as conn:
+        conn.execute("DELETE FROM events WHERE id=?", (event_id,))
 
 # ══════════════════════════════════════
 # 自訂資料表
 # ══════════════════════════════════════
+# ── 欄位型別與索引 ──
+# 每個宣告的欄位（textarea 除外）建一個 (table_name, 型別化 json_extract) 運算式索引，
+# 篩選 / 排序 / 彙總時用完全相同的運算式，SQLite 就能直接走索引
+# 欄位名稱不限字元；含 " \ 或控制字元的無法放進 JSON path，改用 json_each 取值（不建索引）
+INDEXABLE_NAME_RE = re.compile(r'^[^"\\\x00-\x1f]+$')
+INDEXED_TYPES     = {"text", "number", "date", "select"}
+BUILTIN_COLUMNS   = {"id", "created_at", "updated_at"}
+
+def _sql_str(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+def _indexable(name):
+    return bool(INDEXABLE_NAME_RE.match(name))
+
+def _field_expr(field):
+    """欄位 → SQL 運算式（名稱以 SQL 字串常值內嵌，建索引與查詢用同一個運算式）"""
+    name = str(field.get("name", ""))
+    if _indexable(name):
+        path = '$."' + name + '"'
+        expr = f"json_extract(data, {_sql_str(path)})"
+    else:
+        expr = f"(SELECT value FROM json_each(data) WHERE key={_sql_str(name)})"
+    if field.get("type") == "number":
+        return f"CAST({expr} AS REAL)"
+    return expr
+
+def _field_index_name(table_name, field_name):
+    h = hashlib.sha1(f"{table_name}\0{field_name}".encode("utf-8")).hexdigest()[:16]
+    return f"idx_cf_{h}"
+
+def _create_field_indexes(conn, table_name, fields):
+    for f in fields:
+        if f.get("type", "text") not in INDEXED_TYPES or not _indexable(str(f.get("name", ""))):
+            continue
+        conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {_field_index_name(table_name, f['name'])} "
+            f"ON custom_records(table_name, {_field_expr(f)})"
+        )
+
+def _drop_field_indexes(conn, table_name, fields):
+    for f in fields:
+        conn.execute(f"DROP INDEX IF EXISTS {_field_index_name(table_name, str(f.get('name', '')))}")
+
 def create_custom_table(name, display_name, fields):
     """
     fields 格式：[{"name":"title","type":"text","label":"標題"}, ...]
     type 可以是：text / number / date / select / textarea
+    text / number / date / select 欄位會自動建立索引（見 query_records）
     """
-    conn = get_conn()
     try:
-        conn.execute(
-            "INSERT INTO custom_tables (name,display_name,fields) VALUES (?,?,?)",
-            (name, display_name, json.dumps(fields))
-        )
-        conn.commit()
+        with transaction() as conn:
+            conn.execute(
+                "INSERT INTO custom_tables (name,display_name,fields) VALUES (?,?,?)",
+                (name, display_name, json.dumps(fields))
+            )
+            _create_field_indexes(conn, name, fields)
     except sqlite3.IntegrityError:
-        conn.close()
         raise ValueError(f"資料表 {name} 已存在")
-    conn.close()
+
+def get_custom_table(name):
+    with connection() as conn:
+        row = conn.execute("SELECT * FROM custom_tables WHERE name=?", (name,)).fetchone()
+    if not row:
+        return None
+    d = dict(row)
+    d["fields"] = json.loads(d.get("fields") or "[]")
+    return d
 
 def list_custom_tables():
-    conn = get_conn()
-    rows = conn.execute("SELECT * FROM custom_tables ORDER BY created_at").fetchall()
-    conn.close()
+    """單一查詢；record_count 由 trigger 維護"""
+    with connection() as conn:
+        rows = conn.execute("SELECT * FROM custom_tables ORDER BY created_at").fetchall()
     result = []
     for r in rows:
         d = dict(r)
         d["fields"] = json.loads(d.get("fields") or "[]")
-        # 計算記錄數
-        cnt = get_conn().execute(
-            "SELECT COUNT(*) FROM custom_records WHERE table_name=?", (d["name"],)
-        ).fetchone()[0]
-        d["record_count"] = cnt
         result.append(d)
     return result
 
 def delete_custom_table(name):
-    conn = get_conn()
-    conn.execute("DELETE FROM custom_tables WHERE name=?", (name,))
-    conn.execute("DELETE FROM custom_records WHERE table_name=?", (name,))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        row = conn.execute("SELECT fields FROM custom_tables WHERE name=?", (name,)).fetchone()
+        if row:
+            _drop_field_indexes(conn, name, json.loads(row["fields"] or "[]"))
+        conn.execute("DELETE FROM custom_tables WHERE name=?", (name,))
+        conn.execute("DELETE FROM custom_records WHERE table_name=?", (name,))
 
 def add_record(table_name, data):
-    conn = get_conn()
-    c = conn.execute(
-        "INSERT INTO custom_records (table_name,data) VALUES (?,?)",
-        (table_name, json.dumps(data, ensure_ascii=False))
-    )
-    rid = c.lastrowid
-    conn.commit()
-    conn.close()
-    return rid
-
-def get_records(table_name, search=None, limit=100, offset=0):
-    conn = get_conn()
-    if search:
-        rows = conn.execute(
+    with transaction() as conn:
+        c = conn.execute(
+            "INSERT INTO custom_records (table_name,data) VALUES (?,?)",
+            (table_name, json.dumps(data, ensure_ascii=False))
+        )
+        return c.lastrowid
+
+_fts_mode = None   # None=未檢查、""=沒有 FTS5、否則為 tokenizer 名稱
+
+def _records_fts_mode(conn):
+    global _fts_mode
+    if _fts_mode is None:
+        row = conn.execute(
+            "SELECT sql FROM sqlite_master WHERE name='custom_records_fts'").fetchone()
+        if not row:
+            return ""          # 尚未建立，不快取（下次 init_db 可能補上）
+        _fts_mode = "trigram" if "trigram" in row[0] else "unicode61"
+    return _fts_mode
+
+def _like_escape(s):
+    return s.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def _search_records(conn, table_name, search, limit, offset):
+    """
+    全文搜尋（依相關度排序）：
+    - trigram：≥3 字的詞走 FTS MATCH（子字串 / 前綴皆可），較短的詞（常見的 2 字中文）
+      對索引內的純文字做 LIKE，不會比對到 JSON key
+    - unicode61：每個詞都當前綴查詢 "詞"*
+    - 沒有 FTS5：退回舊的 data LIKE
+    """
+    mode = _records_fts_mode(conn)
+    terms = [t.rstrip("*") for t in search.split()]
+    terms = [t for t in terms if t]
+    if not mode or not terms:
+        return conn.execute(
             "SELECT * FROM custom_records WHERE table_name=? AND data LIKE ? ORDER BY id DESC LIMIT ? OFFSET ?",
             (table_name, f"%{search}%", limit, offset)
         ).fetchall()
+
+    quote = lambda t: '"' + t.replace('"', '""') + '"'
+    if mode == "trigram":
+        match = [quote(t) for t in terms if len(t) >= 3]
+        likes = [t for t in terms if len(t) < 3]
     else:
-        rows = conn.execute(
-            "SELECT * FROM custom_records WHERE table_name=? ORDER BY id DESC LIMIT ? OFFSET ?",
-            (table_name, limit, offset)
-        ).fetchall()
-    conn.close()
+        match = [quote(t) + "*" for t in terms]
+        likes = []
+
+    q = "SELECT r.* FROM custom_records_fts f JOIN custom_records r ON r.id = f.rowid WHERE r.table_name=?"
+    params = [table_name]
+    if match:
+        q += " AND custom_records_fts MATCH ?"; params.append(" AND ".join(match))
+    for t in likes:
+        q += " AND f.body LIKE ? ESCAPE '\\'"; params.append(f"%{_like_escape(t)}%")
+    q += " ORDER BY " + ("bm25(custom_records_fts), " if match else "") + "r.id DESC LIMIT ? OFFSET ?"
+    params += [limit, offset]
+    return conn.execute(q, params).fetchall()
+
+def get_records(table_name, search=None, limit=100, offset=0, before_id=None, after_id=None):
+    """
+    新到舊；before_id / after_id 為游標分頁，offset 僅為相容保留
+    search 有值時改走全文索引、依相關度排序（以 offset 分頁）
+    """
+    with connection() as conn:
+        if search:
+            rows = _search_records(conn, table_name, search, limit, offset)
+        else:
+            q, params, asc = _keyset("SELECT * FROM custom_records WHERE table_name=?", [table_name],
+                                     before_id, after_id, limit, offset)
+            rows = conn.execute(q, params).fetchall()
+            if asc:
+                rows.reverse()
     result = []
     for r in rows:
         d = dict(r)
@@ -362,32 +835,134 @@ def get_records(table_name, search=None, limit=100, offset=0):
         result.append(d)
     return result
 
+FILTER_OPS = {"eq": "=", "ne": "!=", "lt": "<", "lte": "<=", "gt": ">", "gte": ">="}
+AGG_FNS    = {"count", "sum", "avg", "min", "max"}
+MAX_QUERY_LIMIT = 1000
+
+def query_records(table_name, filters=None, sort=None, limit=100, offset=0,
+                  aggregate=None, group_by=None):
+    """
+    伺服器端篩選 / 排序 / 彙總，全部在 SQL 內完成（宣告欄位走運算式索引）
+    filters:   [{"field":"price","op":"gte","value":100}, ...]
+               op：eq / ne / lt / lte / gt / gte / contains / in / null / notnull
+    sort:      [{"field":"price","dir":"desc"}, ...]，也可用 id / created_at / updated_at
+    aggregate: [{"fn":"sum","field":"price"}, {"fn":"count"}]，可搭配 group_by 欄位
+    回傳 {"records":[...]} 或 {"groups":[...]}；欄位 / 參數錯誤丟 ValueError
+    """
+    table = get_custom_table(table_name)
+    if not table:
+        raise ValueError(f"找不到資料表 {table_name}")
+    fields = {f.get("name"): f for f in table["fields"]}
+
+    def col(name):
+        if name in BUILTIN_COLUMNS:
+            return name
+        f = fields.get(name)
+        if not f or "\0" in str(name):
+            raise ValueError(f"未知欄位：{name}")
+        return _field_expr(f)
+
+    def coerce(name, v):
+        if fields.get(name, {}).get("type") == "number" and v is not None:
+            try:
+                return float(v)
+            except (TypeError, ValueError):
+                raise ValueError(f"欄位 {name} 需要數字：{v!r}")
+        return v
+
+    where, params = ["table_name=?"], [table_name]
+    for flt in filters or []:
+        name, op, val = flt.get("field"), flt.get("op", "eq"), flt.get("value")
+        expr = col(name)
+        if op in FILTER_OPS:
+            where.append(f"{expr} {FILTER_OPS[op]} ?"); params.append(coerce(name, val))
+        elif op == "contains":
+            where.append(f"{expr} LIKE ? ESCAPE '\\'"); params.append(f"%{_like_escape(str(val))}%")
+        elif op == "in":
+            vals = [coerce(name, v) for v in (val if isinstance(val, list) else [val])]
+            if not vals:
+                where.append("0")
+            else:
+                where.append(f"{expr} IN ({','.join('?' * len(vals))})"); params += vals
+        elif op == "null":
+            where.append(f"{expr} IS NULL")
+        elif op == "notnull":
+            where.append(f"{expr} IS NOT NULL")
+        else:
+            raise ValueError(f"不支援的運算子：{op}")
+    where_sql = " AND ".join(where)
+
+    order = []
+    for s in ([{"field": sort}] if isinstance(sort, str) else sort or []):
+        direction = "DESC" if str(s.get("dir", "asc")).lower() == "desc" else "ASC"
+        order.append(f"{col(s.get('field'))} {direction}")
+    limit = max(1, min(int(limit), MAX_QUERY_LIMIT))
+    offset = max(0, int(offset))
+
+    if aggregate or group_by:
+        select, aliases = [], []
+        if group_by:
+            select.append(f"{col(group_by)} AS grp")
+        for agg in aggregate or [{"fn": "count"}]:
+            fn = str(agg.get("fn", "count")).lower()
+            if fn not in AGG_FNS:
+                raise ValueError(f"不支援的彙總函數：{fn}")
+            field = agg.get("field")
+            arg = col(field) if field else "*"
+            if arg == "*" and fn != "count":
+                raise ValueError(f"{fn} 需要指定欄位")
+            alias = f"{fn}_{field}" if field else fn
+            aliases.append(alias)
+            select.append(f"{fn.upper()}({arg})")
+        q = f"SELECT {', '.join(select)} FROM custom_records WHERE {where_sql}"
+        if group_by:
+            q += f" GROUP BY grp ORDER BY {', '.join(order) if order else 'grp'}"
+        q += " LIMIT ? OFFSET ?"
+        with connection() as conn:
+            rows = conn.execute(q, params + [limit, offset]).fetchall()
+        groups = []
+        for r in rows:
+            vals = list(r)
+            g = {}
+            if group_by:
+                g[group_by] = vals.pop(0)
+            g.update(zip(aliases, vals))
+            groups.append(g)
+        return {"groups": groups}
+
+    order.append("id DESC")
+    q = f"SELECT * FROM custom_records WHERE {where_sql} ORDER BY {', '.join(order)} LIMIT ? OFFSET ?"
+    with connection() as conn:
+        rows = conn.execute(q, params + [limit, offset]).fetchall()
+    records = []
+    for r in rows:
+        d = dict(r)
+        d["data"] = json.loads(d.get("data") or "{}")
+        records.append(d)
+    return {"records": records}
+
 def update_record(record_id, data):
-    conn = get_conn()
-    conn.execute(
-        "UPDATE custom_records SET data=?, updated_at=datetime('now','localtime') WHERE id=?",
-        (json.dumps(data, ensure_ascii=False), record_id)
-    )
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE custom_records SET data=?, updated_at=datetime('now','localtime') WHERE id=?",
+            (json.dumps(data, ensure_ascii=False), record_id)
+        )
 
 def delete_record(record_id):
-    conn = get_conn()
-    conn.execute("DELETE FROM custom_records WHERE id=?", (record_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("DELETE FROM custom_records WHERE id=?", (record_id,))
 
 def get_db_stats():
-    conn = get_conn()
-    stats = {
-        "chat_messages": conn.execute("SELECT COUNT(*) FROM chat_history").fetchone()[0],
-        "tasks_total":   conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0],
-        "tasks_todo":    conn.execute("SELECT COUNT(*) FROM tasks WHERE status='todo'").fetchone()[0],
-        "events_total":  conn.execute("SELECT COUNT(*) FROM events").fetchone()[0],
-        "custom_tables": conn.execute("SELECT COUNT(*) FROM custom_tables").fetchone()[0],
-        "custom_records":conn.execute("SELECT COUNT(*) FROM custom_records").fetchone()[0],
-    }
-    conn.close()
+    _sync_writes()
+    with connection() as conn:
+        stats = {
+            "chat_messages": conn.execute("SELECT COUNT(*) FROM chat_history").fetchone()[0],
+            "tasks_total":   conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0],
+            "tasks_todo":    conn.execute("SELECT COUNT(*) FROM tasks WHERE status='todo'").fetchone()[0],
+            "events_total":  conn.execute("SELECT COUNT(*) FROM events").fetchone()[0],
+            "custom_tables": conn.execute("SELECT COUNT(*) FROM custom_tables").fetchone()[0],
+            "custom_records":conn.execute("SELECT COUNT(*) FROM custom_records").fetchone()[0],
+        }
     return stats
 
 # 初始化
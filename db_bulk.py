@@ -0,0 +1,223 @@
+"""
+db_bulk.py — 大量匯入 / 匯出（NDJSON / CSV 串流）
+涵蓋：自訂資料表記錄、任務、聊天記錄
+- 匯入：邊讀邊解析，每 BATCH_ROWS 筆 executemany + 一次 commit，逐批回報進度
+- 匯出：以 id 游標分批讀取（每批借還一次連線），整表不會載入記憶體
+"""
+import io
+import csv
+import json
+from database import transaction, connection, get_custom_table
+
+BATCH_ROWS   = 2000
+EXPORT_BATCH = 1000
+MAX_ERRORS   = 20     # 回報給前端的錯誤範例數
+FORMATS      = ("ndjson", "csv")
+
+# ══════════════════════════════════════
+# 解析
+# ══════════════════════════════════════
+def iter_input(stream, fmt):
+    """binary stream → (行號, dict)；該行解析失敗時第二項為 ValueError"""
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", errors="replace", newline="")
+    if fmt == "csv":
+        for n, row in enumerate(csv.DictReader(text), start=2):
+            yield n, row
+        return
+    for n, line in enumerate(text, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            obj = json.loads(line)
+        except ValueError as e:
+            yield n, ValueError(f"JSON 格式錯誤：{e}")
+            continue
+        if not isinstance(obj, dict):
+            yield n, ValueError("每一行必須是 JSON 物件")
+            continue
+        yield n, obj
+
+def _num(v):
+    """CSV 的數字欄位字串 → int / float；空字串或非數字原樣保留"""
+    if not isinstance(v, str) or not v.strip():
+        return v
+    try:
+        return int(v)
+    except ValueError:
+        try:
+            return float(v)
+        except ValueError:
+            return v
+
+def _json_list(v):
+    if isinstance(v, list):
+        return v
+    if not v:
+        return []
+    v = str(v).strip()
+    if v.startswith("["):
+        return json.loads(v)
+    return [t.strip() for t in v.split(",") if t.strip()]
+
+# ══════════════════════════════════════
+# 各資料種類的欄位對應
+# ══════════════════════════════════════
+class _Spec:
+    insert_sql   = ""
+    select_sql   = ""
+    select_params = ()
+    csv_columns  = []
+
+    def to_row(self, obj):
+        raise NotImplementedError
+
+    def to_export(self, row):
+        return dict(row)
+
+    def before_batch(self, conn, batch):
+        pass
+
+class RecordsSpec(_Spec):
+    insert_sql = "INSERT INTO custom_records (table_name, data) VALUES (?, ?)"
+    select_sql = "SELECT * FROM custom_records WHERE table_name=?"
+
+    def __init__(self, table_name):
+        table = get_custom_table(table_name) or {"fields": []}
+        self.table_name    = table_name
+        self.select_params = (table_name,)
+        self.numbers = {f.get("name") for f in table["fields"] if f.get("type") == "number"}
+        self.csv_columns = ["id"] + [f.get("name") for f in table["fields"]] + ["created_at", "updated_at"]
+
+    def to_row(self, obj):
+        # 接受匯出格式 {"id":..,"data":{..}} 或直接是資料本身（CSV 每欄即欄位）
+        data = obj["data"] if isinstance(obj.get("data"), dict) else {
+            k: v for k, v in obj.items() if k not in ("id", "created_at", "updated_at")}
+        data = {k: (_num(v) if k in self.numbers else v) for k, v in data.items() if k}
+        return (self.table_name, json.dumps(data, ensure_ascii=False))
+
+    def to_export(self, row):
+        d = dict(row)
+        d["data"] = json.loads(d.get("data") or "{}")
+        return d
+
+    def to_csv(self, d):
+        flat = {**d["data"], "id": d["id"], "created_at": d["created_at"], "updated_at": d["updated_at"]}
+        return [flat.get(c, "") for c in self.csv_columns]
+
+class TasksSpec(_Spec):
+    insert_sql = """INSERT INTO tasks (title, description, status, priority, assigned_to, due_date, tags)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)"""
+    select_sql = "SELECT * FROM tasks WHERE 1=1"
+    csv_columns = ["id", "title", "description", "status", "priority", "assigned_to",
+                   "due_date", "tags", "created_at", "updated_at"]
+
+    def to_row(self, obj):
+        title = str(obj.get("title") or "").strip()
+        if not title:
+            raise ValueError("title 不能空白")
+        return (title, obj.get("description") or "", obj.get("status") or "todo",
+                obj.get("priority") or "medium", obj.get("assigned_to") or None,
+                obj.get("due_date") or None, json.dumps(_json_list(obj.get("tags"))))
+
+    def to_export(self, row):
+        d = dict(row)
+        d["tags"] = json.loads(d.get("tags") or "[]")
+        return d
+
+    def to_csv(self, d):
+        return [json.dumps(d[c], ensure_ascii=False) if c == "tags" else d.get(c, "")
+                for c in self.csv_columns]
+
+class ChatSpec(_Spec):
+    insert_sql = """INSERT INTO chat_history (session_id, role, content, character_id, model_id, created_at)
+                    VALUES (?, ?, ?, ?, ?, COALESCE(?, datetime('now','localtime')))"""
+    csv_columns = ["id", "session_id", "role", "content", "character_id", "model_id", "created_at"]
+
+    def __init__(self, session_id=None):
+        if session_id:
+            self.select_sql, self.select_params = "SELECT * FROM chat_history WHERE session_id=?", (session_id,)
+        else:
+            self.select_sql = "SELECT * FROM chat_history WHERE 1=1"
+
+    def to_row(self, obj):
+        role, content = obj.get("role"), obj.get("content")
+        if not role or content is None:
+            raise ValueError("role / content 必填")
+        return (obj.get("session_id") or "default", role, content,
+                obj.get("character_id") or None, obj.get("model_id") or None,
+                obj.get("created_at") or None)
+
+    def before_batch(self, conn, batch):
+        # 先建 session，訊息 trigger 才會累加 msg_count / last_at
+        conn.executemany(
+            "INSERT OR IGNORE INTO chat_sessions (session_id) VALUES (?)",
+            [(sid,) for sid in {row[0] for row in batch}]
+        )
+
+    def to_csv(self, d):
+        return [d.get(c, "") for c in self.csv_columns]
+
+# ══════════════════════════════════════
+# 匯入 / 匯出
+# ══════════════════════════════════════
+def _insert_batch(spec, batch):
+    with transaction() as conn:
+        spec.before_batch(conn, batch)
+        conn.executemany(spec.insert_sql, batch)
+
+def import_stream(spec, rows):
+    """
+    rows：iter_input() 的輸出
+    產生進度 dict：{"type":"progress",...}，最後一筆 {"type":"done",...}
+    """
+    batch, imported, errors, samples = [], 0, 0, []
+    for n, obj in rows:
+        try:
+            if isinstance(obj, Exception):
+                raise obj
+            if not isinstance(obj, dict):
+                raise ValueError("每一行必須是 JSON 物件")
+            batch.append(spec.to_row(obj))
+        except (ValueError, TypeError, KeyError) as e:
+            errors += 1
+            if len(samples) < MAX_ERRORS:
+                samples.append({"line": n, "error": str(e)[:200]})
+            continue
+        if len(batch) >= BATCH_ROWS:
+            _insert_batch(spec, batch)
+            imported += len(batch)
+            batch = []
+            yield {"type": "progress", "imported": imported, "errors": errors, "line": n}
+    if batch:
+        _insert_batch(spec, batch)
+        imported += len(batch)
+    yield {"type": "done", "imported": imported, "errors": errors, "error_samples": samples}
+
+def export_stream(spec, fmt):
+    """以 id 游標分批讀取，逐行輸出 NDJSON 或 CSV 字串"""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    if fmt == "csv":
+        writer.writerow(spec.csv_columns)
+    last_id = 0
+    while True:
+        with connection() as conn:
+            rows = conn.execute(
+                spec.select_sql + " AND id>? ORDER BY id LIMIT ?",
+                list(spec.select_params) + [last_id, EXPORT_BATCH]
+            ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1]["id"]
+        for r in rows:
+            d = spec.to_export(r)
+            if fmt == "csv":
+                writer.writerow(spec.to_csv(d))
+            else:
+                buf.write(json.dumps(d, ensure_ascii=False) + "\n")
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
@@ -0,0 +1,209 @@
+"""
+db_pool.py — SQLite 連線池
+database.py / kb_manager.py 共用：
+- 每條連線只在建立時設定一次 PRAGMA（WAL、busy_timeout、synchronous…）
+- 同一執行緒重入時共用同一條連線（helper 互相呼叫不會卡死）
+- connection() 借連線、transaction() 自動 commit / rollback
+- stats() 回傳開啟數量與等待時間，給 /ai/db/pool 顯示
+"""
+import os
+import time
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+DB_PATH = os.path.join(os.path.dirname(__file__), "data", "chatroom.db")
+
+POOL_SIZE       = int(os.environ.get("DB_POOL_SIZE", 8))
+ACQUIRE_TIMEOUT = 30       # 秒，池滿時最多等多久
+BUSY_TIMEOUT_MS = 5000     # SQLite 寫鎖等待
+
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA foreign_keys=ON",
+    f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}",
+    "PRAGMA cache_size=-16000",      # 約 16MB page cache
+    "PRAGMA mmap_size=134217728",    # 128MB
+    "PRAGMA temp_store=MEMORY",
+]
+
+class ConnectionPool:
+    def __init__(self, path, size=POOL_SIZE):
+        self.path   = path
+        self.size   = max(1, size)
+        self._idle  = queue.LifoQueue()   # 後進先出：熱連線優先重用
+        self._lock  = threading.Lock()
+        self._local = threading.local()
+        self._opened = 0
+        self._stats = {
+            "acquires":      0,   # 從池中借出次數
+            "reentrant":     0,   # 同執行緒重入（不佔新連線）
+            "created":       0,
+            "waits":         0,   # 池滿需要等待的次數
+            "wait_ms_total": 0.0,
+            "wait_ms_max":   0.0,
+            "timeouts":      0,
+        }
+
+    # ── 建立連線 ──
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_MS / 1000,
+                               check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for p in PRAGMAS:
+            conn.execute(p)
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._opened -= 1
+
+    # ── 借 / 還 ──
+    def _acquire(self):
+        held = getattr(self._local, "conn", None)
+        if held is not None:
+            self._local.depth += 1
+            with self._lock:
+                self._stats["reentrant"] += 1
+            return held
+
+        t0 = time.perf_counter()
+        waited = False
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._opened < self.size
+                if create:
+                    self._opened += 1
+            if create:
+                try:
+                    conn = self._open()
+                except Exception:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+                with self._lock:
+                    self._stats["created"] += 1
+            else:
+                waited = True
+                try:
+                    conn = self._idle.get(timeout=ACQUIRE_TIMEOUT)
+                except queue.Empty:
+                    with self._lock:
+                        self._stats["timeouts"] += 1
+                    raise sqlite3.OperationalError(
+                        f"連線池已滿（{self.size} 條），等待 {ACQUIRE_TIMEOUT}s 仍無空閒連線")
+
+        wait_ms = (time.perf_counter() - t0) * 1000
+        with self._lock:
+            s = self._stats
+            s["acquires"] += 1
+            if waited:
+                s["waits"] += 1
+            s["wait_ms_total"] += wait_ms
+            s["wait_ms_max"] = max(s["wait_ms_max"], wait_ms)
+
+        self._local.conn  = conn
+        self._local.depth = 1
+        self._local.tx_depth = 0
+        return conn
+
+    def _release(self, conn):
+        self._local.depth -= 1
+        if self._local.depth > 0:
+            return
+        self._local.conn = None
+        try:
+            if conn.in_transaction:
+                conn.rollback()   # 呼叫端沒 commit 的寫入不留給下一個人
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """借一條連線；離開時歸還（未 commit 的變更會被 rollback）"""
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    @contextmanager
+    def transaction(self):
+        """
+        寫入用：最外層正常結束 commit、例外 rollback
+        巢狀呼叫只有最外層會 commit
+        """
+        conn = self._acquire()
+        self._local.tx_depth += 1
+        outer = self._local.tx_depth == 1
+        try:
+            yield conn
+            if outer:
+                conn.commit()
+        except BaseException:
+            if outer:
+                conn.rollback()
+            raise
+        finally:
+            self._local.tx_depth -= 1
+            self._release(conn)
+
+    # ── 監控 / 關閉 ──
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            opened = self._opened
+        idle = self._idle.qsize()
+        s["wait_ms_total"] = round(s["wait_ms_total"], 2)
+        s["wait_ms_max"]   = round(s["wait_ms_max"], 2)
+        s["wait_ms_avg"]   = round(s["wait_ms_total"] / s["acquires"], 3) if s["acquires"] else 0.0
+        s.update({
+            "path":   self.path,
+            "size":   self.size,
+            "open":   opened,
+            "idle":   idle,
+            "in_use": opened - idle,
+        })
+        return s
+
+    def close_all(self):
+        """關閉所有閒置連線（借出中的連線歸還時仍會放回池中）"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+# ── 依檔案路徑共用同一個池 ──
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(path=DB_PATH):
+    key = os.path.abspath(path)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = ConnectionPool(key)
+    return pool
+
+def pool_stats():
+    """所有連線池的統計"""
+    return [p.stats() for p in list(_pools.values())]
+
+def close_all():
+    for p in list(_pools.values()):
+        p.close_all()
@@ -0,0 +1,225 @@
+"""
+db_writer.py — 寫入合併（write-behind / group commit）
+開啟方式：環境變數 DB_WRITE_BEHIND=1（預設關閉，行為與同步寫入相同）
+- 請求執行緒只把 (sql, params) 丟進有上限的佇列
+- 專用 writer 執行緒每 N ms 或累積 M 筆就在同一個 transaction 裡 commit
+- 行程結束時（atexit）會把佇列寫完再離開
+- flush() 同步等待目前佇列全部落地（測試 / 讀取前使用）
+"""
+import os
+import time
+import queue
+import atexit
+import sqlite3
+import threading
+from concurrent.futures import Future
+from db_pool import get_pool
+
+ENABLED        = os.environ.get("DB_WRITE_BEHIND", "0") == "1"
+FLUSH_MS       = int(os.environ.get("DB_WRITE_BEHIND_MS", 50))
+BATCH_ROWS     = int(os.environ.get("DB_WRITE_BEHIND_ROWS", 200))
+QUEUE_SIZE     = int(os.environ.get("DB_WRITE_BEHIND_QUEUE", 10000))
+ENQUEUE_TIMEOUT = 5   # 秒，佇列滿時最多等多久，超過就改成同步寫入
+
+_BARRIER = object()
+_STOP    = object()
+
+class WriteBehindWriter:
+    def __init__(self, path, flush_ms=FLUSH_MS, batch_rows=BATCH_ROWS, queue_size=QUEUE_SIZE):
+        self.path       = path
+        self.flush_ms   = flush_ms
+        self.batch_rows = max(1, batch_rows)
+        self._q         = queue.Queue(maxsize=queue_size)
+        self._lock      = threading.Lock()
+        self._put_lock  = threading.Lock()   # _stopped 檢查與排入佇列要一起做，避免排在 _STOP 之後
+        self._stopped   = False
+        self._inflight  = 0                  # 已排入、尚未 commit 的筆數（writer 已取出但還在等湊批的也算）
+        self._stats = {
+            "enqueued":       0,
+            "written":        0,
+            "batches":        0,
+            "batch_max":      0,
+            "batch_last":     0,
+            "commit_ms_total": 0.0,
+            "queue_max":      0,
+            "errors":         0,
+            "sync_fallbacks": 0,   # 佇列滿 / 已停止 → 改走同步寫入
+        }
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+
+    # ── 請求端 ──
+    def submit(self, sql, params=()):
+        """排入佇列，回傳 Future（result() 為 lastrowid）"""
+        fut = Future()
+        with self._put_lock:
+            if self._stopped:
+                return self._write_now(sql, params, fut)
+            with self._lock:
+                self._inflight += 1
+            try:
+                self._q.put((sql, params, fut), timeout=ENQUEUE_TIMEOUT)
+            except queue.Full:
+                with self._lock:
+                    self._inflight -= 1
+                return self._write_now(sql, params, fut)
+        with self._lock:
+            self._stats["enqueued"] += 1
+            self._stats["queue_max"] = max(self._stats["queue_max"], self._q.qsize())
+        return fut
+
+    def _write_now(self, sql, params, fut):
+        with self._lock:
+            self._stats["sync_fallbacks"] += 1
+        try:
+            with get_pool(self.path).transaction() as conn:
+                fut.set_result(conn.execute(sql, params).lastrowid)
+        except Exception as e:
+            fut.set_exception(e)
+        return fut
+
+    def pending(self):
+        with self._lock:
+            return self._inflight
+
+    def flush(self, timeout=None):
+        """等到目前已排入的寫入全部 commit；回傳是否在 timeout 內完成"""
+        fut = Future()
+        with self._put_lock:
+            # 與 stop() 互斥：barrier 不會排在 _STOP 之後（writer 已經不會再取它）
+            if self._stopped or not self._thread.is_alive():
+                return True
+            self._q.put((_BARRIER, None, fut))
+        try:
+            fut.result(timeout=timeout)
+            return True
+        except Exception:
+            return False
+
+    def stop(self, timeout=10):
+        """寫完佇列後停止 writer 執行緒（atexit 會呼叫）"""
+        with self._put_lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._q.put((_STOP, None, None))
+        self._thread.join(timeout)
+
+    # ── writer 執行緒 ──
+    def _run(self):
+        while True:
+            item = self._q.get()
+            batch, barriers, stop = [], [], False
+            deadline = time.monotonic() + self.flush_ms / 1000
+            while True:
+                sql, params, fut = item
+                if sql is _STOP:
+                    stop = True
+                elif sql is _BARRIER:
+                    barriers.append(fut)
+                else:
+                    batch.append(item)
+                if stop or barriers or len(batch) >= self.batch_rows:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._q.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if stop:
+                batch.extend(self._drain())
+            if batch:
+                self._commit(batch)
+            for fut in barriers:
+                fut.set_result(True)
+            if stop:
+                return
+
+    def _drain(self):
+        items = []
+        while True:
+            try:
+                sql, params, fut = self._q.get_nowait()
+            except queue.Empty:
+                return items
+            if sql is _BARRIER:
+                fut.set_result(True)
+            elif sql is not _STOP:
+                items.append((sql, params, fut))
+
+    def _commit(self, batch):
+        t0 = time.perf_counter()
+        pool = get_pool(self.path)
+        results = []
+        try:
+            with pool.transaction() as conn:
+                for sql, params, fut in batch:
+                    results.append(conn.execute(sql, params).lastrowid)
+        except sqlite3.Error:
+            # 整批失敗 → 逐筆重試，只讓出錯的那筆回報例外
+            results = None
+        if results is not None:
+            for (_, _, fut), rowid in zip(batch, results):
+                fut.set_result(rowid)
+        else:
+            for sql, params, fut in batch:
+                try:
+                    with pool.transaction() as conn:
+                        fut.set_result(conn.execute(sql, params).lastrowid)
+                except Exception as e:
+                    with self._lock:
+                        self._stats["errors"] += 1
+                    fut.set_exception(e)
+        ms = (time.perf_counter() - t0) * 1000
+        with self._lock:
+            s = self._stats
+            self._inflight -= len(batch)
+            s["written"] += len(batch)
+            s["batches"] += 1
+            s["batch_last"] = len(batch)
+            s["batch_max"]  = max(s["batch_max"], len(batch))
+            s["commit_ms_total"] += ms
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+        s["queue_depth"]   = self._q.qsize()
+        s["inflight"]      = self.pending()
+        s["batch_avg"]     = round(s["written"] / s["batches"], 2) if s["batches"] else 0.0
+        s["commit_ms_avg"] = round(s["commit_ms_total"] / s["batches"], 3) if s["batches"] else 0.0
+        s["commit_ms_total"] = round(s["commit_ms_total"], 2)
+        s.update({"enabled": True, "flush_ms": self.flush_ms, "batch_rows": self.batch_rows,
+                  "running": self._thread.is_alive()})
+        return s
+
+# ── 依 DB 路徑共用單一 writer ──
+_writers = {}
+_writers_lock = threading.Lock()
+
+def get_writer(path):
+    """DB_WRITE_BEHIND 未開啟時回傳 None（呼叫端走同步寫入）"""
+    if not ENABLED:
+        return None
+    key = os.path.abspath(path)
+    w = _writers.get(key)
+    if w is None:
+        with _writers_lock:
+            w = _writers.get(key)
+            if w is None:
+                w = _writers[key] = WriteBehindWriter(key)
+    return w
+
+def flush_all(timeout=None):
+    return all(w.flush(timeout) for w in list(_writers.values()))
+
+def writer_stats():
+    if not ENABLED:
+        return {"enabled": False}
+    return {path: w.stats() for path, w in _writers.items()}
+
+@atexit.register
+def _shutdown():
+    for w in list(_writers.values()):
+        w.stop()
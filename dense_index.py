@@ -0,0 +1,174 @@
+"""
+dense_index.py — 本機 hashed embedding 向量檢索（NumPy，選配，不需要網路 / GPU）
+- 特徵：中文取字元 1~3-gram、英文取單字與相鄰雙字，feature hashing 投影到 DIM 維（帶正負號）
+- 向量 float32 存成 .npy，np.load(mmap_mode='r') 載入；與 sparse_index 共用版本快取（get_index）
+- 近似最近鄰：多組隨機超平面 LSH（每組 LSH_BITS 位元），查詢時多探測漢明距離 1 的桶，
+  候選再用精確內積重排；資料量小於 BRUTE_FORCE_ROWS 時直接全掃
+- 混合模式：fuse() 把向量分數與 BM25 / TF-IDF 分數各自除以最高分後加權相加
+"""
+import os
+import re
+import json
+import math
+import zlib
+import shutil
+from collections import Counter
+
+try:
+    import numpy as np
+    AVAILABLE = True
+except ImportError:
+    np = None
+    AVAILABLE = False
+
+DIM              = 512
+LSH_TABLES       = 8
+LSH_BITS         = 10
+LSH_SEED         = 20240601
+BRUTE_FORCE_ROWS = 4096
+MODES            = ("keyword", "dense", "hybrid")
+DEFAULT_MODE     = os.environ.get("RETRIEVER", "keyword")
+HYBRID_ALPHA     = float(os.environ.get("RETRIEVER_HYBRID_ALPHA", 0.5))   # 向量分數的權重
+
+_CJK  = re.compile(r'[\u4e00-\u9fff]+')
+_WORD = re.compile(r'[a-z0-9]+')
+
+def resolve_mode(mode=None):
+    """未指定 / 不認得的模式用預設值；沒有 NumPy 時一律退回 keyword"""
+    mode = mode if mode in MODES else DEFAULT_MODE
+    return mode if AVAILABLE else "keyword"
+
+# ══════════════════════════════════════
+# 特徵與向量
+# ══════════════════════════════════════
+def features(text):
+    text = text.lower()
+    feats = Counter()
+    for run in _CJK.findall(text):
+        for n, w in ((1, 0.5), (2, 1.0), (3, 1.0)):
+            for i in range(len(run) - n + 1):
+                feats["c" + run[i:i + n]] += w
+    words = _WORD.findall(text)
+    for i, w in enumerate(words):
+        feats["w" + w] += 1.0
+        if i:
+            feats["b" + words[i - 1] + " " + w] += 1.0
+    return feats
+
+def embed(text, dim=DIM):
+    """feature hashing → L2 正規化的 float32 向量（詞頻取 log(1+n) 壓縮）"""
+    vec = np.zeros(dim, dtype=np.float32)
+    for f, n in features(text).items():
+        h = zlib.crc32(f.encode("utf-8"))
+        vec[(h >> 1) % dim] += math.log1p(n) if h & 1 else -math.log1p(n)
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+def _planes(dim=DIM):
+    rng = np.random.default_rng(LSH_SEED)
+    return rng.standard_normal((LSH_TABLES, LSH_BITS, dim)).astype(np.float32)
+
+def _codes(planes, vecs):
+    """vecs (n, dim) → 每組 LSH 的桶號 (tables, n)"""
+    bits = (np.einsum("tbd,nd->tnb", planes, vecs) > 0).astype(np.int64)
+    return (bits << np.arange(LSH_BITS)).sum(axis=2)
+
+# ══════════════════════════════════════
+# 索引
+# ══════════════════════════════════════
+class DenseIndex:
+    def __init__(self, vecs, codes, order, rows, extra=None, meta=None):
+        self.vecs  = vecs          # (n, DIM) float32
+        self.codes = codes         # (tables, n) 各列的桶號
+        self.order = order         # (tables, n) 依桶號排序後的列序
+        self.rows  = rows
+        self.extra = extra or {}
+        self.meta  = meta or {}
+        self._planes = _planes(vecs.shape[1]) if len(rows) else None
+        self._sorted = np.take_along_axis(np.asarray(codes), np.asarray(order), axis=1) if len(rows) else None
+
+    @classmethod
+    def build(cls, rows, texts, extra=None, meta=None):
+        vecs = np.stack([embed(t) for t in texts]) if texts else np.zeros((0, DIM), dtype=np.float32)
+        if len(rows):
+            codes = _codes(_planes(), vecs)
+            order = np.argsort(codes, axis=1, kind="stable")
+        else:
+            codes = order = np.zeros((LSH_TABLES, 0), dtype=np.int64)
+        extra = {k: np.asarray(v) for k, v in (extra or {}).items()}
+        return cls(vecs, codes, order, list(rows), extra, meta)
+
+    def save(self, path):
+        tmp = f"{path}.tmp{os.getpid()}"
+        os.makedirs(tmp, exist_ok=True)
+        for name, arr in [("vecs", self.vecs), ("codes", self.codes), ("order", self.order)] + \
+                         [(f"x_{k}", v) for k, v in self.extra.items()]:
+            np.save(os.path.join(tmp, f"{name}.npy"), arr)
+        with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"rows": self.rows, "extra": list(self.extra), "meta": self.meta}, f, ensure_ascii=False)
+        try:
+            os.replace(tmp, path)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            m = json.load(f)
+        arr = lambda name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+        return cls(arr("vecs"), arr("codes"), arr("order"), m["rows"],
+                   {k: arr(f"x_{k}") for k in m["extra"]}, m["meta"])
+
+    def stats(self):
+        return {"version": self.meta.get("version"), "rows": len(self.rows), "dim": int(self.vecs.shape[1])}
+
+    def _candidates(self, q):
+        """LSH 多探測：每組查自己的桶 + 漢明距離 1 的桶"""
+        code = _codes(self._planes, q[None, :])[:, 0]
+        found = []
+        for t in range(LSH_TABLES):
+            probes = [code[t]] + [code[t] ^ (1 << b) for b in range(LSH_BITS)]
+            for c in probes:
+                lo, hi = np.searchsorted(self._sorted[t], [c, c + 1])
+                if hi > lo:
+                    found.append(np.asarray(self.order[t][lo:hi]))
+        return np.unique(np.concatenate(found)) if found else np.zeros(0, dtype=np.int64)
+
+    def search(self, text, k, mask=None):
+        """[(列序, cosine 分數)]，分數 > 0、高到低"""
+        if not len(self.rows):
+            return []
+        q = embed(text, self.vecs.shape[1])
+        if not q.any():
+            return []
+        if len(self.rows) <= BRUTE_FORCE_ROWS:
+            cand = np.arange(len(self.rows))
+        else:
+            cand = self._candidates(q)
+        if mask is not None:
+            mask = np.asarray(mask)
+            cand = cand[mask[cand]]
+            if len(cand) < k:
+                cand = np.nonzero(mask)[0]     # 限定範圍很小時，LSH 候選不夠就直接掃範圍內全部
+        if not len(cand):
+            return []
+        scores = np.asarray(self.vecs[cand]) @ q
+        k = min(k, len(cand))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.lexsort((cand[top], -scores[top]))]
+        return [(int(cand[i]), float(scores[i])) for i in top if scores[i] > 0]
+
+# ══════════════════════════════════════
+# 混合排序
+# ══════════════════════════════════════
+def fuse(keyword, dense, alpha=None):
+    """
+    keyword / dense：{key: 分數}；各自除以最高分後加權相加
+    回傳 [(key, 分數)]，高到低
+    """
+    alpha = HYBRID_ALPHA if alpha is None else alpha
+    km = max(keyword.values(), default=0) or 1
+    dm = max(dense.values(), default=0) or 1
+    keys = set(keyword) | set(dense)
+    fused = {k: (1 - alpha) * keyword.get(k, 0) / km + alpha * dense.get(k, 0) / dm for k in keys}
+    return sorted(fused.items(), key=lambda x: (-x[1], str(x[0])))
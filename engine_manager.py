@@ -3,9 +3,22 @@ engine_manager.py — 統一 AI 引擎管理層
 支援：Groq / OpenRouter / Ollama / Anthropic / Colab
 自動 fallback：Ollama → Colab → OpenRouter → Groq → 排隊
 """
-import os, json, time, requests, threading
+import os, json, time, queue, threading
+import requests
+import http_client
+from engine_router import Router
+from concurrent.futures import ThreadPoolExecutor
 from typing import Generator, Optional
 
+HEALTH_TTL    = float(os.environ.get("ENGINE_HEALTH_TTL", 30))   # 背景探測間隔（秒）
+PROBE_TIMEOUT = float(os.environ.get("ENGINE_PROBE_TIMEOUT", 3))
+HEDGE_DEFAULT = float(os.environ.get("HEDGE_DEFAULT", 2.0))   # 沒有 TTFT 樣本時的對沖等待（秒）
+HEDGE_MIN     = float(os.environ.get("HEDGE_MIN", 0.3))
+HEDGE_MAX     = float(os.environ.get("HEDGE_MAX", 8.0))
+CATALOG_TTL   = float(os.environ.get("ENGINE_CATALOG_TTL", 600))  # 模型清單快取時間（秒）
+CATALOG_RETRY = float(os.environ.get("ENGINE_CATALOG_RETRY", 60))  # 抓取失敗後多久再試
+CATALOG_FILE  = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "engine_catalog.json")
+
 # ══════════════════════════════════════════════════════════════
 # Config 讀取
 # ══════════════════════════════════════════════════════════════
@@ -39,6 +52,16 @@ class EngineStatus:
                 "last_check": time.time(),
             }
 
+    def mark(self, engine_id, ok, error=""):
+        """實際請求的結果（成功 / 失敗）直接寫入，保留上次探測的延遲"""
+        with self._lock:
+            cur = self._data.get(engine_id, {})
+            self._data[engine_id] = {
+                "ok": ok, "error": error,
+                "latency_ms": cur.get("latency_ms", 0),
+                "last_check": time.time(),
+            }
+
     def get(self, engine_id):
         with self._lock:
             return self._data.get(engine_id, {"ok": None, "error": "", "latency_ms": 0, "last_check": 0})
@@ -49,6 +72,128 @@ class EngineStatus:
 
 _status = EngineStatus()
 
+# ══════════════════════════════════════════════════════════════
+# 模型清單快取（記憶體 + data/engine_catalog.json）
+# ══════════════════════════════════════════════════════════════
+class ModelCatalog:
+    """
+    各引擎的模型清單：有效期內直接回傳；過期先回傳舊清單、背景重新抓（帶 ETag / Last-Modified 條件請求，
+    304 只延長有效期）；冷啟動讀磁碟上最後一次的清單，完全沒有時才同步抓一次
+    """
+    def __init__(self, path=CATALOG_FILE, ttl=CATALOG_TTL):
+        self.path   = path
+        self.ttl    = ttl
+        self._lock  = threading.Lock()
+        self._data  = None       # engine_id → {url, models, etag, last_modified, fetched_at, checked_at, error}
+        self._busy  = set()      # 正在背景更新的 engine_id
+        self.stats  = {"hits": 0, "stale": 0, "fetches": 0, "not_modified": 0, "errors": 0}
+
+    def _load(self):
+        if self._data is None:
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    self._data = json.load(f)
+            except (OSError, ValueError):
+                self._data = {}
+        return self._data
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self._data, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+    def _entry(self, eng):
+        with self._lock:
+            e = self._load().get(eng.engine_id)
+        # 網址換了（例如改了 OLLAMA_URL）舊清單就不算數
+        return e if e and e.get("url") == eng.models_url() else None
+
+    def stale(self, eng):
+        e = self._entry(eng)
+        return e is None or time.time() - e.get("checked_at", 0) >= self.ttl
+
+    def get(self, eng) -> list:
+        e = self._entry(eng)
+        if e is None:
+            if eng.available():
+                self.refresh(eng)
+                e = self._entry(eng)
+            else:
+                self.refresh_async(eng)
+        elif time.time() - e.get("checked_at", 0) >= self.ttl:
+            self.stats["stale"] += 1
+            self.refresh_async(eng)
+        else:
+            self.stats["hits"] += 1
+        return (e or {}).get("models") or eng.default_models()
+
+    def peek(self, eng) -> list:
+        """只讀快取、不阻塞（路由用）：沒有或過期時背景更新，先回傳舊清單或預設清單"""
+        e = self._entry(eng)
+        if e is None or time.time() - e.get("checked_at", 0) >= self.ttl:
+            self.refresh_async(eng)
+        return (e or {}).get("models") or eng.default_models()
+
+    def refresh(self, eng):
+        """條件請求重新抓清單；失敗時保留舊清單，CATALOG_RETRY 秒後再試"""
+        url = eng.models_url()
+        if not url:
+            return
+        with self._lock:
+            old = dict(self._load().get(eng.engine_id) or {})
+        if old.get("url") != url:
+            old = {"url": url}
+        headers = dict(eng.models_headers())
+        if old.get("etag"):
+            headers["If-None-Match"] = old["etag"]
+        if old.get("last_modified"):
+            headers["If-Modified-Since"] = old["last_modified"]
+        now = time.time()
+        self.stats["fetches"] += 1
+        try:
+            r = http_client.get(url, headers=headers, timeout=PROBE_TIMEOUT * 2, retries=0)
+            if r.status_code == 304 and old.get("models"):
+                self.stats["not_modified"] += 1
+                old.update(checked_at=now, error="")
+            elif r.ok:
+                old.update(models=eng.parse_models(r.json()), fetched_at=now, checked_at=now, error="",
+                           etag=r.headers.get("ETag", ""), last_modified=r.headers.get("Last-Modified", ""))
+            else:
+                raise ValueError(f"HTTP {r.status_code}")
+        except Exception as e:
+            self.stats["errors"] += 1
+            old.update(checked_at=now - self.ttl + CATALOG_RETRY, error=str(e)[:120])
+        with self._lock:
+            self._load()[eng.engine_id] = old
+            self._save()
+
+    def refresh_async(self, eng):
+        with self._lock:
+            if eng.engine_id in self._busy:
+                return
+            self._busy.add(eng.engine_id)
+        def run():
+            try:
+                self.refresh(eng)
+            finally:
+                with self._lock:
+                    self._busy.discard(eng.engine_id)
+        threading.Thread(target=run, daemon=True).start()
+
+    def info(self, eng):
+        e = self._entry(eng)
+        if e is None:
+            return None
+        return {"count": len(e.get("models") or []), "age_s": int(time.time() - e.get("fetched_at", 0)),
+                "etag": bool(e.get("etag") or e.get("last_modified")), "error": e.get("error", "")}
+
+_catalog = ModelCatalog()
+
 # ══════════════════════════════════════════════════════════════
 # 引擎基底類別
 # ══════════════════════════════════════════════════════════════
@@ -56,12 +201,25 @@ class BaseEngine:
     engine_id   = "base"
     name        = "Base"
     requires_key = True
+    # 尚未探測過時是否視為可用：雲端服務有 key 就先當可用，本機 / 自架端點要探測成功才算
+    assume_up    = True
+    # 路由政策用：local = 資料不出本機 / 自架；paid = 按量計費
+    local        = False
+    paid         = False
+
+    def configured(self) -> bool:
+        """有沒有設定 key / 網址（不連網路）"""
+        raise NotImplementedError
 
     def available(self) -> bool:
-        raise NotImplementedError
+        """讀快取的健康狀態（O(1)，不連網路）；狀態由背景探測與實際請求結果更新"""
+        if not self.configured():
+            return False
+        ok = _status.get(self.engine_id)["ok"]
+        return self.assume_up if ok is None else ok
 
     def ping(self) -> bool:
-        """快速健康檢查，更新 _status"""
+        """快速健康檢查（連網路），更新 _status；由背景探測呼叫"""
         t0 = time.time()
         try:
             ok = self._ping()
@@ -72,7 +230,7 @@ class BaseEngine:
             return False
 
     def _ping(self) -> bool:
-        return self.available()
+        return self.configured()
 
     def stream(self, messages, model=None, **kw) -> Generator:
         """
@@ -84,9 +242,30 @@ class BaseEngine:
     def _stream(self, messages, model=None, **kw) -> Generator:
         raise NotImplementedError
 
-    def list_models(self) -> list:
+    # ── 模型清單（有 models_url 的引擎走 ModelCatalog 快取）──
+    def models_url(self) -> Optional[str]:
+        return None
+
+    def models_headers(self) -> dict:
+        return {}
+
+    def parse_models(self, data) -> list:
         return []
 
+    def default_models(self) -> list:
+        return []
+
+    def list_models(self) -> list:
+        if not self.models_url():
+            return self.default_models()
+        return _catalog.get(self)
+
+    def cached_models(self) -> list:
+        """聊天請求路徑上用（路由）：只看快取 / 預設清單，不會同步抓網路"""
+        if not self.models_url():
+            return self.list_models()
+        return _catalog.peek(self)
+
 # ══════════════════════════════════════════════════════════════
 # Groq 引擎
 # ══════════════════════════════════════════════════════════════
@@ -107,12 +286,12 @@ class GroqEngine(BaseEngine):
     def _key(self):
         return (_cfg("GROQ_API_KEY") or "").strip()
 
-    def available(self):
+    def configured(self):
         return bool(self._key())
 
     def _ping(self):
-        r = requests.get(f"{self.API_URL}/models",
-                         headers={"Authorization": f"Bearer {self._key()}"}, timeout=5)
+        r = http_client.get(f"{self.API_URL}/models",
+                         headers={"Authorization": f"Bearer {self._key()}"}, timeout=PROBE_TIMEOUT, retries=0)
         return r.status_code == 200
 
     def list_models(self):
@@ -120,11 +299,11 @@ class GroqEngine(BaseEngine):
 
     def _stream(self, messages, model=None, vision=False, **kw):
         model = model or ("meta-llama/llama-4-scout-17b-16e-instruct" if vision else "llama-3.3-70b-versatile")
-        r = requests.post(
+        r = http_client.post(
             f"{self.API_URL}/chat/completions",
             headers={"Authorization": f"Bearer {self._key()}", "Content-Type": "application/json"},
             json={"model": model, "messages": messages, "stream": True, "max_tokens": 2048},
-            stream=True, timeout=90,
+            stream=True, timeout=90, retries=0,
         )
         yield from _parse_openai_stream(r, engine=self.engine_id, model=model)
 
@@ -156,27 +335,28 @@ class OpenRouterEngine(BaseEngine):
     def _key(self):
         return (_cfg("OPENROUTER_API_KEY") or "").strip()
 
-    def available(self):
+    def configured(self):
         return bool(self._key())
 
     def _ping(self):
-        r = requests.get(f"{self.API_URL}/models",
-                         headers={"Authorization": f"Bearer {self._key()}"}, timeout=8)
+        # /key 只回傳這把 key 的額度資訊，很小；模型清單由 ModelCatalog 以條件請求另外更新
+        r = http_client.get(f"{self.API_URL}/key",
+                         headers={"Authorization": f"Bearer {self._key()}"}, timeout=PROBE_TIMEOUT, retries=0)
         return r.status_code == 200
 
-    def list_models(self):
-        # 嘗試從 API 取最新免費模型清單，失敗就用內建清單
-        try:
-            r = requests.get(f"{self.API_URL}/models",
-                             headers={"Authorization": f"Bearer {self._key()}"}, timeout=8)
-            if r.ok:
-                all_models = r.json().get("data", [])
-                free = [m for m in all_models if ":free" in m.get("id","")]
-                if free:
-                    return [{"id":m["id"],"name":m.get("name",m["id"]),"tag":"免費",
-                             "vision":"vision" in str(m.get("description","")).lower()} for m in free[:30]]
-        except Exception:
-            pass
+    # 從 API 取最新免費模型清單（快取），失敗就用內建清單
+    def models_url(self):
+        return f"{self.API_URL}/models"
+
+    def models_headers(self):
+        return {"Authorization": f"Bearer {self._key()}"}
+
+    def parse_models(self, data):
+        free = [m for m in data.get("data", []) if ":free" in m.get("id","")]
+        return [{"id":m["id"],"name":m.get("name",m["id"]),"tag":"免費",
+                 "vision":"vision" in str(m.get("description","")).lower()} for m in free[:30]]
+
+    def default_models(self):
         return self.FREE_MODELS
 
     def _stream(self, messages, model=None, **kw):
@@ -186,7 +366,7 @@ class OpenRouterEngine(BaseEngine):
         print(f"[OpenRouter] key_len={len(key)} prefix={key[:8]}... model={model}", file=sys.stderr)
         if not key:
             raise ValueError("❌ OPENROUTER_API_KEY 未設定，請到設定頁面填入")
-        r = requests.post(
+        r = http_client.post(
             f"{self.API_URL}/chat/completions",
             headers={
                 "Authorization":  f"Bearer {self._key()}",
@@ -195,7 +375,7 @@ class OpenRouterEngine(BaseEngine):
                 "X-Title":        "AI Chatroom",
             },
             json={"model": model, "messages": messages, "stream": True, "max_tokens": 2048},
-            stream=True, timeout=90,
+            stream=True, timeout=90, retries=0,
         )
         yield from _parse_openai_stream(r, engine=self.engine_id, model=model)
 
@@ -206,51 +386,52 @@ class OllamaEngine(BaseEngine):
     engine_id    = "ollama"
     name         = "Ollama（本機）"
     requires_key = False
+    local        = True
+
+    assume_up    = False
 
     def _base_url(self):
         return _cfg("OLLAMA_URL", "http://localhost:11434")
 
-    def available(self):
-        try:
-            r = requests.get(f"{self._base_url()}/api/tags", timeout=3)
-            return r.status_code == 200
-        except Exception:
-            return False
+    def configured(self):
+        return bool(self._base_url())
 
-    def list_models(self):
-        try:
-            r = requests.get(f"{self._base_url()}/api/tags", timeout=5)
-            if r.ok:
-                return [{"id": m["name"], "name": m["name"], "tag": "本機", "vision": False}
-                        for m in r.json().get("models", [])]
-        except Exception:
-            pass
-        return []
+    def _ping(self):
+        r = http_client.get(f"{self._base_url()}/api/tags", timeout=PROBE_TIMEOUT, retries=0)
+        return r.status_code == 200
+
+    def models_url(self):
+        return f"{self._base_url()}/api/tags"
+
+    def parse_models(self, data):
+        return [{"id": m["name"], "name": m["name"], "tag": "本機", "vision": False}
+                for m in data.get("models", [])]
 
     def _stream(self, messages, model=None, **kw):
-        models = self.list_models()
+        models = self.list_models() if not model else []   # 快取的清單，不會每次對話都打 /api/tags
         model  = model or (models[0]["id"] if models else "llama3.2")
-        r = requests.post(
+        r = http_client.post(
             f"{self._base_url()}/api/chat",
             json={"model": model, "messages": messages, "stream": True},
-            stream=True, timeout=120,
+            stream=True, timeout=120, retries=0,
         )
         if not r.ok:
             raise ValueError(f"❌ Ollama 錯誤 {r.status_code}：{r.text[:200]}")
         full = ""
-        for line in r.iter_lines(decode_unicode=True):
-            if not line:
-                continue
-            try:
-                chunk = json.loads(line)
-                token = chunk.get("message", {}).get("content", "")
-                if token:
-                    full += token
-                    yield token, full
-                if chunk.get("done"):
-                    break
-            except Exception:
-                continue
+        with r:
+            for line in r.iter_lines(decode_unicode=True):
+                if not line:
+                    continue
+                try:
+                    chunk = json.loads(line)
+                    token = chunk.get("message", {}).get("content", "")
+                    if token:
+                        full += token
+                        yield token, full
+                    if chunk.get("done"):
+                        break
+                except Exception:
+                    continue
 
 # ══════════════════════════════════════════════════════════════
 # Anthropic 引擎
@@ -258,6 +439,7 @@ class OllamaEngine(BaseEngine):
 class AnthropicEngine(BaseEngine):
     engine_id = "anthropic"
     name      = "Anthropic Claude"
+    paid      = True
     API_URL   = "https://api.anthropic.com/v1/messages"
 
     MODELS = [
@@ -269,7 +451,7 @@ class AnthropicEngine(BaseEngine):
     def _key(self):
         return (_cfg("ANTHROPIC_API_KEY") or "").strip()
 
-    def available(self):
+    def configured(self):
         return bool(self._key())
 
     def list_models(self):
@@ -291,35 +473,36 @@ class AnthropicEngine(BaseEngine):
         if system_txt:
             payload["system"] = system_txt
 
-        r = requests.post(
+        r = http_client.post(
             self.API_URL,
             headers={
                 "x-api-key":         self._key(),
                 "anthropic-version": "2023-06-01",
                 "Content-Type":      "application/json",
             },
-            json=payload, stream=True, timeout=90,
+            json=payload, stream=True, timeout=90, retries=0,
         )
         if not r.ok:
             err = r.json().get("error", {}).get("message", r.text)
             raise ValueError(f"❌ Anthropic 錯誤 {r.status_code}：{err[:200]}")
 
         full = ""
-        for line in r.iter_lines(decode_unicode=True):
-            if not line or not line.startswith("data:"):
-                continue
-            data_str = line[5:].strip()
-            if data_str == "[DONE]":
-                break
-            try:
-                ev = json.loads(data_str)
-                if ev.get("type") == "content_block_delta":
-                    token = ev.get("delta", {}).get("text", "")
-                    if token:
-                        full += token
-                        yield token, full
-            except Exception:
-                continue
+        with r:
+            for line in r.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data_str = line[5:].strip()
+                if data_str == "[DONE]":
+                    break
+                try:
+                    ev = json.loads(data_str)
+                    if ev.get("type") == "content_block_delta":
+                        token = ev.get("delta", {}).get("text", "")
+                        if token:
+                            full += token
+                            yield token, full
+                except Exception:
+                    continue
 
 # ══════════════════════════════════════════════════════════════
 # Colab 引擎（自架）
@@ -328,40 +511,38 @@ class ColabEngine(BaseEngine):
     engine_id    = "colab"
     name         = "Colab 自架"
     requires_key = False
+    local        = True
+
+    assume_up    = False
 
     def _base_url(self):
         return _cfg("COLAB_API_URL", "")   # e.g. https://xxxx.ngrok-free.app
 
-    def available(self):
-        url = self._base_url()
-        if not url:
-            return False
-        try:
-            r = requests.get(f"{url}/health", timeout=5)
-            return r.status_code == 200
-        except Exception:
-            return False
+    def configured(self):
+        return bool(self._base_url())
 
-    def list_models(self):
+    def _ping(self):
+        r = http_client.get(f"{self._base_url()}/health", timeout=PROBE_TIMEOUT, retries=0)
+        return r.status_code == 200
+
+    def models_url(self):
         url = self._base_url()
-        if not url:
-            return []
-        try:
-            r = requests.get(f"{url}/v1/models", timeout=5)
-            if r.ok:
-                return [{"id": m["id"], "name": m["id"], "tag": "Colab", "vision": False}
-                        for m in r.json().get("data", [])]
-        except Exception:
-            pass
+        return f"{url}/v1/models" if url else None
+
+    def parse_models(self, data):
+        return [{"id": m["id"], "name": m["id"], "tag": "Colab", "vision": False}
+                for m in data.get("data", [])]
+
+    def default_models(self):
         return [{"id": "local-model", "name": "Colab 模型", "tag": "自架", "vision": False}]
 
     def _stream(self, messages, model=None, **kw):
         url   = self._base_url()
         model = model or "local-model"
-        r = requests.post(
+        r = http_client.post(
             f"{url}/v1/chat/completions",
             json={"model": model, "messages": messages, "stream": True, "max_tokens": 2048},
-            stream=True, timeout=120,
+            stream=True, timeout=120, retries=0,
         )
         yield from _parse_openai_stream(r, engine=self.engine_id, model=model)
 
@@ -369,40 +550,42 @@ class ColabEngine(BaseEngine):
 # 共用串流解析（OpenAI 格式）
 # ══════════════════════════════════════════════════════════════
 def _parse_openai_stream(r, engine="", model=""):
-    if not r.ok:
-        try:
-            err = r.json().get("error", {}).get("message", r.text)
-        except Exception:
-            err = r.text
-        code = r.status_code
-        if code == 404:
-            raise ValueError(f"❌ 模型不存在：{model}")
-        elif code == 429:
-            raise ValueError(f"⏳ Rate Limit（{engine}），請稍後再試。")
-        elif code == 401:
-            raise ValueError(f"❌ API Key 錯誤（{engine}）：{err[:120]}")
-        else:
-            raise ValueError(f"❌ [{engine}] 錯誤 {code}：{err[:200]}")
-    full = ""
-    for line in r.iter_lines(decode_unicode=False):
-        if not line:
-            continue
-        try:
-            line_str = line.decode("utf-8")
-        except Exception:
-            continue
-        if line_str.startswith("data: "):
-            data_str = line_str[6:].strip()
-            if data_str == "[DONE]":
-                break
+    """連線在讀完 / 出錯 / generator 被丟棄時都歸還連線池"""
+    with r:
+        if not r.ok:
             try:
-                chunk = json.loads(data_str)
-                token = chunk["choices"][0].get("delta", {}).get("content", "")
-                if token:
-                    full += token
-                    yield token, full
+                err = r.json().get("error", {}).get("message", r.text)
+            except Exception:
+                err = r.text
+            code = r.status_code
+            if code == 404:
+                raise ValueError(f"❌ 模型不存在：{model}")
+            elif code == 429:
+                raise ValueError(f"⏳ Rate Limit（{engine}），請稍後再試。")
+            elif code == 401:
+                raise ValueError(f"❌ API Key 錯誤（{engine}）：{err[:120]}")
+            else:
+                raise ValueError(f"❌ [{engine}] 錯誤 {code}：{err[:200]}")
+        full = ""
+        for line in r.iter_lines(decode_unicode=False):
+            if not line:
+                continue
+            try:
+                line_str = line.decode("utf-8")
             except Exception:
                 continue
+            if line_str.startswith("data: "):
+                data_str = line_str[6:].strip()
+                if data_str == "[DONE]":
+                    break
+                try:
+                    chunk = json.loads(data_str)
+                    token = chunk["choices"][0].get("delta", {}).get("content", "")
+                    if token:
+                        full += token
+                        yield token, full
+                except Exception:
+                    continue
 
 # ══════════════════════════════════════════════════════════════
 # 引擎管理器
@@ -410,13 +593,13 @@ def _parse_openai_stream(r, engine="", model=""):
 class EngineManager:
     """
     統一管理所有引擎，提供：
-    - 自動 fallback
+    - 自動模式：依實際延遲 / 錯誤率 / 斷路器狀態與路由政策挑引擎（engine_router），失敗時改用下一個
     - 手動指定引擎
     - 狀態查詢
     - 模型清單彙整
     """
 
-    # fallback 優先順序：隱私最高的在前
+    # 預期延遲相同時的先後：隱私最高的在前
     FALLBACK_ORDER = ["ollama", "colab", "openrouter", "groq"]
 
     def __init__(self):
@@ -427,82 +610,268 @@ class EngineManager:
             "anthropic":   AnthropicEngine(),
             "colab":       ColabEngine(),
         }
-        # 使用者手動選擇的引擎（None = 自動）
+        # 使用者手動選擇的引擎（None = 沒有指定）
         self._preferred = None
+        # 使用者明確選了自動模式（"auto"）：聊天才交給路由；沒選時聊天照舊直接走 Groq
+        self._auto      = False
         # 上次 ping 時間
         self._last_ping = 0
+        self._probe_lock = threading.Lock()
+        self._probing    = False
+        self._prober     = None
+        self.router      = Router()
+        self._hedge_lock = threading.Lock()
+        self.hedge_stats = {"eligible": 0, "hedged": 0, "hedge_won": 0,
+                            "saved_ms_total": 0, "saved_samples": 0, "saved_unmeasured": 0}
 
     def set_preferred(self, engine_id: Optional[str]):
-        """手動指定引擎，None = 自動 fallback"""
-        if engine_id and engine_id not in self.engines:
+        """手動指定引擎；"auto" = 依延遲路由，None = 回到預設（聊天直接走 Groq）"""
+        if engine_id and engine_id != "auto" and engine_id not in self.engines:
             raise ValueError(f"未知引擎：{engine_id}")
-        self._preferred = engine_id
+        self._auto      = engine_id == "auto"
+        self._preferred = None if self._auto else engine_id
 
     def get_preferred(self):
-        return self._preferred
+        return "auto" if self._auto else self._preferred
 
     def _pick_engine(self, engine_id=None) -> BaseEngine:
-        """選出要用的引擎"""
-        eid = engine_id or self._preferred
-        if eid:
-            eng = self.engines.get(eid)
-            if eng and eng.available():
-                return eng
-            elif eng:
-                raise ValueError(f"❌ 引擎 {eng.name} 目前不可用")
-            else:
-                raise ValueError(f"❌ 未知引擎：{eid}")
-
-        # 自動 fallback
-        for eid in self.FALLBACK_ORDER:
-            eng = self.engines[eid]
-            if eng.available():
-                return eng
-
-        raise ValueError("❌ 所有引擎均不可用，請確認 API Key 設定")
-
-    def stream(self, messages, engine_id=None, model=None, **kw) -> Generator:
+        """手動指定的引擎（available() 只讀快取狀態，不會卡在死掉的端點上）"""
+        self.start_prober()
+        eng = self.engines.get(engine_id)
+        if eng and eng.available():
+            return eng
+        elif eng:
+            raise ValueError(f"❌ 引擎 {eng.name} 目前不可用")
+        raise ValueError(f"❌ 未知引擎：{engine_id}")
+
+    def policy(self):
+        return _cfg("ROUTING_POLICY", "") or None
+
+    def plan(self, engine_id=None, model=None) -> list:
         """
-        主要呼叫入口：自動選引擎 + 串流輸出
-        yield (token, full_text, engine_id)
+        依序要嘗試的 [(engine, model), ...]
+        - 指定 engine_id：只用那一個
+        - 使用者手動選了引擎：先用它，失敗再依路由排序
+        - 自動：依路由排序
+        """
+        self.start_prober()
+        if engine_id:
+            return [(self._pick_engine(engine_id), model)]
+        ranked = self.router.rank(self.engines, model=model, policy=self.policy(),
+                                  order=self.FALLBACK_ORDER)
+        if self._preferred:
+            pref = self._pick_engine(self._preferred)
+            ranked = [(pref, model)] + [(e, m) for e, m in ranked if e is not pref]
+        if not ranked:
+            raise ValueError("❌ 所有引擎均不可用，請確認 API Key 設定")
+        return ranked
+
+    def _attempt(self, eng, messages, model=None, canceller=None, **kw) -> Generator:
+        """
+        單一引擎的串流；量測 TTFT / tokens/sec 回報給 router 與健康狀態
+        canceller：http_client.Canceller，被它關掉連線造成的錯誤不算引擎失敗
         """
-        eng = self._pick_engine(engine_id)
+        eid = eng.engine_id
+        t0, ttft, n = time.time(), None, 0
+        trial = self.router.acquire(eid)
         try:
-            for token, full in eng.stream(messages, model=model, **kw):
-                yield token, full, eng.engine_id
-            _status.set(eng.engine_id, True)
+            try:
+                for token, full in eng.stream(messages, model=model, **kw):
+                    if ttft is None:
+                        ttft = time.time() - t0
+                    n += 1
+                    yield token, full
+            except Exception:
+                if canceller is None or not canceller.cancelled:
+                    raise
+                # 對沖輸了、連線被關掉：當作取消，不算引擎失敗
+                if ttft is not None:
+                    self.router.record_ttft(eid, model, ttft)
+                return
+        except (requests.ConnectionError, requests.Timeout) as e:
+            # 連不上 / 逾時：立刻標記為不可用，等背景探測恢復
+            _status.mark(eid, False, error=f"{type(e).__name__}: {e}"[:120])
+            self.router.record_failure(eid, model)
+            raise
         except ValueError as e:
             msg = str(e)
-            # Rate limit → 嘗試下一個引擎
-            if "⏳" in msg and not engine_id:
-                _status.set(eng.engine_id, False, error="rate_limit")
-                next_eng = self._next_engine(eng.engine_id)
-                if next_eng:
-                    for token, full in next_eng.stream(messages, model=None, **kw):
-                        yield token, full, next_eng.engine_id
-                    return
+            if "API Key" in msg:
+                _status.mark(eid, False, error="auth")
+            elif "⏳" in msg:
+                _status.mark(eid, False, error="rate_limit")
+            self.router.record_failure(eid, model)
+            raise
+        except GeneratorExit:
+            # 被取消（client 斷線 / 對沖輸了）：只記首字延遲，讓 p90 不只看到贏家
+            # （不算成功也不算失敗）
+            if ttft is not None:
+                self.router.record_ttft(eid, model, ttft)
+            raise
+        except Exception:
+            # HTTPError / 串流中斷（ChunkedEncodingError）/ 回應格式錯誤等：一樣算失敗
+            self.router.record_failure(eid, model)
             raise
+        else:
+            self.router.record_success(eid, model, ttft, n, time.time() - t0)
+            _status.mark(eid, True)
+        finally:
+            # 沒回報成功 / 失敗就結束（取消）時放掉半開試探名額
+            self.router.release(eid, trial)
 
-    def _next_engine(self, current_id) -> Optional[BaseEngine]:
-        """fallback 到下一個可用引擎"""
-        order = self.FALLBACK_ORDER
+    def stream(self, messages, engine_id=None, model=None, hedge=None, **kw) -> Generator:
+        """
+        主要呼叫入口：選引擎 + 串流輸出
+        yield (token, full_text, engine_id)
+        還沒吐出任何 token 就失敗時改用下一個引擎（指定 engine_id 時不換）
+        hedge：自動模式下對沖（None = 看 HEDGE_STREAMS 設定），見 _hedged()
+        """
+        plan = self.plan(engine_id, model)
+        if hedge is None:
+            hedge = str(_cfg("HEDGE_STREAMS", "")).lower() in ("1", "true", "yes", "on")
+        if hedge and not engine_id and not self._preferred and len(plan) > 1:
+            yield from self._hedged(plan, messages, **kw)
+            return
+        err = None
+        for eng, m in plan:
+            started = False
+            try:
+                for token, full in self._attempt(eng, messages, model=m, **kw):
+                    started = True
+                    yield token, full, eng.engine_id
+                return
+            except Exception as e:
+                # 任何錯誤（含 HTTPError / ChunkedEncodingError）只要還沒吐出 token 就換下一個
+                if started or engine_id:
+                    raise
+                err = e
+        raise err
+
+    # ── 對沖串流 ──
+    def hedge_delay(self, engine_id) -> float:
+        """主引擎多久沒吐出第一個 token 就對沖：最近 TTFT 的 p90，限制在 HEDGE_MIN ~ HEDGE_MAX"""
+        p90 = self.router.ttft_percentile(engine_id, 0.9)
+        return min(max(p90 if p90 is not None else HEDGE_DEFAULT, HEDGE_MIN), HEDGE_MAX)
+
+    def _hedge_count(self, **kw):
+        with self._hedge_lock:
+            for k, v in kw.items():
+                self.hedge_stats[k] += v
+
+    def _hedged(self, plan, messages, **kw) -> Generator:
+        """
+        先送主引擎；hedge_delay 內沒有第一個 token 就對排序下一名送同一個請求，
+        先吐出 token 的贏，其他的立刻 shutdown 連線（還在等回應標頭的也一樣，見 http_client.Canceller）。
+        還沒有贏家時失敗的引擎由排序再下一名補上（同一般 fallback）。
+        省下的時間：主引擎最近的 TTFT 樣本中比這次贏家首字還慢的平均 - 贏家首字時間（沒有這種樣本就量不到）
+        """
+        events  = queue.Queue()
+        cancels = []                 # 第幾個 → Canceller
+        race    = {"winner": None, "closed": False}
+        t0      = time.time()
+
+        def run(idx, eng, m, canc):
+            with canc.track():
+                gen = self._attempt(eng, messages, model=m, canceller=canc, **kw)
+                try:
+                    for token, full in gen:
+                        if race["closed"] or race["winner"] not in (None, idx):
+                            return
+                        events.put((idx, "token", token, full))
+                    events.put((idx, "done", None, None))
+                except Exception as e:
+                    if not canc.cancelled:
+                        events.put((idx, "error", e, None))
+                finally:
+                    gen.close()
+
+        launched, failed, err = 0, set(), None
+        hedges = set()               # 因為逾時才送出的（不含失敗後的 fallback）
+        def launch():
+            nonlocal launched
+            eng, m = plan[launched]
+            canc = http_client.Canceller()
+            cancels.append(canc)
+            threading.Thread(target=run, args=(launched, eng, m, canc), daemon=True,
+                             name=f"hedge-{eng.engine_id}").start()
+            launched += 1
+
+        self._hedge_count(eligible=1)
+        launch()
+        deadline = t0 + self.hedge_delay(plan[0][0].engine_id)
+        finished = False
         try:
-            idx = order.index(current_id)
-        except ValueError:
-            idx = -1
-        for eid in order[idx+1:]:
-            eng = self.engines.get(eid)
-            if eng and eng.available():
-                return eng
-        return None
+            while True:
+                wait = None
+                if race["winner"] is None and launched == 1 and launched < len(plan):
+                    wait = max(deadline - time.time(), 0)
+                try:
+                    idx, kind, a, b = events.get(timeout=wait)
+                except queue.Empty:
+                    self._hedge_count(hedged=1)
+                    hedges.add(launched)
+                    launch()
+                    continue
+                w = race["winner"]
+                if w is None:
+                    if kind == "error":
+                        failed.add(idx)
+                        err = a
+                        if len(failed) == launched:
+                            if launched == len(plan):
+                                raise err
+                            launch()
+                        continue
+                    race["winner"] = w = idx
+                    for i, canc in enumerate(cancels):
+                        if i != idx:
+                            canc.cancel()
+                    if idx in hedges:
+                        self._hedge_won(plan[0][0].engine_id, time.time() - t0)
+                if idx != w:
+                    continue
+                if kind == "token":
+                    yield a, b, plan[idx][0].engine_id
+                elif kind == "done":
+                    finished = True
+                    return
+                else:
+                    raise a
+        finally:
+            race["closed"] = True
+            if not finished:
+                # 呼叫端不讀了（client 斷線）或出錯：全部關掉，包括贏家
+                for canc in cancels:
+                    canc.cancel()
+
+    def _hedge_won(self, primary_id, winner_at):
+        tail = self.router.ttft_tail_mean(primary_id, winner_at)
+        if tail is None:
+            self._hedge_count(hedge_won=1, saved_unmeasured=1)
+        else:
+            self._hedge_count(hedge_won=1, saved_samples=1, saved_ms_total=int((tail - winner_at) * 1000))
+
+    def routing(self) -> dict:
+        """路由輸入（EWMA / 斷路器）與最近一次決策；沒有決策時以目前狀態試算一次（不送請求）"""
+        if self.router.last_decision is None:
+            self.router.rank(self.engines, policy=self.policy(), order=self.FALLBACK_ORDER)
+        snap = self.router.snapshot()
+        with self._hedge_lock:
+            h = dict(self.hedge_stats)
+        h["hedge_rate"]   = round(h["hedged"] / h["eligible"], 3) if h["eligible"] else 0.0
+        h["avg_saved_ms"] = round(h["saved_ms_total"] / h["saved_samples"]) if h["saved_samples"] else None
+        snap["hedging"] = h
+        return snap
 
     def status(self) -> dict:
-        """回傳所有引擎狀態"""
+        """回傳所有引擎狀態（快取，不連網路）"""
+        self.start_prober()
         result = {}
         for eid, eng in self.engines.items():
             st = _status.get(eid)
             result[eid] = {
                 "name":       eng.name,
+                "configured": eng.configured(),
+                "catalog":    _catalog.info(eng) if eng.models_url() else None,
                 "available":  eng.available(),
                 "ok":         st["ok"],
                 "error":      st["error"],
@@ -512,16 +881,48 @@ class EngineManager:
             }
         return result
 
+    # ── 健康探測 ──
+    def probe_all(self):
+        """並行 ping 所有已設定的引擎（同一時間只跑一輪），回傳 {engine_id: ok}"""
+        with self._probe_lock:
+            if self._probing:
+                return None
+            self._probing = True
+        try:
+            engines = [eng for eng in self.engines.values() if eng.configured()]
+            results = {}
+            if engines:
+                with ThreadPoolExecutor(max_workers=len(engines)) as pool:
+                    results = dict(zip([e.engine_id for e in engines], pool.map(lambda e: e.ping(), engines)))
+                    # 順便更新過期的模型清單（只對健康的引擎）
+                    stale = [e for e in engines if results[e.engine_id] and e.models_url() and _catalog.stale(e)]
+                    list(pool.map(_catalog.refresh, stale))
+            self._last_ping = time.time()
+            return results
+        finally:
+            self._probing = False
+
+    def _probe_loop(self):
+        while True:
+            try:
+                self.probe_all()
+            except Exception:
+                pass
+            time.sleep(HEALTH_TTL)
+
+    def start_prober(self):
+        """背景探測執行緒（每個行程一條，第一次用到時啟動），每 HEALTH_TTL 秒更新一次健康狀態"""
+        if self._prober is not None and self._prober.is_alive():
+            return
+        with self._probe_lock:
+            if self._prober is None or not self._prober.is_alive():
+                self._prober = threading.Thread(target=self._probe_loop, name="engine-prober", daemon=True)
+                self._prober.start()
+
     def ping_all(self):
-        """背景 ping 所有引擎（在 thread 裡跑）"""
-        def _run():
-            for eng in self.engines.values():
-                try:
-                    eng.ping()
-                except Exception:
-                    pass
-        t = threading.Thread(target=_run, daemon=True)
-        t.start()
+        """立即在背景重新探測一輪（已有一輪在跑就略過）"""
+        self.start_prober()
+        threading.Thread(target=self.probe_all, daemon=True).start()
 
     def all_models(self) -> list:
         """彙整所有引擎的模型清單"""
@@ -561,6 +962,9 @@ def stream_ai(messages, engine_id=None, model=None, **kw):
 def get_status() -> dict:
     return manager.status()
 
+def get_routing() -> dict:
+    return manager.routing()
+
 def set_engine(engine_id: Optional[str]):
     manager.set_preferred(engine_id)
 
@@ -574,4 +978,7 @@ def get_models_by_engine() -> dict:
     return manager.models_by_engine()
 
 def ping_engines():
-    manager.ping_all()
\ No newline at end of file
+    """確保背景探測在跑；狀態超過兩個探測週期（HEALTH_TTL * 2）沒更新才補一輪（不阻塞請求）"""
+    manager.start_prober()
+    if time.time() - manager._last_ping > HEALTH_TTL * 2:
+        manager.ping_all()
\ No newline at end of file
@@ -0,0 +1,242 @@
+"""
+engine_router.py — 依實際流量的延遲挑引擎（給 engine_manager 自動模式用）
+- 每個引擎、每個 (引擎, 模型) 以 EWMA 記：首字延遲（TTFT）、tokens/sec、錯誤率
+- 斷路器：連續失敗 BREAKER_FAILURES 次打開；冷卻後半開，只放行一個試探請求，
+  成功就關閉，失敗再打開且冷卻加倍（上限 BREAKER_MAX）
+- 政策先過濾引擎（privacy 只用本機 / balanced 不用付費、本機加分 / fast 全部），
+  剩下的依預期延遲排序：(TTFT + EXPECTED_TOKENS / tps) / (1 - 錯誤率)
+- 樣本不足 MIN_SAMPLES 或超過 EXPLORE_AFTER 秒沒有新樣本的引擎排最前面試一次（探索），
+  否則第一次量到比較慢的引擎永遠不會再被選到
+- 最近一次路由決策與每個引擎的輸入值保留給 /ai/engines 顯示
+"""
+import os
+import time
+import threading
+from collections import deque
+
+ALPHA            = float(os.environ.get("ROUTER_EWMA_ALPHA", 0.3))
+BREAKER_FAILURES = int(os.environ.get("ROUTER_BREAKER_FAILURES", 3))
+BREAKER_COOLDOWN = float(os.environ.get("ROUTER_BREAKER_COOLDOWN", 30))    # 秒，每次重新打開加倍
+BREAKER_MAX      = float(os.environ.get("ROUTER_BREAKER_MAX", 300))
+TRIAL_TIMEOUT    = 120      # 半開試探請求沒回報結果（例如 client 斷線）多久後再放行下一個
+EXPECTED_TOKENS  = int(os.environ.get("ROUTER_EXPECTED_TOKENS", 300))      # 估算整段回覆時間用
+MIN_SAMPLES      = 3        # 引擎樣本數不足時先探索；(引擎, 模型) 樣本不足時改用引擎整體的數字
+EXPLORE_AFTER    = float(os.environ.get("ROUTER_EXPLORE_AFTER", 600))
+PRIOR            = {"ttft": 2.0, "tps": 30.0, "error_rate": 0.0}          # 完全沒有樣本時
+TTFT_WINDOW      = 50       # 保留最近幾筆 TTFT 算百分位
+
+POLICIES = {
+    "privacy":  {"local_only": True,  "allow_paid": False, "local_bonus": 0.0},
+    "balanced": {"local_only": False, "allow_paid": False, "local_bonus": 1.0},   # 同等條件下優先本機
+    "fast":     {"local_only": False, "allow_paid": True,  "local_bonus": 0.0},
+}
+DEFAULT_POLICY = os.environ.get("ROUTING_POLICY", "balanced")
+
+# ══════════════════════════════════════
+# 統計
+# ══════════════════════════════════════
+def _ewma(old, value):
+    return value if old is None else ALPHA * value + (1 - ALPHA) * old
+
+class _Stats:
+    __slots__ = ("ttft", "tps", "error_rate", "samples", "ttfts", "last")
+
+    def __init__(self):
+        self.ttft = self.tps = self.error_rate = None
+        self.samples = 0
+        self.last    = 0.0
+        self.ttfts   = deque(maxlen=TTFT_WINDOW)
+
+    def success(self, ttft, tokens, duration):
+        self.samples += 1
+        self.last = time.time()
+        self.error_rate = _ewma(self.error_rate, 0.0)
+        if ttft is not None:
+            self.ttft = _ewma(self.ttft, ttft)
+            self.ttfts.append(ttft)
+            if tokens > 1 and duration > ttft:
+                self.tps = _ewma(self.tps, (tokens - 1) / (duration - ttft))
+
+    def failure(self):
+        self.samples += 1
+        self.last = time.time()
+        self.error_rate = _ewma(self.error_rate, 1.0)
+
+    def view(self):
+        return {"ttft_s": None if self.ttft is None else round(self.ttft, 3),
+                "tps": None if self.tps is None else round(self.tps, 1),
+                "error_rate": None if self.error_rate is None else round(self.error_rate, 3),
+                "samples": self.samples}
+
+class _Breaker:
+    __slots__ = ("failures", "opened_at", "cooldown", "trial_at")
+
+    def __init__(self):
+        self.failures  = 0
+        self.opened_at = None
+        self.cooldown  = BREAKER_COOLDOWN
+        self.trial_at  = None     # 半開試探請求開始時間
+
+    def state(self, now):
+        if self.opened_at is None:
+            return "closed"
+        if now - self.opened_at < self.cooldown:
+            return "open"
+        if self.trial_at is not None and now - self.trial_at < TRIAL_TIMEOUT:
+            return "open"         # 已有試探請求在跑
+        return "half_open"
+
+# ══════════════════════════════════════
+# Router
+# ══════════════════════════════════════
+class Router:
+    def __init__(self):
+        self._lock     = threading.Lock()
+        self._engines  = {}        # engine_id → _Stats
+        self._models   = {}        # (engine_id, model) → _Stats
+        self._breakers = {}        # engine_id → _Breaker
+        self.last_decision = None
+
+    def _breaker(self, eid):
+        return self._breakers.setdefault(eid, _Breaker())
+
+    # ── 回報實際請求結果 ──
+    def acquire(self, eid):
+        """開始一個實際請求；斷路器半開時這個請求就是試探，回傳 trial_at（不是試探時為 None）"""
+        with self._lock:
+            b = self._breaker(eid)
+            if b.state(time.time()) == "half_open":
+                b.trial_at = time.time()
+                return b.trial_at
+            return None
+
+    def release(self, eid, trial_at):
+        """試探請求結束時放掉名額（已回報成功 / 失敗、或名額已被別的試探接手時不動）"""
+        if trial_at is None:
+            return
+        with self._lock:
+            b = self._breaker(eid)
+            if b.trial_at == trial_at:
+                b.trial_at = None
+
+    def record_success(self, eid, model, ttft, tokens, duration):
+        with self._lock:
+            self._engines.setdefault(eid, _Stats()).success(ttft, tokens, duration)
+            self._models.setdefault((eid, model or ""), _Stats()).success(ttft, tokens, duration)
+            b = self._breaker(eid)
+            b.failures, b.opened_at, b.trial_at, b.cooldown = 0, None, None, BREAKER_COOLDOWN
+
+    def record_failure(self, eid, model):
+        with self._lock:
+            self._engines.setdefault(eid, _Stats()).failure()
+            self._models.setdefault((eid, model or ""), _Stats()).failure()
+            b = self._breaker(eid)
+            b.failures += 1
+            now = time.time()
+            if b.trial_at is not None or (b.opened_at is not None and b.state(now) == "half_open"):
+                # 半開試探失敗 → 重新打開，冷卻加倍
+                b.cooldown  = min(b.cooldown * 2, BREAKER_MAX)
+                b.opened_at = now
+            elif b.opened_at is None and b.failures >= BREAKER_FAILURES:
+                b.opened_at = now
+            b.trial_at = None
+
+    def record_ttft(self, eid, model, ttft):
+        """被取消的請求只有首字延遲可記（不算成功 / 失敗）"""
+        with self._lock:
+            for st in (self._engines.setdefault(eid, _Stats()),
+                       self._models.setdefault((eid, model or ""), _Stats())):
+                st.ttft = _ewma(st.ttft, ttft)
+                st.ttfts.append(ttft)
+
+    def ttft_percentile(self, eid, q=0.9):
+        """最近 TTFT_WINDOW 筆首字延遲的百分位（秒），沒有樣本時回傳 None"""
+        with self._lock:
+            st = self._engines.get(eid)
+            samples = sorted(st.ttfts) if st else []
+        if not samples:
+            return None
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+    def ttft_tail_mean(self, eid, above):
+        """最近 TTFT 樣本中大於 above 秒的平均（估計「這次要是沒對沖還得等多久」），沒有時回傳 None"""
+        with self._lock:
+            st = self._engines.get(eid)
+            tail = [t for t in st.ttfts if t > above] if st else []
+        return sum(tail) / len(tail) if tail else None
+
+    # ── 排序 ──
+    def _explore(self, eid, now):
+        st = self._engines.get(eid)
+        return st is None or st.samples < MIN_SAMPLES or now - st.last > EXPLORE_AFTER
+
+    def _inputs(self, eid, model):
+        st = self._models.get((eid, model or ""))
+        if st is None or st.samples < MIN_SAMPLES:
+            st = self._engines.get(eid)
+        v = st.view() if st else {"ttft_s": None, "tps": None, "error_rate": None, "samples": 0}
+        ttft = v["ttft_s"] if v["ttft_s"] is not None else PRIOR["ttft"]
+        tps  = v["tps"] or PRIOR["tps"]
+        err  = v["error_rate"] if v["error_rate"] is not None else PRIOR["error_rate"]
+        return v, (ttft + EXPECTED_TOKENS / tps) / max(1 - err, 0.1)
+
+    def rank(self, engines, model=None, policy=None, order=()):
+        """
+        engines：{engine_id: BaseEngine}；order：同分時的先後（FALLBACK_ORDER）
+        回傳 [(engine, model_for_engine), ...]（預期延遲由低到高）；決策記在 last_decision
+        指定 model 時只排有提供這個模型的引擎（使用者選的模型不會被別的引擎的預設模型頂替）；
+        沒有任何已設定的引擎列出它（例如自訂模型 ID）時才照常排序，model 原樣傳給每個引擎
+        模型清單只看快取（cached_models），不在請求路徑上抓網路
+        """
+        name = policy if policy in POLICIES else DEFAULT_POLICY
+        pol  = POLICIES[name]
+        now  = time.time()
+        serving = set()
+        if model:
+            serving = {eid for eid, eng in engines.items()
+                       if eng.configured() and any(x.get("id") == model for x in eng.cached_models())}
+        rows = []
+        for eid, eng in engines.items():
+            row = {"engine": eid, "local": eng.local, "paid": eng.paid}
+            if not eng.configured():
+                row["excluded"] = "未設定"
+            elif serving and eid not in serving:
+                row["excluded"] = "不提供此模型"
+            elif pol["local_only"] and not eng.local:
+                row["excluded"] = "政策：僅本機"
+            elif eng.paid and not pol["allow_paid"]:
+                row["excluded"] = "政策：不用付費引擎"
+            elif not eng.available():
+                row["excluded"] = "健康檢查失敗"
+            with self._lock:
+                row["breaker"] = self._breaker(eid).state(now)
+            if row["breaker"] == "open" and "excluded" not in row:
+                row["excluded"] = "斷路器開啟"
+            if "excluded" not in row:
+                m = model
+                with self._lock:
+                    inputs, expected = self._inputs(eid, m)
+                    explore = self._explore(eid, now)
+                if eng.local:
+                    expected -= pol["local_bonus"]
+                row.update(model=m, expected_s=round(expected, 3), explore=explore, **inputs)
+            rows.append(row)
+        rank_of = {eid: i for i, eid in enumerate(order)}
+        ok = sorted((r for r in rows if "excluded" not in r),
+                    key=lambda r: (not r["explore"], r["expected_s"], rank_of.get(r["engine"], len(rank_of))))
+        self.last_decision = {
+            "at": now, "policy": name, "model": model,
+            "chosen": ok[0]["engine"] if ok else None,
+            "candidates": ok + [r for r in rows if "excluded" in r],
+        }
+        return [(engines[r["engine"]], r["model"]) for r in ok]
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            engines = {eid: dict(st.view(), breaker=self._breaker(eid).state(now),
+                                 consecutive_failures=self._breaker(eid).failures)
+                       for eid, st in self._engines.items()}
+            models = {f"{eid}/{m or '(預設)'}": st.view() for (eid, m), st in self._models.items()}
+        return {"policy_default": DEFAULT_POLICY, "policies": list(POLICIES),
+                "engines": engines, "models": models, "last_decision": self.last_decision}
@@ -0,0 +1,250 @@
+"""
+http_client.py — LLM 供應商共用 HTTP 連線層
+- 每個 host 一個 requests.Session（HTTPAdapter 連線池），keep-alive 重用 TCP + TLS 連線
+- 統一重試：連線失敗 / 連線逾時 / 429 / 5xx 以指數退避 + jitter 重試；
+  有 Retry-After（秒數或 HTTP 日期）就照它等，超過 MAX_RETRY_AFTER 秒不等、直接回傳讓呼叫端 fallback
+- 讀取逾時不重試（LLM 回應慢重送只會更慢）；串流請求只在拿到回應標頭前重試
+- 重試用完仍是 429 / 5xx 時回傳最後一個 Response，錯誤訊息照舊由呼叫端處理
+- 互動對話串流（engine_manager 各引擎 _stream、ai_utils.stream_groq）用 retries=0：
+  429 / 連線失敗立刻交給路由與 fallback；背景呼叫（agent_engine、true_multi_agent…）才用預設重試
+- stats()：每個 host 的請求 / 重試 / 錯誤數，與連線池的新建連線數、重用次數（pool hit）
+- Canceller：記下某個執行緒借出的連線，可從別的執行緒直接關掉（對沖串流取消輸家，
+  連還在等回應標頭的請求也能中斷）
+"""
+import os
+import time
+import random
+import socket
+import threading
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+POOL_SIZE       = int(os.environ.get("HTTP_POOL_SIZE", 10))          # 每個 host 保留的連線數
+CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+READ_TIMEOUT    = float(os.environ.get("HTTP_READ_TIMEOUT", 60))
+MAX_RETRIES     = int(os.environ.get("HTTP_MAX_RETRIES", 3))
+BACKOFF_BASE    = float(os.environ.get("HTTP_BACKOFF_BASE", 1.0))
+BACKOFF_MAX     = float(os.environ.get("HTTP_BACKOFF_MAX", 30))
+MAX_RETRY_AFTER = float(os.environ.get("HTTP_MAX_RETRY_AFTER", 60))
+RETRY_STATUS    = {429, 500, 502, 503, 504}
+
+_sessions = {}     # host → requests.Session
+_host_cfg = {}     # host → {"pool_size", "connect_timeout", "read_timeout"}
+_counters = {}     # host → {"requests", "retries", "errors"}
+_lock     = threading.Lock()
+
+# ══════════════════════════════════════
+# 取消進行中的請求
+# ══════════════════════════════════════
+_tracking = threading.local()
+
+def _abort(conn):
+    """shutdown 底層 socket：卡在 recv 的執行緒會立刻收到錯誤，供應商端也會看到斷線"""
+    sock = getattr(conn, "sock", None)
+    if sock is not None:
+        try:
+            socket.socket.shutdown(sock, socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+class Canceller:
+    """
+    with c.track(): 期間本執行緒從連線池借出的連線都記下來；
+    c.cancel() 可從別的執行緒關掉還沒歸還的那些（已歸還連線池的不會動到）
+    """
+    def __init__(self):
+        self._lock      = threading.Lock()
+        self._conns     = set()
+        self.cancelled  = False
+
+    @contextmanager
+    def track(self):
+        prev = getattr(_tracking, "canceller", None)
+        _tracking.canceller = self
+        try:
+            yield self
+        finally:
+            _tracking.canceller = prev
+
+    def _add(self, conn):
+        with self._lock:
+            self._conns.add(conn)
+            if self.cancelled:
+                _abort(conn)
+
+    def _discard(self, conn):
+        with self._lock:
+            self._conns.discard(conn)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            for conn in self._conns:
+                _abort(conn)
+
+class _TrackingPool:
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        c = getattr(_tracking, "canceller", None)
+        conn._canceller = c
+        if c is not None:
+            c._add(conn)
+        return conn
+
+    def _put_conn(self, conn):
+        c = getattr(conn, "_canceller", None)
+        if c is not None:
+            c._discard(conn)
+            conn._canceller = None
+        super()._put_conn(conn)
+
+class _HTTPPool(_TrackingPool, HTTPConnectionPool):
+    pass
+
+class _HTTPSPool(_TrackingPool, HTTPSConnectionPool):
+    pass
+
+class _Adapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kw):
+        super().init_poolmanager(*args, **kw)
+        self.poolmanager.pool_classes_by_scheme = {"http": _HTTPPool, "https": _HTTPSPool}
+
+def _host(url):
+    return urlsplit(url).netloc.lower()
+
+def configure(host, pool_size=None, connect_timeout=None, read_timeout=None):
+    """個別 host 的連線池大小 / 逾時（例如本機 Ollama 連線數少、逾時長），已建立的 Session 會重建"""
+    with _lock:
+        cfg = _host_cfg.setdefault(host.lower(), {})
+        for k, v in (("pool_size", pool_size), ("connect_timeout", connect_timeout),
+                     ("read_timeout", read_timeout)):
+            if v is not None:
+                cfg[k] = v
+        old = _sessions.pop(host.lower(), None)
+    if old is not None:
+        old.close()
+
+def session_for(url):
+    host = _host(url)
+    with _lock:
+        s = _sessions.get(host)
+        if s is None:
+            size = _host_cfg.get(host, {}).get("pool_size", POOL_SIZE)
+            s = requests.Session()
+            adapter = _Adapter(pool_connections=1, pool_maxsize=size, max_retries=0)
+            s.mount("http://", adapter)
+            s.mount("https://", adapter)
+            _sessions[host] = s
+            _counters.setdefault(host, {"requests": 0, "retries": 0, "errors": 0})
+        return s
+
+def _timeout(host, timeout):
+    """數字視為讀取逾時，連線逾時另外用 CONNECT_TIMEOUT（連不上的 host 不必等滿讀取逾時）"""
+    cfg = _host_cfg.get(host, {})
+    if timeout is None:
+        timeout = cfg.get("read_timeout", READ_TIMEOUT)
+    if isinstance(timeout, (int, float)):
+        return (min(cfg.get("connect_timeout", CONNECT_TIMEOUT), timeout), timeout)
+    return timeout
+
+def retry_after(resp):
+    """Retry-After 標頭 → 秒數；沒有或格式不對時回傳 None"""
+    value = resp.headers.get("Retry-After") if resp is not None else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+def backoff(attempt, resp=None):
+    """第 attempt 次重試前要等的秒數：有 Retry-After 照它 + 少量 jitter，否則 full jitter 指數退避"""
+    wait = retry_after(resp)
+    if wait is not None:
+        return wait + random.uniform(0, BACKOFF_BASE)
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+def _count(host, key):
+    with _lock:
+        _counters[host][key] += 1
+
+def request(method, url, retries=None, timeout=None, on_retry=None, **kw):
+    """
+    送出請求並套用統一重試策略，回傳 requests.Response（與 requests.request 相同用法）
+    retries：最多重試次數（預設 MAX_RETRIES；健康檢查之類快速失敗的用 0）
+    on_retry(resp, exc)：每次決定重試時呼叫（例如記錄 429 次數）
+    """
+    retries = MAX_RETRIES if retries is None else retries
+    s = session_for(url)
+    host = _host(url)
+    timeout = _timeout(host, timeout)
+    attempt = 0
+    while True:
+        _count(host, "requests")
+        try:
+            resp = s.request(method, url, timeout=timeout, **kw)
+        except requests.ConnectionError as e:        # 含 ConnectTimeout；ReadTimeout 不在此列
+            if attempt >= retries:
+                _count(host, "errors")
+                raise
+            if on_retry:
+                on_retry(None, e)
+            wait = backoff(attempt)
+        else:
+            if resp.status_code not in RETRY_STATUS or attempt >= retries:
+                return resp
+            wait = backoff(attempt, resp)
+            if retry_after(resp) is not None and wait > MAX_RETRY_AFTER:
+                return resp
+            if on_retry:
+                on_retry(resp, None)
+            resp.close()
+        _count(host, "retries")
+        attempt += 1
+        time.sleep(wait)
+
+def get(url, **kw):
+    return request("GET", url, **kw)
+
+def post(url, **kw):
+    return request("POST", url, **kw)
+
+# ══════════════════════════════════════
+# 監控
+# ══════════════════════════════════════
+def _pool_counts(session):
+    """urllib3 連線池的 num_requests / num_connections（新建連線數），差值即重用次數"""
+    reqs = conns = 0
+    seen = set()
+    for adapter in session.adapters.values():
+        if id(adapter) in seen:
+            continue
+        seen.add(id(adapter))
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                reqs  += getattr(pool, "num_requests", 0)
+                conns += getattr(pool, "num_connections", 0)
+    return reqs, conns
+
+def stats():
+    with _lock:
+        items = [(h, s, dict(_counters[h])) for h, s in _sessions.items()]
+    out = {}
+    for host, s, c in items:
+        reqs, conns = _pool_counts(s)
+        c.update(pool_size=_host_cfg.get(host, {}).get("pool_size", POOL_SIZE),
+                 connections_opened=conns, pool_hits=max(reqs - conns, 0),
+                 pool_hit_rate=round((reqs - conns) / reqs, 3) if reqs else 0.0)
+        out[host] = c
+    return out
@@ -0,0 +1,249 @@
+"""
+ingest.py — 批次匯入（KB / RAG）
+- 多檔或 zip 上傳時逐檔串流寫到 data/ingest/<job_id>/，不把整包讀進記憶體
+- 解碼 / 切段 / 斷詞交給 ProcessPoolExecutor（預設 CPU 核心數）平行處理，
+  worker 只做純計算、不碰資料庫
+- 全部檔案處理完後在同一個 transaction 寫入文件、段落與索引（失敗整批 rollback）
+- 進度與逐檔結果記在 ingest_jobs，任何一個 worker 行程都能用 job_id 輪詢
+"""
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import zipfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from database import connection, transaction, DB_PATH
+
+INGEST_DIR     = os.path.join(os.path.dirname(DB_PATH), "ingest")
+TARGETS        = ("kb", "rag")
+TEXT_EXTS      = (".txt", ".md", ".csv", ".json", ".py", ".js", ".html", ".css")
+MAX_FILE_BYTES = 5 * 1024 * 1024      # 單檔上限（與 /ai/rag/upload 相同）
+MAX_FILES      = 2000                 # 單一工作最多檔案數（含 zip 內的檔案）
+WORKERS        = int(os.environ.get("INGEST_WORKERS", 0)) or os.cpu_count() or 1
+COPY_BUF       = 64 * 1024
+PROGRESS_EVERY = 1.0                  # 進度最多每秒寫回一次
+
+# ══════════════════════════════════════
+# 工作記錄
+# ══════════════════════════════════════
+def _job_dir(job_id):
+    return os.path.join(INGEST_DIR, job_id)
+
+def create_job(target):
+    if target not in TARGETS:
+        raise ValueError(f"不支援的匯入目標：{target}")
+    job_id = uuid.uuid4().hex[:12]
+    os.makedirs(_job_dir(job_id), exist_ok=True)
+    with transaction() as conn:
+        conn.execute("INSERT INTO ingest_jobs (id, target) VALUES (?,?)", (job_id, target))
+    return job_id
+
+# files 欄位只存狀態；text / prepared 是處理中的全文與切段，不能寫進 DB
+FILE_FIELDS = ("name", "status", "size", "error", "id", "chunks", "duplicate")
+
+def _save_job(job_id, files, **fields):
+    fields["files"]     = json.dumps([{k: f[k] for k in FILE_FIELDS if k in f} for f in files],
+                                     ensure_ascii=False)
+    fields["total"]     = len(files)
+    fields["processed"] = sum(f["status"] not in ("queued", "prepared") for f in files)
+    fields["imported"]  = sum(f["status"] in ("ok", "duplicate") for f in files)
+    fields["failed"]    = sum(f["status"] == "error" for f in files)
+    cols = ", ".join(f"{k}=?" for k in fields)
+    with transaction() as conn:
+        conn.execute(f"UPDATE ingest_jobs SET {cols} WHERE id=?", list(fields.values()) + [job_id])
+
+def get_job(job_id):
+    with connection() as conn:
+        row = conn.execute("SELECT * FROM ingest_jobs WHERE id=?", (job_id,)).fetchone()
+    if not row:
+        return None
+    job = dict(row)
+    job["files"] = json.loads(job["files"])
+    return job
+
+def list_jobs(limit=20):
+    with connection() as conn:
+        rows = conn.execute(
+            "SELECT id, target, status, total, processed, imported, failed, created_at, finished_at "
+            "FROM ingest_jobs ORDER BY created_at DESC, rowid DESC LIMIT ?", (limit,)
+        ).fetchall()
+    return [dict(r) for r in rows]
+
+# ══════════════════════════════════════
+# 收檔（串流寫入暫存目錄）
+# ══════════════════════════════════════
+def _safe_name(name):
+    """zip 內路徑 / 上傳檔名 → 單一層檔名（擋掉 ../ 與絕對路徑）"""
+    name = os.path.basename(name.replace("\\", "/")) or "file"
+    return re.sub(r'[\x00-\x1f/:*?"<>|]', "_", name)
+
+def _copy_limited(src, path):
+    """分段複製，超過 MAX_FILE_BYTES 就中止並刪掉半成品"""
+    size = 0
+    with open(path, "wb") as out:
+        while True:
+            buf = src.read(COPY_BUF)
+            if not buf:
+                break
+            size += len(buf)
+            if size > MAX_FILE_BYTES:
+                break
+            out.write(buf)
+    if size > MAX_FILE_BYTES:
+        os.remove(path)
+        raise ValueError(f"檔案超過 {MAX_FILE_BYTES // 1024 // 1024}MB")
+    return size
+
+def _entry(job_id, files, name, src):
+    """收一個檔案到暫存目錄，結果（或錯誤）加進 files"""
+    f = {"name": name, "status": "queued"}
+    files.append(f)
+    if len(files) > MAX_FILES:
+        f.update(status="error", error=f"超過單次上限 {MAX_FILES} 個檔案")
+        return
+    if not name.lower().endswith(TEXT_EXTS):
+        f.update(status="error", error="不支援的格式")
+        return
+    path = os.path.join(_job_dir(job_id), f"{len(files):05d}_{_safe_name(name)}")
+    try:
+        f["size"] = _copy_limited(src, path)
+        f["path"] = path
+    except (OSError, ValueError) as e:
+        f.update(status="error", error=str(e))
+
+def stage_upload(job_id, filename, stream, files):
+    """
+    收下一個上傳檔（stream 為可 read() 的檔案物件）；.zip 會展開成多個檔案
+    結果累加到 files（list of dict），zip 本身壞掉時記成一筆錯誤
+    """
+    filename = filename or "file"
+    if not filename.lower().endswith(".zip"):
+        _entry(job_id, files, filename, stream)
+        return
+    zpath = os.path.join(_job_dir(job_id), f"upload_{uuid.uuid4().hex[:8]}.zip")
+    with open(zpath, "wb") as out:
+        shutil.copyfileobj(stream, out, COPY_BUF)
+    try:
+        with zipfile.ZipFile(zpath) as zf:
+            for info in zf.infolist():
+                base = os.path.basename(info.filename.rstrip("/"))
+                if info.is_dir() or info.filename.startswith("__MACOSX/") or base.startswith("."):
+                    continue
+                name = f"{filename}/{info.filename}"
+                if info.file_size > MAX_FILE_BYTES:
+                    files.append({"name": name, "status": "error",
+                                  "error": f"檔案超過 {MAX_FILE_BYTES // 1024 // 1024}MB"})
+                    continue
+                with zf.open(info) as src:
+                    _entry(job_id, files, name, src)
+    except zipfile.BadZipFile as e:
+        files.append({"name": filename, "status": "error", "error": f"zip 格式錯誤：{e}"})
+    finally:
+        os.remove(zpath)
+
+# ══════════════════════════════════════
+# 處理（worker 行程）
+# ══════════════════════════════════════
+def _decode(raw):
+    if b"\x00" in raw[:8192]:
+        raise ValueError("不是文字檔")
+    try:
+        return raw.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return raw.decode("utf-8", errors="replace")
+
+def _prepare(target, path):
+    """讀檔 → 解碼 → 切段 + 斷詞；在子行程執行，只回傳可 pickle 的結果"""
+    with open(path, "rb") as f:
+        text = _decode(f.read())
+    if not text.strip():
+        raise ValueError("內容是空的")
+    if target == "kb":
+        from kb_manager import prepare_chunks
+    else:
+        from rag_store import prepare_chunks
+    return text, prepare_chunks(text)
+
+def _prepare_all(job_id, target, files):
+    """平行處理所有待處理檔案，結果放回各自的 dict（text / prepared 或 error）"""
+    pending = [f for f in files if f["status"] == "queued"]
+    if not pending:
+        return
+    last = time.time()
+
+    def done(f, result=None, error=None):
+        nonlocal last
+        if error is None:
+            f["text"], f["prepared"] = result
+            f["status"] = "prepared"
+        else:
+            f.update(status="error", error=str(error) or type(error).__name__)
+        if time.time() - last >= PROGRESS_EVERY:
+            last = time.time()
+            _save_job(job_id, files)
+
+    workers = min(WORKERS, len(pending))
+    if workers <= 1:
+        for f in pending:
+            try:
+                done(f, _prepare(target, f["path"]))
+            except Exception as e:
+                done(f, error=e)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_prepare, target, f["path"]): f for f in pending}
+        for fut in as_completed(futures):
+            err = fut.exception()
+            done(futures[fut], None if err else fut.result(), err)
+
+def _merge(target, options, files):
+    """所有處理成功的檔案在同一個 transaction 寫入（任何一筆失敗整批 rollback）"""
+    ready = [f for f in files if f["status"] == "prepared"]
+    if target == "kb":
+        from kb_manager import add_doc
+        with transaction():
+            for f in ready:
+                title = os.path.splitext(os.path.basename(f["name"]))[0]
+                f["id"] = add_doc(title, f["text"], options.get("category", "note"),
+                                  options.get("tags"), source=f["name"], prepared=f["prepared"])
+                f["chunks"] = len(f["prepared"])
+    else:
+        from rag_store import add_doc
+        with transaction():
+            for f in ready:
+                doc = add_doc(os.path.basename(f["name"]), f["text"], f["prepared"])
+                f["id"], f["chunks"] = doc["id"], doc["chunks"]
+                f["duplicate"] = doc["duplicate"]
+    for f in ready:
+        f["status"] = "duplicate" if f.get("duplicate") else "ok"
+        f.pop("text", None)
+        f.pop("prepared", None)
+
+def run_job(job_id, target, files, options=None):
+    options = options or {}
+    try:
+        _save_job(job_id, files, status="running")
+        _prepare_all(job_id, target, files)
+        _merge(target, options, files)
+        status, error = "done", None
+    except Exception as e:
+        for f in files:
+            if f["status"] == "prepared":
+                f.update(status="error", error="批次寫入失敗，已全部 rollback")
+            f.pop("text", None)
+            f.pop("prepared", None)
+        status, error = "failed", str(e)
+    finally:
+        shutil.rmtree(_job_dir(job_id), ignore_errors=True)
+    _save_job(job_id, files, status=status, error=error,
+              finished_at=time.strftime("%Y-%m-%d %H:%M:%S"))
+
+def start_job(job_id, target, files, options=None):
+    """背景執行緒跑 run_job，立即回傳"""
+    t = threading.Thread(target=run_job, args=(job_id, target, files, options),
+                         name=f"ingest-{job_id}", daemon=True)
+    t.start()
+    return t
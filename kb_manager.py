@@ -9,17 +9,29 @@ import os
 import math
 import re
 from datetime import datetime
-from collections import Counter
+from collections import Counter, defaultdict
+from db_pool import get_pool
+from database import apply_migrations, _column_names, create_version_triggers, get_version
+from chunk_store import ensure_chunks, write_chunks, drop_chunks, split_text
+import sparse_index
+import dense_index
+from query_cache import get_cache, normalize_query
 
 DB_PATH = os.path.join(os.path.dirname(__file__), "data", "chatroom.db")
 
-def get_conn():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+def connection():
+    """與 database.py 共用同一個連線池"""
+    return get_pool(DB_PATH).connection()
+
+def transaction():
+    return get_pool(DB_PATH).transaction()
 
 def init_kb():
-    conn = get_conn()
+    with transaction() as conn:
+        _create_schema(conn)
+        apply_migrations(conn, KB_MIGRATIONS)
+
+def _create_schema(conn):
     conn.execute("""
     CREATE TABLE IF NOT EXISTS kb_docs (
         id          INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -34,8 +46,100 @@ def init_kb():
     )""")
     conn.execute("CREATE INDEX IF NOT EXISTS idx_kb_category ON kb_docs(category)")
     conn.execute("CREATE INDEX IF NOT EXISTS idx_kb_active   ON kb_docs(is_active)")
-    conn.commit()
-    conn.close()
+
+def _m_kb_index(conn):
+    """
+    倒排索引：term → (category, doc_id, chunk_id, tf)
+    - 主鍵以 (term, category) 開頭，查詢只掃描查詢詞（與分類）那一段
+    - chunk_id=0 代表標題欄位
+    - 只收錄 is_active=1 的文件
+    """
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS kb_chunks (
+        id          INTEGER PRIMARY KEY,
+        doc_id      INTEGER NOT NULL,
+        ordinal     INTEGER NOT NULL,
+        text        TEXT    NOT NULL,
+        n_tokens    INTEGER NOT NULL
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_kb_chunks_doc ON kb_chunks(doc_id)")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS kb_postings (
+        term        TEXT    NOT NULL,
+        category    TEXT    NOT NULL,
+        doc_id      INTEGER NOT NULL,
+        chunk_id    INTEGER NOT NULL,
+        tf          INTEGER NOT NULL,
+        PRIMARY KEY (term, category, doc_id, chunk_id)
+    ) WITHOUT ROWID""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_kb_postings_doc ON kb_postings(doc_id)")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS kb_doc_stats (
+        doc_id      INTEGER PRIMARY KEY,
+        category    TEXT    NOT NULL,
+        title_len   INTEGER NOT NULL,
+        body_len    INTEGER NOT NULL
+    )""")
+
+def _m_kb_bm25(conn):
+    """
+    BM25 所需的語料統計，隨索引增量維護
+    - kb_term_stats：(term, category) → df（含該詞的文件數）
+    - kb_corpus_stats：每個分類的文件數、標題 / 內文總長、段落數（kb_doc_stats 的 trigger 維護）
+    """
+    if "n_chunks" not in _column_names(conn, "kb_doc_stats"):
+        conn.execute("ALTER TABLE kb_doc_stats ADD COLUMN n_chunks INTEGER NOT NULL DEFAULT 0")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS kb_term_stats (
+        term        TEXT    NOT NULL,
+        category    TEXT    NOT NULL,
+        df          INTEGER NOT NULL,
+        PRIMARY KEY (term, category)
+    ) WITHOUT ROWID""")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS kb_corpus_stats (
+        category    TEXT    PRIMARY KEY,
+        n_docs      INTEGER NOT NULL DEFAULT 0,
+        title_len   INTEGER NOT NULL DEFAULT 0,
+        body_len    INTEGER NOT NULL DEFAULT 0,
+        n_chunks    INTEGER NOT NULL DEFAULT 0
+    )""")
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_kb_doc_stats_ins AFTER INSERT ON kb_doc_stats BEGIN
+        INSERT INTO kb_corpus_stats (category, n_docs, title_len, body_len, n_chunks)
+        VALUES (NEW.category, 1, NEW.title_len, NEW.body_len, NEW.n_chunks)
+        ON CONFLICT(category) DO UPDATE SET
+            n_docs    = n_docs + 1,
+            title_len = title_len + NEW.title_len,
+            body_len  = body_len + NEW.body_len,
+            n_chunks  = n_chunks + NEW.n_chunks;
+    END""")
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_kb_doc_stats_del AFTER DELETE ON kb_doc_stats BEGIN
+        UPDATE kb_corpus_stats SET
+            n_docs    = n_docs - 1,
+            title_len = title_len - OLD.title_len,
+            body_len  = body_len - OLD.body_len,
+            n_chunks  = n_chunks - OLD.n_chunks
+        WHERE category = OLD.category;
+    END""")
+    _reindex_all(conn)
+
+def _m_kb_chunk_store(conn):
+    """段落改存共用的 chunks 表（source='kb'），postings.chunk_id 指向 chunks.id"""
+    conn.execute("DROP TABLE IF EXISTS kb_chunks")
+    _reindex_all(conn)
+
+def _m_kb_index_version(conn):
+    """索引有任何變動時 change_versions['kb_index'] 加一（稀疏矩陣 / 查詢快取用來判斷過期）"""
+    create_version_triggers(conn, "kb_doc_stats", "kb_index")
+
+KB_MIGRATIONS = [
+    ("011_kb_index", _m_kb_index),
+    ("012_kb_bm25",  _m_kb_bm25),
+    ("013_kb_chunk_store", _m_kb_chunk_store),
+    ("015_kb_index_version", _m_kb_index_version),
+]
 
 # ── 分類定義 ──
 CATEGORIES = {
@@ -49,16 +153,15 @@ CATEGORIES = {
 # ══════════════════════════════════════
 # CRUD
 # ══════════════════════════════════════
-def add_doc(title, content, category="note", tags=None, source=None):
-    conn = get_conn()
-    c = conn.execute(
-        "INSERT INTO kb_docs (title,content,category,tags,source) VALUES (?,?,?,?,?)",
-        (title, content, category, json.dumps(tags or []), source)
-    )
-    doc_id = c.lastrowid
-    conn.commit()
-    conn.close()
-    return doc_id
+def add_doc(title, content, category="note", tags=None, source=None, prepared=None):
+    """prepared：prepare_chunks(content) 的結果（批次匯入在 worker 行程先算好）"""
+    with transaction() as conn:
+        c = conn.execute(
+            "INSERT INTO kb_docs (title,content,category,tags,source) VALUES (?,?,?,?,?)",
+            (title, content, category, json.dumps(tags or []), source)
+        )
+        _index_doc(conn, c.lastrowid, prepared)
+        return c.lastrowid
 
 def update_doc(doc_id, **kwargs):
     if "tags" in kwargs:
@@ -66,21 +169,20 @@ def update_doc(doc_id, **kwargs):
     kwargs["updated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     sets = ", ".join(f"{k}=?" for k in kwargs)
     vals = list(kwargs.values()) + [doc_id]
-    conn = get_conn()
-    conn.execute(f"UPDATE kb_docs SET {sets} WHERE id=?", vals)
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute(f"UPDATE kb_docs SET {sets} WHERE id=?", vals)
+        if INDEXED_FIELDS & kwargs.keys():
+            _index_doc(conn, doc_id)
 
 def delete_doc(doc_id):
-    conn = get_conn()
-    conn.execute("DELETE FROM kb_docs WHERE id=?", (doc_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("DELETE FROM kb_docs WHERE id=?", (doc_id,))
+        _unindex_doc(conn, doc_id)
+        drop_chunks(conn, "kb", doc_id)
 
 def get_doc(doc_id):
-    conn = get_conn()
-    row = conn.execute("SELECT * FROM kb_docs WHERE id=?", (doc_id,)).fetchone()
-    conn.close()
+    with connection() as conn:
+        row = conn.execute("SELECT * FROM kb_docs WHERE id=?", (doc_id,)).fetchone()
     if not row:
         return None
     d = dict(row)
@@ -88,7 +190,6 @@ def get_doc(doc_id):
     return d
 
 def list_docs(category=None, active_only=True, limit=200):
-    conn = get_conn()
     q = "SELECT id,title,category,tags,source,is_active,created_at,updated_at, substr(content,1,120) as preview FROM kb_docs WHERE 1=1"
     params = []
     if active_only:
@@ -97,8 +198,8 @@ def list_docs(category=None, active_only=True, limit=200):
         q += " AND category=?"; params.append(category)
     q += " ORDER BY category, updated_at DESC LIMIT ?"
     params.append(limit)
-    rows = conn.execute(q, params).fetchall()
-    conn.close()
+    with connection() as conn:
+        rows = conn.execute(q, params).fetchall()
     result = []
     for r in rows:
         d = dict(r)
@@ -108,13 +209,12 @@ def list_docs(category=None, active_only=True, limit=200):
     return result
 
 def get_kb_stats():
-    conn = get_conn()
-    rows = conn.execute("""
-        SELECT category, COUNT(*) as cnt
-        FROM kb_docs WHERE is_active=1
-        GROUP BY category
-    """).fetchall()
-    conn.close()
+    with connection() as conn:
+        rows = conn.execute("""
+            SELECT category, COUNT(*) as cnt
+            FROM kb_docs WHERE is_active=1
+            GROUP BY category
+        """).fetchall()
     stats = {cat: 0 for cat in CATEGORIES}
     for r in rows:
         stats[r["category"]] = r["cnt"]
@@ -125,7 +225,6 @@ def get_kb_stats():
 # 全文搜尋
 # ══════════════════════════════════════
 def fulltext_search(query, category=None, limit=10):
-    conn = get_conn()
     q = """
         SELECT id, title, category, tags, created_at,
                substr(content,1,200) as preview,
@@ -138,8 +237,8 @@ def fulltext_search(query, category=None, limit=10):
         q += " AND category=?"; params.append(category)
     q += " ORDER BY title_match DESC, updated_at DESC LIMIT ?"
     params.append(limit)
-    rows = conn.execute(q, params).fetchall()
-    conn.close()
+    with connection() as conn:
+        rows = conn.execute(q, params).fetchall()
     result = []
     for r in rows:
         d = dict(r)
@@ -161,83 +260,312 @@ def _tokenize(text):
     bigrams = [''.join(cjk[i:i+2]) for i in range(len(cjk)-1)]
     return words + cjk + bigrams
 
-def _tfidf_score(query_tokens, doc_tokens):
-    if not doc_tokens:
-        return 0.0
-    doc_freq = Counter(doc_tokens)
-    total = len(doc_tokens)
-    score = 0.0
-    for tok in query_tokens:
-        tf = doc_freq.get(tok, 0) / total
-        score += tf
-    return score
-
-def semantic_search(query, category=None, top_k=5, active_only=True):
-    """給 AI 使用的語意搜尋，回傳最相關的段落"""
-    conn = get_conn()
-    q = "SELECT id, title, content, category FROM kb_docs WHERE is_active=1"
-    params = []
-    if category:
-        q += " AND category=?"; params.append(category)
-    rows = conn.execute(q, params).fetchall()
-    conn.close()
+def _idf(df, n):
+    return math.log(1 + (n - df + 0.5) / (df + 0.5))
 
-    if not rows:
-        return []
+def _bm25_tf(tf, length, avg, b):
+    """長度正規化後的詞頻（BM25F 各欄位先正規化再加權合併）"""
+    return tf / ((1 - b) + b * length / avg) if avg else 0.0
 
-    query_tokens = _tokenize(query)
-    if not query_tokens:
-        return []
+def _partition(conn, category, terms=None):
+    """
+    讀取分類（None = 全部）的語料統計與 postings；terms 為 None 時讀整個分類（建矩陣用）
+    回傳 (corpus, df, rows)
+    """
+    cat_sql, cat_params = (" AND category=?", [category]) if category else ("", [])
+    term_sql, term_params = "", []
+    if terms is not None:
+        term_sql, term_params = f" AND term IN ({','.join('?' * len(terms))})", list(terms)
+    corpus = conn.execute(f"""
+        SELECT COALESCE(SUM(n_docs),0) AS n, COALESCE(SUM(title_len),0) AS tl,
+               COALESCE(SUM(body_len),0) AS bl, COALESCE(SUM(n_chunks),0) AS nc
+        FROM kb_corpus_stats WHERE 1=1{cat_sql}""", cat_params).fetchone()
+    df = {r["term"]: r["df"] for r in conn.execute(
+        f"SELECT term, SUM(df) AS df FROM kb_term_stats WHERE 1=1{term_sql}{cat_sql} GROUP BY term",
+        term_params + cat_params)}
+    rows = conn.execute(f"""
+        SELECT p.term, p.doc_id, p.chunk_id, p.tf,
+               s.title_len, s.body_len, c.n_tokens
+        FROM kb_postings p
+        JOIN kb_doc_stats s ON s.doc_id = p.doc_id
+        LEFT JOIN chunks c ON c.id = p.chunk_id
+        WHERE 1=1{term_sql.replace("term", "p.term", 1)}{cat_sql.replace("category", "p.category")}
+    """, term_params + cat_params).fetchall()
+    return corpus, df, rows
+
+def _bm25_weights(corpus, df, rows):
+    """
+    每個 (文件, 詞) 的 BM25F 權重與每個 (段落, 詞) 的 BM25 權重（不含查詢詞頻）
+    查詢分數 = Σ 查詢詞頻 × 權重，所以同一份權重可以直接放進稀疏矩陣
+    """
+    n = corpus["n"]
+    avg_title, avg_body = corpus["tl"] / n, corpus["bl"] / n
+    avg_chunk = corpus["bl"] / corpus["nc"] if corpus["nc"] else 0
+    idf = {t: _idf(d, n) for t, d in df.items()}
 
-    scored = []
-    for row in rows:
-        doc_tokens = _tokenize(row["title"] * 3 + " " + row["content"])
-        score = _tfidf_score(query_tokens, doc_tokens)
-        if score > 0:
-            # 切成段落
-            chunks = _chunk_text(row["content"], 400)
-            best_chunk = ""
-            best_score = 0
-            for chunk in chunks:
-                chunk_score = _tfidf_score(query_tokens, _tokenize(chunk))
-                if chunk_score > best_score:
-                    best_score = chunk_score
-                    best_chunk = chunk
-            scored.append({
-                "id": row["id"],
-                "title": row["title"],
-                "category": row["category"],
-                "chunk": best_chunk or row["content"][:400],
-                "score": score,
-            })
-
-    scored.sort(key=lambda x: x["score"], reverse=True)
-    return scored[:top_k]
-
-def _chunk_text(text, size=400):
-    paragraphs = [p.strip() for p in text.split('\n') if p.strip()]
-    chunks, cur = [], ""
-    for para in paragraphs:
-        if len(cur) + len(para) < size:
-            cur += para + "\n"
+    doc_tf   = defaultdict(float)          # (doc_id, term) → 兩個欄位加權合併的詞頻
+    chunk_w  = {}                          # (doc_id, chunk_id, term) → 權重
+    for r in rows:
+        t = r["term"]
+        if r["chunk_id"] == 0:
+            doc_tf[(r["doc_id"], t)] += TITLE_WEIGHT * _bm25_tf(r["tf"], r["title_len"], avg_title, B_TITLE)
         else:
-            if cur:
-                chunks.append(cur.strip())
-            cur = para + "\n"
-    if cur:
-        chunks.append(cur.strip())
-    return chunks or [text[:size]]
-
-def build_kb_context(query, category=None, top_k=5):
-    """組合給 AI 的知識庫背景"""
-    results = semantic_search(query, category=category, top_k=top_k)
+            doc_tf[(r["doc_id"], t)] += _bm25_tf(r["tf"], r["body_len"], avg_body, B_BODY)
+            ctf = _bm25_tf(r["tf"], r["n_tokens"], avg_chunk, B_BODY)
+            chunk_w[(r["doc_id"], r["chunk_id"], t)] = idf.get(t, 0) * ctf * (K1 + 1) / (ctf + K1)
+    doc_w = {k: idf.get(k[1], 0) * tf * (K1 + 1) / (tf + K1) for k, tf in doc_tf.items()}
+    return doc_w, chunk_w
+
+def _rank_postings(qtf, category, top_k):
+    """只讀查詢詞的 postings（沒有 NumPy 時的路徑）"""
+    terms = list(qtf)[:MAX_QUERY_TERMS]
+    with connection() as conn:
+        corpus, df, rows = _partition(conn, category, terms)
+    if not corpus["n"] or not df:
+        return [], {}
+    doc_w, chunk_w = _bm25_weights(corpus, df, rows)
+    doc_score = defaultdict(float)
+    for (doc_id, t), w in doc_w.items():
+        doc_score[doc_id] += qtf[t] * w
+    chunk_sc = defaultdict(float)
+    for (doc_id, chunk_id, t), w in chunk_w.items():
+        chunk_sc[(doc_id, chunk_id)] += qtf[t] * w
+    top = sorted(doc_score.items(), key=lambda x: (-x[1], x[0]))[:top_k]
+    best = {}
+    for (doc_id, chunk_id), sc in chunk_sc.items():
+        if sc > best.get(doc_id, (0, 0))[1]:
+            best[doc_id] = (chunk_id, sc)
+    return top, best
+
+def _kb_matrix(category):
+    """分類的稀疏矩陣：文件列（BM25F）+ 段落列（BM25），kb_index 版本變了才重建"""
+    def build():
+        with connection() as conn:
+            corpus, df, rows = _partition(conn, category)
+        doc_w, chunk_w = _bm25_weights(corpus, df, rows) if corpus["n"] else ({}, {})
+        vecs = defaultdict(dict)
+        for (doc_id, t), w in doc_w.items():
+            vecs[(0, doc_id, doc_id)][t] = w
+        for (doc_id, chunk_id, t), w in chunk_w.items():
+            vecs[(1, doc_id, chunk_id)][t] = w
+        keys = sorted(vecs)
+        return sparse_index.SparseIndex.build(
+            [k[2] for k in keys], [vecs[k] for k in keys],
+            extra={"is_chunk": [k[0] == 1 for k in keys], "doc": [k[1] for k in keys]})
+    return sparse_index.get_index(f"kb_{category or '_all'}", get_version("kb_index"), build)
+
+def _rank_sparse(qtf, category, top_k):
+    import numpy as np
+    idx = _kb_matrix(category)
+    scores = idx.matvec(qtf)
+    if scores is None:
+        return [], {}
+    is_chunk = np.asarray(idx.extra["is_chunk"])
+    top = [(idx.rows[i], sc) for i, sc in idx.topk(scores, top_k, ~is_chunk)]
+    best = {}
+    cand = np.nonzero(is_chunk & (scores > 0) & np.isin(idx.extra["doc"], [d for d, _ in top]))[0]
+    for i in cand:
+        doc_id, sc = int(idx.extra["doc"][i]), float(scores[i])
+        if sc > best.get(doc_id, (0, 0))[1]:
+            best[doc_id] = (idx.rows[i], sc)
+    return top, best
+
+def _kb_dense(category):
+    """分類內全部段落的 hashed embedding（標題 + 段落），kb_index 版本變了才重建"""
+    def build():
+        cat_sql, cat_params = (" AND s.category=?", [category]) if category else ("", [])
+        with connection() as conn:
+            rows = conn.execute(f"""
+                SELECT c.id, s.doc_id, d.title, c.text
+                FROM kb_doc_stats s
+                JOIN kb_docs d ON d.id = s.doc_id
+                JOIN chunks c ON c.source = 'kb' AND c.doc_id = CAST(s.doc_id AS TEXT)
+                WHERE 1=1{cat_sql}
+                ORDER BY c.id
+            """, cat_params).fetchall()
+        return dense_index.DenseIndex.build(
+            [r["id"] for r in rows], [f"{r['title']}\n{r['text']}" for r in rows],
+            extra={"doc": [r["doc_id"] for r in rows]})
+    return sparse_index.get_index(f"dense_kb_{category or '_all'}", get_version("kb_index"),
+                                  build, dense_index.DenseIndex)
+
+def _rank_dense(query, category, top_k):
+    """段落向量相似度；文件分數 = 最相似段落的分數"""
+    idx = _kb_dense(category)
+    best = {}
+    for i, sc in idx.search(query, top_k * 4):
+        doc_id = int(idx.extra["doc"][i])
+        if sc > best.get(doc_id, (0, 0))[1]:
+            best[doc_id] = (idx.rows[i], sc)
+    top = sorted(((d, sc) for d, (_, sc) in best.items()), key=lambda x: (-x[1], x[0]))[:top_k]
+    return top, best
+
+def _rank_keyword(qtf, category, top_k):
+    if not qtf:
+        return [], {}
+    if sparse_index.enabled():
+        return _rank_sparse(qtf, category, top_k)
+    return _rank_postings(qtf, category, top_k)
+
+def semantic_search(query, category=None, top_k=5, active_only=True, mode=None):
+    """
+    給 AI 使用的語意搜尋（BM25F：標題 / 內文分開正規化再加權），回傳最相關的段落
+    只讀查詢詞的 postings 與預先算好的語料統計；每筆附上最佳段落的 BM25 分數 chunk_score
+    有 NumPy 時改用預先算好權重的稀疏矩陣（sparse_index），排序結果相同
+    mode：keyword（預設）/ dense（hashed embedding）/ hybrid（兩者分數融合），見 dense_index
+    結果依 (查詢, 分類, top_k, 模式, kb_index 版本) 快取，文件有任何異動版本就會變
+    """
+    mode = dense_index.resolve_mode(mode)
+    key = (normalize_query(query), category, top_k, mode, get_version("kb_index"))
+    def compute():
+        sparse_index.take_stale()
+        return _semantic_search(query, category, top_k, mode)
+    # 索引重建中用舊版本算出的結果不存（key 已經是新版本號）
+    results = _query_cache.get_or_compute(key, compute, cacheable=lambda: not sparse_index.take_stale())
+    return [dict(r) for r in results]
+
+_query_cache = get_cache("kb")
+
+def _semantic_search(query, category, top_k, mode):
+    qtf = Counter(_tokenize(query))
+    if mode == "keyword":
+        top, best = _rank_keyword(qtf, category, top_k)
+    elif mode == "dense":
+        top, best = _rank_dense(query, category, top_k)
+    else:
+        k_top, k_best = _rank_keyword(qtf, category, top_k * 3)
+        d_top, d_best = _rank_dense(query, category, top_k * 3)
+        top = dense_index.fuse(dict(k_top), dict(d_top))[:top_k]
+        best = {**d_best, **k_best}
+    if not top:
+        return []
+
+    ids = [d for d, _ in top]
+    chunk_ids = [best[d][0] for d in ids if d in best]
+    with connection() as conn:
+        docs = {r["id"]: r for r in conn.execute(
+            f"SELECT id, title, category, substr(content,1,400) AS head FROM kb_docs WHERE id IN ({','.join('?' * len(ids))})", ids)}
+        texts = {r["id"]: r["text"] for r in conn.execute(
+            f"SELECT id, text FROM chunks WHERE id IN ({','.join('?' * len(chunk_ids))})", chunk_ids)}
+
+    results = []
+    for doc_id, score in top:
+        d = docs.get(doc_id)
+        if not d:
+            continue
+        chunk_id, chunk_score = best.get(doc_id, (None, 0.0))
+        results.append({
+            "id": doc_id,
+            "title": d["title"],
+            "category": d["category"],
+            "chunk": texts.get(chunk_id) or d["head"],
+            "score": score,
+            "chunk_score": chunk_score,
+        })
+    return results
+
+# ══════════════════════════════════════
+# 倒排索引維護（與 kb_docs 寫入同一個 transaction）
+# ══════════════════════════════════════
+CHUNK_SIZE      = 400
+TITLE_WEIGHT    = 3      # BM25F 欄位權重（內文 = 1）
+K1              = 1.2
+B_TITLE         = 0.3    # 標題長度差異小，正規化弱一點
+B_BODY          = 0.75
+MAX_QUERY_TERMS = 200
+INDEXED_FIELDS  = {"title", "content", "category", "is_active"}
+
+def _unindex_doc(conn, doc_id):
+    st = conn.execute("SELECT category FROM kb_doc_stats WHERE doc_id=?", (doc_id,)).fetchone()
+    if st:
+        terms = [(t, st["category"]) for (t,) in conn.execute(
+            "SELECT DISTINCT term FROM kb_postings WHERE doc_id=?", (doc_id,))]
+        conn.executemany("UPDATE kb_term_stats SET df=df-1 WHERE term=? AND category=?", terms)
+        conn.executemany("DELETE FROM kb_term_stats WHERE term=? AND category=? AND df<=0", terms)
+    conn.execute("DELETE FROM kb_postings   WHERE doc_id=?", (doc_id,))
+    conn.execute("DELETE FROM kb_doc_stats  WHERE doc_id=?", (doc_id,))
+
+def prepare_chunks(content):
+    """切段 + 斷詞，回傳 [(start, end, n_tokens, {term: tf}), ...]；不碰資料庫，可在其他行程執行"""
+    out = []
+    for start, end in split_text(content, CHUNK_SIZE):
+        tf = Counter(_tokenize(content[start:end]))
+        out.append((start, end, sum(tf.values()), dict(tf)))
+    return out
+
+def _index_doc(conn, doc_id, prepared=None):
+    """
+    重建單一文件的 postings 與語料統計；停用或已刪除的文件只清除
+    段落存在 chunks 表，內容沒變（只改標題 / 分類 / 啟用狀態）時不重切
+    prepared：prepare_chunks() 的結果，有的話直接寫入段落與詞頻
+    """
+    _unindex_doc(conn, doc_id)
+    row = conn.execute(
+        "SELECT title, content, category, is_active FROM kb_docs WHERE id=?", (doc_id,)
+    ).fetchone()
+    if not row or not row["is_active"]:
+        return
+    cat = row["category"]
+    title_tf = Counter(_tokenize(row["title"]))
+    postings = [(t, cat, doc_id, 0, n) for t, n in title_tf.items()]
+    if prepared is None:
+        chunks = ensure_chunks(conn, "kb", doc_id, row["content"],
+                               lambda c: len(_tokenize(c)), CHUNK_SIZE)
+        tfs = [Counter(_tokenize(chunk)) for _, chunk, _ in chunks]
+    else:
+        chunks = write_chunks(conn, "kb", doc_id, row["content"],
+                              [p[:3] for p in prepared], CHUNK_SIZE)
+        tfs = [p[3] for p in prepared]
+    body_len, n_chunks = 0, len(chunks)
+    for (cid, chunk, n_tokens), tf in zip(chunks, tfs):
+        body_len += n_tokens
+        postings += [(t, cat, doc_id, cid, n) for t, n in tf.items()]
+    conn.executemany(
+        "INSERT INTO kb_postings (term, category, doc_id, chunk_id, tf) VALUES (?,?,?,?,?)", postings
+    )
+    conn.executemany("""
+        INSERT INTO kb_term_stats (term, category, df) VALUES (?, ?, 1)
+        ON CONFLICT(term, category) DO UPDATE SET df = df + 1
+    """, [(t, cat) for t in {p[0] for p in postings}])
+    conn.execute(
+        "INSERT INTO kb_doc_stats (doc_id, category, title_len, body_len, n_chunks) VALUES (?,?,?,?,?)",
+        (doc_id, cat, sum(title_tf.values()), body_len, n_chunks)
+    )
+
+def _reindex_all(conn):
+    for table in ("kb_postings", "kb_doc_stats", "kb_term_stats", "kb_corpus_stats"):
+        conn.execute(f"DELETE FROM {table}")
+    ids = [r[0] for r in conn.execute("SELECT id FROM kb_docs WHERE is_active=1").fetchall()]
+    for doc_id in ids:
+        _index_doc(conn, doc_id)
+    return len(ids)
+
+def rebuild_index():
+    """整個重建（分詞 / 切段規則變更後使用），回傳收錄文件數"""
+    with transaction() as conn:
+        return _reindex_all(conn)
+
+MIN_REL_SCORE = 0.35   # 低於第一名分數此比例的結果不送進 prompt
+
+def build_kb_context(query, category=None, top_k=5, min_rel_score=MIN_REL_SCORE, mode=None, budget=None):
+    """
+    組合給 AI 的知識庫背景（mode 見 semantic_search）
+    budget：token 上限（預設 context_packer.SOURCE_BUDGET），近似重複的段落丟掉、超出的截到句子邊界
+    """
+    from context_packer import pack, SOURCE_BUDGET
+    results = semantic_search(query, category=category, top_k=top_k, mode=mode)
+    if not results:
+        return ""
+    cutoff = results[0]["score"] * min_rel_score
+    results, _ = pack([dict(r, source="kb", text=r["chunk"]) for r in results if r["score"] >= cutoff],
+                      budget or SOURCE_BUDGET)
     if not results:
         return ""
     lines = ["【知識庫相關資料】"]
     for r in results:
         cat_info = CATEGORIES.get(r["category"], CATEGORIES["other"])
         lines.append(f"\n▍{cat_info['icon']} {r['title']}（{cat_info['label']}）")
-        lines.append(r["chunk"])
+        lines.append(r["text"])
     return "\n".join(lines)
 
 # ── 快速匯入 ──
@@ -0,0 +1,85 @@
+"""
+query_cache.py — 檢索結果快取（KB semantic_search / RAG search 共用）
+- key = (正規化查詢, 文件集合 / 分類, 模式…, 語料版本)；版本來自 change_versions
+  （kb_index / rag_index，由 trigger 在新增 / 修改 / 刪除時加一），版本變了舊結果自然不再命中
+- 容量上限（LRU 淘汰）+ TTL；每個行程各自一份，版本號跨行程共用所以不會讀到過期結果
+- stats() 給 /ai/db/retrieval 看命中率調參數
+"""
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+
+CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE", 256))
+CACHE_TTL  = float(os.environ.get("QUERY_CACHE_TTL", 300))     # 秒；0 = 停用快取
+
+_SPACE = re.compile(r"\s+")
+
+def normalize_query(query):
+    """大小寫、前後空白、連續空白不影響斷詞結果，視為同一個查詢"""
+    return _SPACE.sub(" ", (query or "").strip().lower())
+
+class QueryCache:
+    def __init__(self, name, capacity=CACHE_SIZE, ttl=CACHE_TTL):
+        self.name     = name
+        self.capacity = capacity
+        self.ttl      = ttl
+        self._items   = OrderedDict()      # key → (存入時間, 結果)
+        self._lock    = threading.Lock()
+        self._stats   = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0}
+
+    def get_or_compute(self, key, compute, cacheable=None):
+        """
+        命中就回傳快取；否則呼叫 compute() 並存起來（compute 期間不持有鎖）
+        cacheable()：compute 之後回傳 False 就不存（例如這次用的是重建中的舊索引）
+        """
+        if self.capacity <= 0 or self.ttl <= 0:
+            return compute()
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                if now - item[0] < self.ttl:
+                    self._items.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return item[1]
+                del self._items[key]
+                self._stats["expired"] += 1
+            self._stats["misses"] += 1
+        value = compute()
+        if cacheable is not None and not cacheable():
+            return value
+        with self._lock:
+            self._items[key] = (now, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+                self._stats["evictions"] += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s.update(size=len(self._items), capacity=self.capacity, ttl=self.ttl)
+        lookups = s["hits"] + s["misses"]
+        s["hit_rate"] = round(s["hits"] / lookups, 3) if lookups else 0.0
+        return s
+
+_caches = {}
+_lock   = threading.Lock()
+
+def get_cache(name):
+    with _lock:
+        if name not in _caches:
+            _caches[name] = QueryCache(name)
+        return _caches[name]
+
+def cache_stats():
+    with _lock:
+        caches = list(_caches.values())
+    return {c.name: c.stats() for c in caches}
@@ -0,0 +1,472 @@
+"""
+rag_store.py — RAG 文件的儲存與檢索索引
+- 文件資料在 rag_docs 表（id 唯一，多筆刪除在同一個 transaction）
+- 內文存在以 sha256 命名的 blob（data/rag_blobs/ab/abcd….txt），同內容只存一份
+- 索引以內容 hash 為 key：重複上傳同一份內容不再切段 / 建索引，最後一份刪掉才清除
+- 上傳時切段（chunk_store）並把每個段落的詞頻寫進 rag_postings
+- 查詢只讀「選定文件 × 查詢詞」的 postings；df 即命中段落數，不必掃全文
+- 常用文件的索引放在記憶體 LRU，以 chunk_docs.content_hash 判斷是否過期
+  （上傳 / 刪除時本行程直接失效，其他行程在下次查詢時發現 hash 變了）
+"""
+import os
+import re
+import json
+import math
+import time
+import uuid
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+from database import connection, transaction, get_version, apply_migrations, DB_PATH
+from chunk_store import ensure_chunks, write_chunks, drop_chunks, split_text
+import sparse_index
+import dense_index
+from query_cache import get_cache, normalize_query
+
+DATA_DIR      = os.path.dirname(DB_PATH)
+BLOB_DIR      = os.path.join(DATA_DIR, "rag_blobs")
+LEGACY_INDEX  = os.path.join(DATA_DIR, "rag_index.json")
+LEGACY_DIR    = os.path.join(DATA_DIR, "rag_docs")
+
+CHUNK_SIZE    = 400
+CHUNK_OVERLAP = 80
+LRU_DOCS      = 32
+TOP_K         = 4
+
+def tokenize(text):
+    """簡單斷詞（支援中英文）"""
+    return re.findall(r'[\u4e00-\u9fff]|[a-zA-Z0-9]+', text.lower())
+
+# ══════════════════════════════════════
+# Blob（內容定址）
+# ══════════════════════════════════════
+def blob_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def _blob_path(h):
+    return os.path.join(BLOB_DIR, h[:2], f"{h}.txt")
+
+def put_blob(text):
+    """寫入 blob（已存在就跳過），回傳 hash"""
+    h = blob_hash(text)
+    path = _blob_path(h)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+    return h
+
+def read_blob(h):
+    with open(_blob_path(h), "r", encoding="utf-8") as f:
+        return f.read()
+
+def _remove_blob(h):
+    try:
+        os.remove(_blob_path(h))
+    except OSError:
+        pass
+
+# ══════════════════════════════════════
+# 文件資料
+# ══════════════════════════════════════
+def _m_rag_docs(conn):
+    """rag_index.json → rag_docs；舊的 data/rag_docs/*.txt 搬進 blob，索引改以內容 hash 為 key"""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS rag_docs (
+        id          TEXT    PRIMARY KEY,
+        name        TEXT    NOT NULL,
+        blob_hash   TEXT    NOT NULL,
+        size        INTEGER NOT NULL,
+        chunks      INTEGER NOT NULL DEFAULT 0,
+        uploaded    TEXT    NOT NULL
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_rag_docs_hash ON rag_docs(blob_hash)")
+    # 舊索引以 doc id 為 key，清掉讓查詢時依 hash 重建
+    conn.execute("DELETE FROM rag_postings")
+    conn.execute("DELETE FROM chunks     WHERE source='rag'")
+    conn.execute("DELETE FROM chunk_docs WHERE source='rag'")
+    try:
+        with open(LEGACY_INDEX, "r", encoding="utf-8") as f:
+            legacy = json.load(f)
+    except (OSError, ValueError):
+        return
+    for d in legacy:
+        try:
+            with open(os.path.join(LEGACY_DIR, d["filename"]), "r", encoding="utf-8") as f:
+                text = f.read()
+        except (OSError, KeyError):
+            continue
+        conn.execute(
+            "INSERT OR IGNORE INTO rag_docs (id, name, blob_hash, size, chunks, uploaded) VALUES (?,?,?,?,?,?)",
+            (d["id"], d.get("name") or d["id"], put_blob(text), len(text), d.get("chunks") or 0,
+             d.get("uploaded") or time.strftime("%Y-%m-%d %H:%M"))
+        )
+    os.replace(LEGACY_INDEX, LEGACY_INDEX + ".migrated")
+
+RAG_MIGRATIONS = [
+    ("017_rag_docs", _m_rag_docs),
+]
+
+def init_rag():
+    with transaction() as conn:
+        apply_migrations(conn, RAG_MIGRATIONS)
+
+def list_docs():
+    with connection() as conn:
+        rows = conn.execute(
+            "SELECT id, name, size, chunks, uploaded, blob_hash FROM rag_docs ORDER BY uploaded, rowid"
+        ).fetchall()
+    return [dict(r) for r in rows]
+
+def add_doc(name, text, prepared=None):
+    """
+    新增文件，回傳文件 dict（duplicate=True 表示內容已存在，沿用既有索引）
+    id 用 uuid，同一秒內多次上傳也不會撞號
+    prepared：prepare_chunks(text) 的結果（批次匯入在 worker 行程先算好）
+    """
+    h = blob_hash(text)
+    with transaction() as conn:
+        row = conn.execute(
+            "SELECT n_chunks FROM chunk_docs WHERE source='rag' AND doc_id=?", (h,)
+        ).fetchone()
+        duplicate = row is not None
+        n_chunks = row["n_chunks"] if duplicate else index_doc(h, text, prepared)
+        doc = {"id": f"doc_{uuid.uuid4().hex[:12]}", "name": name, "size": len(text),
+               "chunks": n_chunks, "uploaded": time.strftime("%Y-%m-%d %H:%M"), "blob_hash": h}
+        conn.execute(
+            "INSERT INTO rag_docs (id, name, blob_hash, size, chunks, uploaded) VALUES (?,?,?,?,?,?)",
+            (doc["id"], name, h, doc["size"], n_chunks, doc["uploaded"])
+        )
+        # 引用寫入後（已持有 SQLite 寫入鎖）才寫 blob：delete_docs 刪檔也在寫入鎖內，
+        # 跨行程也不會在兩者之間被刪掉；它若剛刪掉同一份內容，這裡會重新寫回
+        put_blob(text)
+    doc["duplicate"] = duplicate
+    return doc
+
+def delete_docs(doc_ids):
+    """一次刪除多份文件（同一個 transaction），內容沒有其他文件引用時連索引與 blob 一起清掉"""
+    doc_ids = list(doc_ids)
+    if not doc_ids:
+        return 0
+    marks = ",".join("?" * len(doc_ids))
+    with transaction() as conn:
+        hashes = {r[0] for r in conn.execute(
+            f"SELECT blob_hash FROM rag_docs WHERE id IN ({marks})", doc_ids)}
+        n = conn.execute(f"DELETE FROM rag_docs WHERE id IN ({marks})", doc_ids).rowcount
+        orphans = [h for h in hashes if not conn.execute(
+            "SELECT 1 FROM rag_docs WHERE blob_hash=? LIMIT 1", (h,)).fetchone()]
+        for h in orphans:
+            drop_doc(h)
+    if orphans:
+        # 刪檔前在寫入 transaction（BEGIN IMMEDIATE）裡重新確認沒有引用：commit 後可能有
+        # add_doc（任何行程）上傳同一份內容，它插入引用與寫 blob 都在同一把寫入鎖內
+        with transaction() as conn:
+            if not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+            for h in orphans:
+                if not conn.execute("SELECT 1 FROM rag_docs WHERE blob_hash=? LIMIT 1", (h,)).fetchone():
+                    _remove_blob(h)
+    return n
+
+def doc_keys(doc_ids=None):
+    """文件 id → 索引 key（內容 hash）；doc_ids 為 None 時取全部"""
+    q, params = "SELECT DISTINCT blob_hash FROM rag_docs", []
+    if doc_ids is not None:
+        doc_ids = list(doc_ids)
+        if not doc_ids:
+            return []
+        q += f" WHERE id IN ({','.join('?' * len(doc_ids))})"
+        params = doc_ids
+    with connection() as conn:
+        return [r[0] for r in conn.execute(q, params)]
+
+# ══════════════════════════════════════
+# 建立 / 刪除索引（key = 內容 hash）
+# ══════════════════════════════════════
+def prepare_chunks(text):
+    """切段 + 斷詞，回傳 [(start, end, n_tokens, {term: tf}), ...]；不碰資料庫，可在其他行程執行"""
+    out = []
+    for start, end in split_text(text, CHUNK_SIZE, CHUNK_OVERLAP):
+        tf = Counter(tokenize(text[start:end]))
+        out.append((start, end, sum(tf.values()), dict(tf)))
+    return out
+
+def index_doc(doc_id, text, prepared=None):
+    """切段 + 寫入 postings，回傳段落數；prepared 為 prepare_chunks() 的結果時不重新斷詞"""
+    with transaction() as conn:
+        if prepared is None:
+            chunks = ensure_chunks(conn, "rag", doc_id, text, lambda c: len(tokenize(c)),
+                                   CHUNK_SIZE, CHUNK_OVERLAP)
+            tfs = [Counter(tokenize(chunk)) for _, chunk, _ in chunks]
+        else:
+            chunks = write_chunks(conn, "rag", doc_id, text, [p[:3] for p in prepared],
+                                  CHUNK_SIZE, CHUNK_OVERLAP)
+            tfs = [p[3] for p in prepared]
+        conn.execute("DELETE FROM rag_postings WHERE doc_id=?", (doc_id,))
+        conn.executemany(
+            "INSERT INTO rag_postings (doc_id, term, chunk_id, tf) VALUES (?,?,?,?)",
+            [(doc_id, t, cid, n) for (cid, _, _), tf in zip(chunks, tfs) for t, n in tf.items()]
+        )
+    _cache.invalidate(doc_id)
+    return len(chunks)
+
+def drop_doc(doc_id):
+    with transaction() as conn:
+        conn.execute("DELETE FROM rag_postings WHERE doc_id=?", (doc_id,))
+        drop_chunks(conn, "rag", doc_id)
+    _cache.invalidate(doc_id)
+
+def unindexed(doc_ids):
+    """還沒建索引的內容（舊版上傳搬過來的），呼叫端讀 blob 後 index_doc 補建"""
+    known = _doc_versions(doc_ids)
+    return [d for d in doc_ids if d not in known]
+
+def ensure_indexed(keys):
+    for h in unindexed(keys):
+        try:
+            n = index_doc(h, read_blob(h))
+        except OSError:
+            continue
+        with transaction() as conn:
+            conn.execute("UPDATE rag_docs SET chunks=? WHERE blob_hash=?", (n, h))
+
+def _doc_versions(doc_ids):
+    if not doc_ids:
+        return {}
+    with connection() as conn:
+        rows = conn.execute(f"""
+            SELECT doc_id, content_hash, n_chunks FROM chunk_docs
+            WHERE source='rag' AND doc_id IN ({','.join('?' * len(doc_ids))})
+        """, list(doc_ids)).fetchall()
+    return {r["doc_id"]: (r["content_hash"], r["n_chunks"]) for r in rows}
+
+# ══════════════════════════════════════
+# 文件索引快取（LRU）
+# ══════════════════════════════════════
+class _DocIndex:
+    """單一文件的部分索引：查過的詞才載入 postings"""
+    def __init__(self, doc_id, version, n_chunks):
+        self.doc_id   = doc_id
+        self.version  = version
+        self.n_chunks = n_chunks
+        self.postings = {}      # term → [(chunk_id, tf), ...]（沒命中也記成空 list）
+        self.lengths  = {}      # chunk_id → n_tokens
+        self.lock     = threading.Lock()
+
+    def load(self, conn, terms):
+        with self.lock:
+            missing = [t for t in terms if t not in self.postings]
+            if missing:
+                for t in missing:
+                    self.postings[t] = []
+                for r in conn.execute(f"""
+                    SELECT term, chunk_id, tf FROM rag_postings
+                    WHERE doc_id=? AND term IN ({','.join('?' * len(missing))})
+                """, [self.doc_id] + missing):
+                    self.postings[r["term"]].append((r["chunk_id"], r["tf"]))
+                new_ids = {cid for t in missing for cid, _ in self.postings[t]} - self.lengths.keys()
+                if new_ids:
+                    for r in conn.execute(
+                        f"SELECT id, n_tokens FROM chunks WHERE id IN ({','.join('?' * len(new_ids))})",
+                        list(new_ids)
+                    ):
+                        self.lengths[r["id"]] = r["n_tokens"]
+            return {t: self.postings[t] for t in terms}
+
+class _LRU:
+    def __init__(self, capacity=LRU_DOCS):
+        self.capacity = capacity
+        self._items   = OrderedDict()
+        self._lock    = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, doc_id, version, n_chunks):
+        with self._lock:
+            idx = self._items.get(doc_id)
+            if idx is not None and idx.version == version:
+                self._items.move_to_end(doc_id)
+                self.hits += 1
+                return idx
+            self.misses += 1
+            idx = self._items[doc_id] = _DocIndex(doc_id, version, n_chunks)
+            self._items.move_to_end(doc_id)
+            while len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+            return idx
+
+    def invalidate(self, doc_id=None):
+        with self._lock:
+            if doc_id is None:
+                self._items.clear()
+            else:
+                self._items.pop(doc_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {"docs": len(self._items), "capacity": self.capacity,
+                    "hits": self.hits, "misses": self.misses}
+
+_cache = _LRU()
+
+def cache_stats():
+    return _cache.stats()
+
+# ══════════════════════════════════════
+# 查詢
+# ══════════════════════════════════════
+def search(query, doc_ids, top_k=TOP_K, mode=None):
+    """
+    TF-IDF（與 ai_utils.tfidf_search 相同公式），語料 = 選定文件的全部段落
+    有 NumPy 時改用全部 RAG 段落的稀疏矩陣（IDF 以全部文件計、段落向量 L2 正規化）
+    mode：keyword（預設）/ dense（hashed embedding）/ hybrid（兩者分數融合），見 dense_index
+    回傳 [{"doc_id","chunk_id","text","score","char_start","char_end"}, ...]
+    結果依 (查詢, 文件集合, top_k, 模式, rag_index 版本) 快取；doc_ids 是內容 hash，同一份內容的結果不變
+    """
+    if not doc_ids:
+        return []
+    mode = dense_index.resolve_mode(mode)
+    key = (normalize_query(query), frozenset(doc_ids), top_k, mode, get_version("rag_index"))
+    def compute():
+        sparse_index.take_stale()
+        return _search(query, sorted(doc_ids), top_k, mode)
+    # 索引重建中用舊版本算出的結果不存（key 已經是新版本號）
+    results = _query_cache.get_or_compute(key, compute, cacheable=lambda: not sparse_index.take_stale())
+    return [dict(r) for r in results]
+
+_query_cache = get_cache("rag")
+
+def _search(query, doc_ids, top_k, mode):
+    if mode == "keyword":
+        top = _rank_keyword(query, doc_ids, top_k)
+    elif mode == "dense":
+        top = _rank_dense(query, doc_ids, top_k)
+    else:
+        top = dense_index.fuse(dict(_rank_keyword(query, doc_ids, top_k * 3)),
+                               dict(_rank_dense(query, doc_ids, top_k * 3)))[:top_k]
+    if not top:
+        return []
+    with connection() as conn:
+        rows = {r["id"]: r for r in conn.execute(
+            f"SELECT id, doc_id, text, char_start, char_end FROM chunks WHERE id IN ({','.join('?' * len(top))})",
+            [cid for cid, _ in top])}
+    return [{"doc_id": rows[cid]["doc_id"], "chunk_id": cid, "text": rows[cid]["text"], "score": sc,
+             "char_start": rows[cid]["char_start"], "char_end": rows[cid]["char_end"]}
+            for cid, sc in top if cid in rows]
+
+def _rank_keyword(query, doc_ids, top_k):
+    qtf = Counter(tokenize(query))
+    if not qtf:
+        return []
+    if sparse_index.enabled():
+        return _rank_sparse(qtf, doc_ids, top_k)
+    return _rank_postings(qtf, doc_ids, top_k)
+
+def _rank_postings(qtf, doc_ids, top_k):
+    versions = _doc_versions(doc_ids)
+    if not versions:
+        return []
+    terms = list(qtf)
+    n = sum(nc for _, nc in versions.values())
+
+    hits = {}                  # term → [(chunk_id, tf), ...]
+    lengths = {}
+    with connection() as conn:
+        for doc_id, (version, n_chunks) in versions.items():
+            idx = _cache.get(doc_id, version, n_chunks)
+            for t, plist in idx.load(conn, terms).items():
+                hits.setdefault(t, []).extend(plist)
+            lengths.update(idx.lengths)
+
+    scores = Counter()
+    for t, plist in hits.items():
+        idf = math.log((n + 1) / (len(plist) + 1)) + 1
+        for cid, tf in plist:
+            scores[cid] += tf / (lengths.get(cid) or 1) * idf * qtf[t]
+    # 同分時段落 id 小的在前（與 SparseIndex.topk 一致）
+    top = sorted(scores.items(), key=lambda x: (-x[1], x[0]))[:top_k]
+    return [(cid, sc) for cid, sc in top if sc > 0]
+
+def _matrix():
+    """
+    全部 RAG 段落 × 詞彙（值 = 詞頻，段落長度另存），rag_index 版本變了才重建
+    tf / 長度與 IDF 都在查詢時以 float64 計算（IDF 只對選定文件的段落算），
+    運算順序與 _rank_postings 相同，分數與同分排序才會完全一樣
+    """
+    def build():
+        with connection() as conn:
+            rows = conn.execute("""
+                SELECT p.doc_id, p.chunk_id, p.term, p.tf, c.n_tokens
+                FROM rag_postings p JOIN chunks c ON c.id = p.chunk_id
+                ORDER BY p.chunk_id
+            """).fetchall()
+        vecs, docs, lengths = {}, {}, {}
+        for r in rows:
+            vecs.setdefault(r["chunk_id"], {})[r["term"]] = r["tf"]
+            docs[r["chunk_id"]] = r["doc_id"]
+            lengths[r["chunk_id"]] = r["n_tokens"] or 1
+        doc_list = sorted(set(docs.values()))
+        pos = {d: i for i, d in enumerate(doc_list)}
+        keys = sorted(vecs)
+        return sparse_index.SparseIndex.build(
+            keys, [vecs[k] for k in keys],
+            extra={"doc": [pos[docs[k]] for k in keys], "len": [lengths[k] for k in keys]},
+            meta={"docs": doc_list})
+    # 名稱帶 _counts：舊版（矩陣裡已是 tf / 長度或含 IDF）的同版本索引不會被誤用
+    return sparse_index.get_index("rag_counts", get_version("rag_index"), build)
+
+def _rank_sparse(qtf, doc_ids, top_k):
+    """與 _rank_postings 同一套權重與運算順序：tf / 長度 × IDF（選定文件的段落數與 df）× 查詢詞頻"""
+    import numpy as np
+    idx = _matrix()
+    pos = {d: i for i, d in enumerate(idx.meta["docs"])}
+    wanted = [pos[d] for d in doc_ids if d in pos]
+    if not wanted:
+        return []
+    mask = np.isin(idx.extra["doc"], wanted)
+    lengths = np.asarray(idx.extra["len"], dtype=np.float64)
+    n = _n_chunks(doc_ids)
+    scores = None
+    for t, qf in qtf.items():
+        col = idx.matvec({t: 1.0})
+        if col is None:
+            continue
+        df = int(np.count_nonzero(col[mask]))
+        if not df:
+            continue
+        part = col.astype(np.float64) / lengths * (math.log((n + 1) / (df + 1)) + 1) * qf
+        scores = part if scores is None else scores + part
+    if scores is None:
+        return []
+    return [(idx.rows[i], sc) for i, sc in idx.topk(scores, top_k, mask)]
+
+def _n_chunks(doc_ids):
+    """選定文件的段落總數（含沒有任何詞的段落，與 _rank_postings 的 n 相同）"""
+    return sum(nc for _, nc in _doc_versions(doc_ids).values())
+
+def _dense():
+    """全部 RAG 段落的 hashed embedding，rag_index 版本變了才重建"""
+    def build():
+        with connection() as conn:
+            rows = conn.execute(
+                "SELECT id, doc_id, text FROM chunks WHERE source='rag' ORDER BY id"
+            ).fetchall()
+        doc_list = sorted({r["doc_id"] for r in rows})
+        pos = {d: i for i, d in enumerate(doc_list)}
+        return dense_index.DenseIndex.build(
+            [r["id"] for r in rows], [r["text"] for r in rows],
+            extra={"doc": [pos[r["doc_id"]] for r in rows]}, meta={"docs": doc_list})
+    return sparse_index.get_index("dense_rag", get_version("rag_index"), build, dense_index.DenseIndex)
+
+def _rank_dense(query, doc_ids, top_k):
+    import numpy as np
+    idx = _dense()
+    pos = {d: i for i, d in enumerate(idx.meta.get("docs", []))}
+    wanted = [pos[d] for d in doc_ids if d in pos]
+    if not wanted:
+        return []
+    mask = np.isin(idx.extra["doc"], wanted)
+    return [(idx.rows[i], sc) for i, sc in idx.search(query, top_k, mask)]
+
+init_rag()
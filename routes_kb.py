@@ -1,8 +1,71 @@
 # routes_kb.py — 知識庫 / 資料庫
 import os, json, time, base64, requests, math, re, threading
-from flask import request, Response, render_template, session, jsonify
+from flask import request, Response, render_template, session, jsonify, stream_with_context
 from ai_utils import *
 
+def _page_args():
+    """解析分頁參數：cursor（不透明字串）優先，其次 before_id / after_id"""
+    from database import decode_cursor
+    cursor = request.args.get("cursor")
+    if cursor:
+        return decode_cursor(cursor)
+    return {
+        "before_id": request.args.get("before_id", type=int),
+        "after_id":  request.args.get("after_id", type=int),
+    }
+
+def _paged(rows, limit, oldest_id, newest_id, page):
+    """
+    body 維持原本的 list，游標放在 header：
+    X-Next-Cursor 往更舊翻頁、X-Prev-Cursor 往更新翻頁
+    """
+    from database import encode_cursor
+    resp = jsonify(rows)
+    if not rows:
+        return resp
+    if len(rows) >= limit or page.get("after_id") is not None:
+        resp.headers["X-Next-Cursor"] = encode_cursor("before", oldest_id)
+    if page.get("before_id") is not None or page.get("after_id") is not None:
+        resp.headers["X-Prev-Cursor"] = encode_cursor("after", newest_id)
+    return resp
+
+def _bulk_format():
+    fmt = (request.args.get("format") or "").lower()
+    if not fmt:
+        fmt = "csv" if "csv" in (request.content_type or "") else "ndjson"
+    return fmt
+
+def _bulk_import(spec):
+    """
+    上傳 NDJSON / CSV（原始 body 或 multipart 的 file 欄位），邊讀邊寫入
+    回應為 NDJSON 進度串流，最後一行 type=done
+    """
+    from db_bulk import iter_input, import_stream, FORMATS
+    fmt = _bulk_format()
+    if fmt not in FORMATS:
+        return jsonify({"error": f"format 只支援 {FORMATS}"}), 400
+    f = request.files.get("file")
+    stream = f.stream if f else request.stream
+
+    def generate():
+        try:
+            for ev in import_stream(spec, iter_input(stream, fmt)):
+                yield json.dumps(ev, ensure_ascii=False) + "\n"
+        except Exception as e:
+            import traceback; traceback.print_exc()
+            yield json.dumps({"type": "error", "error": str(e)[:300]}, ensure_ascii=False) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+def _bulk_export(spec, basename):
+    from db_bulk import export_stream, FORMATS
+    fmt = (request.args.get("format") or "ndjson").lower()
+    if fmt not in FORMATS:
+        return jsonify({"error": f"format 只支援 {FORMATS}"}), 400
+    mimetype = "text/csv; charset=utf-8" if fmt == "csv" else "application/x-ndjson"
+    return Response(stream_with_context(export_stream(spec, fmt)), mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename={basename}.{fmt}"})
+
 def register_kb_routes(app):
     @app.route("/ai/kb/categories", methods=["GET"])
     def kb_categories():
@@ -93,6 +156,41 @@ def register_kb_routes(app):
         doc_id = add_doc(title, content, category, tags, source=fname)
         return jsonify({"id": doc_id, "message": f"{fname} 已匯入知識庫"})
 
+    # ── 批次匯入（多檔 / zip，背景平行處理）──
+    @app.route("/ai/ingest", methods=["POST"])
+    def ingest_upload():
+        from ingest import create_job, stage_upload, start_job
+        target = request.form.get("target", "kb")
+        uploads = [f for f in request.files.getlist("files") + request.files.getlist("file") if f]
+        if not uploads:
+            return jsonify({"error": "沒有檔案"}), 400
+        try:
+            tags = json.loads(request.form.get("tags", "[]"))
+        except Exception:
+            tags = []
+        try:
+            job_id = create_job(target)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        files = []
+        for f in uploads:
+            stage_upload(job_id, f.filename, f.stream, files)
+        start_job(job_id, target, files, {"category": request.form.get("category", "note"), "tags": tags})
+        return jsonify({"job_id": job_id, "total": len(files)}), 202
+
+    @app.route("/ai/ingest/<job_id>", methods=["GET"])
+    def ingest_status(job_id):
+        from ingest import get_job
+        job = get_job(job_id)
+        if not job:
+            return jsonify({"error": "找不到匯入工作"}), 404
+        return jsonify(job)
+
+    @app.route("/ai/ingest", methods=["GET"])
+    def ingest_jobs():
+        from ingest import list_jobs
+        return jsonify(list_jobs(request.args.get("limit", 20, type=int)))
+
     @app.route("/ai/kb/import_world", methods=["POST"])
     def kb_import_world():
         from kb_manager import import_from_world_state
@@ -109,6 +207,26 @@ def register_kb_routes(app):
         from database import get_db_stats
         return jsonify(get_db_stats())
 
+    @app.route("/ai/db/pool", methods=["GET"])
+    def db_pool_stats():
+        """連線池監控：開啟數、閒置數、等待時間"""
+        from db_pool import pool_stats
+        return jsonify(pool_stats())
+
+    @app.route("/ai/db/writer", methods=["GET"])
+    def db_writer_stats():
+        """寫入合併監控：佇列深度、批次大小、commit 耗時"""
+        from db_writer import writer_stats
+        return jsonify(writer_stats())
+
+    @app.route("/ai/db/retrieval", methods=["GET"])
+    def db_retrieval_stats():
+        """檢索快取監控：查詢結果快取命中率、RAG 文件索引 LRU、已載入的矩陣索引"""
+        from query_cache import cache_stats
+        from rag_store import cache_stats as rag_doc_stats
+        from sparse_index import index_stats
+        return jsonify({"queries": cache_stats(), "rag_docs": rag_doc_stats(), "indexes": index_stats()})
+
     # ── 聊天記錄 ──
     @app.route("/ai/db/chat", methods=["GET"])
     def db_chat_list():
@@ -117,7 +235,29 @@ def register_kb_routes(app):
         limit = int(request.args.get("limit", 50))
         if session_id == "__sessions__":
             return jsonify(list_chat_sessions())
-        return jsonify(get_chat_history(session_id, limit=limit))
+        try:
+            page = _page_args()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        rows = get_chat_history(session_id, limit=limit, **page)
+        # 聊天記錄為舊到新
+        return _paged(rows, limit, rows[0]["id"] if rows else 0, rows[-1]["id"] if rows else 0, page)
+
+    @app.route("/ai/db/chat/import", methods=["POST"])
+    def db_chat_import():
+        from db_bulk import ChatSpec
+        return _bulk_import(ChatSpec())
+
+    @app.route("/ai/db/chat/export", methods=["GET"])
+    def db_chat_export():
+        from db_bulk import ChatSpec
+        return _bulk_export(ChatSpec(request.args.get("session")), "chat")
+
+    @app.route("/ai/db/archive", methods=["GET"])
+    def db_archive_stats():
+        """封存狀態（搬移請用排程：python chat_archive.py run）"""
+        from chat_archive import archive_stats
+        return jsonify(archive_stats())
 
     @app.route("/ai/db/chat/<session_id>", methods=["DELETE"])
     def db_chat_delete(session_id):
@@ -150,6 +290,16 @@ def register_kb_routes(app):
         )
         return jsonify({"id": tid, "message": "已新增任務"})
 
+    @app.route("/ai/db/tasks/import", methods=["POST"])
+    def db_tasks_import():
+        from db_bulk import TasksSpec
+        return _bulk_import(TasksSpec())
+
+    @app.route("/ai/db/tasks/export", methods=["GET"])
+    def db_tasks_export():
+        from db_bulk import TasksSpec
+        return _bulk_export(TasksSpec(), "tasks")
+
     @app.route("/ai/db/tasks/<int:task_id>", methods=["PUT"])
     def db_tasks_update(task_id):
         from database import update_task
@@ -171,7 +321,12 @@ def register_kb_routes(app):
         from database import get_events
         event_type = request.args.get("type")
         limit = int(request.args.get("limit", 50))
-        return jsonify(get_events(event_type=event_type, limit=limit))
+        try:
+            page = _page_args()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        rows = get_events(event_type=event_type, limit=limit, **page)
+        return _paged(rows, limit, rows[-1]["id"] if rows else 0, rows[0]["id"] if rows else 0, page)
 
     @app.route("/ai/db/events", methods=["POST"])
     def db_events_create():
@@ -231,7 +386,40 @@ def register_kb_routes(app):
         search = request.args.get("q")
         limit  = int(request.args.get("limit", 100))
         offset = int(request.args.get("offset", 0))
-        return jsonify(get_records(name, search=search, limit=limit, offset=offset))
+        try:
+            page = _page_args()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        rows = get_records(name, search=search, limit=limit, offset=offset, **page)
+        if search:
+            return jsonify(rows)   # 全文搜尋依相關度排序，以 offset 分頁
+        return _paged(rows, limit, rows[-1]["id"] if rows else 0, rows[0]["id"] if rows else 0, page)
+
+    @app.route("/ai/db/tables/<name>/query", methods=["POST"])
+    def db_records_query(name):
+        """
+        伺服器端篩選 / 排序 / 彙總
+        body: {"filters":[{"field":"price","op":"gte","value":100}],
+               "sort":[{"field":"price","dir":"desc"}], "limit":50, "offset":0,
+               "aggregate":[{"fn":"sum","field":"price"}], "group_by":"category"}
+        """
+        from database import query_records, get_custom_table
+        if not get_custom_table(name):
+            return jsonify({"error": f"找不到資料表 {name}"}), 404
+        data = request.get_json() or {}
+        try:
+            result = query_records(
+                name,
+                filters=data.get("filters"),
+                sort=data.get("sort"),
+                limit=data.get("limit", 100),
+                offset=data.get("offset", 0),
+                aggregate=data.get("aggregate"),
+                group_by=data.get("group_by"),
+            )
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify(result)
 
     @app.route("/ai/db/tables/<name>/records", methods=["POST"])
     def db_records_create(name):
@@ -240,6 +428,22 @@ def register_kb_routes(app):
         rid = add_record(name, data)
         return jsonify({"id": rid, "message": "已新增"})
 
+    @app.route("/ai/db/tables/<name>/import", methods=["POST"])
+    def db_records_import(name):
+        from database import get_custom_table
+        from db_bulk import RecordsSpec
+        if not get_custom_table(name):
+            return jsonify({"error": f"找不到資料表 {name}"}), 404
+        return _bulk_import(RecordsSpec(name))
+
+    @app.route("/ai/db/tables/<name>/export", methods=["GET"])
+    def db_records_export(name):
+        from database import get_custom_table
+        from db_bulk import RecordsSpec
+        if not get_custom_table(name):
+            return jsonify({"error": f"找不到資料表 {name}"}), 404
+        return _bulk_export(RecordsSpec(name), "records")
+
     @app.route("/ai/db/records/<int:record_id>", methods=["PUT"])
     def db_records_update(record_id):
         from database import update_record
@@ -59,36 +59,22 @@ def register_role_routes(app):
         raw = file_obj.read(5 * 1024 * 1024)  # 最大 5MB
         text = raw.decode("utf-8", errors="replace")
         
-        doc_id   = f"doc_{int(time.time())}"
-        filename = f"{doc_id}.txt"
-        path     = os.path.join(RAG_DIR, filename)
-        with open(path,"w",encoding="utf-8") as f:
-            f.write(text)
-        
-        index = load_rag_index()
-        index.append({
-            "id":       doc_id,
-            "name":     file_obj.filename,
-            "filename": filename,
-            "size":     len(text),
-            "chunks":   len(chunk_text(text)),
-            "uploaded": time.strftime("%Y-%m-%d %H:%M")
-        })
-        save_rag_index(index)
-        return jsonify({"status":"ok","id":doc_id,"name":file_obj.filename})
+        doc = rag_add_doc(file_obj.filename, text)
+        return jsonify({"status":"ok","id":doc["id"],"name":file_obj.filename,
+                        "duplicate":doc["duplicate"]})
 
     @app.route("/ai/rag/docs/<doc_id>", methods=["DELETE"])
     def rag_doc_delete(doc_id):
-        index = load_rag_index()
-        doc   = next((d for d in index if d["id"]==doc_id), None)
-        if doc:
-            try:
-                os.remove(os.path.join(RAG_DIR, doc["filename"]))
-            except Exception:
-                pass
-        save_rag_index([d for d in index if d["id"] != doc_id])
+        rag_delete_docs([doc_id])
         return jsonify({"status":"ok"})
 
+    @app.route("/ai/rag/docs/delete", methods=["POST"])
+    def rag_docs_delete_many():
+        ids = (request.get_json() or {}).get("ids") or []
+        if not isinstance(ids, list):
+            return jsonify({"error":"ids 必須是陣列"}), 400
+        return jsonify({"status":"ok","deleted":rag_delete_docs(ids)})
+
     # ── 真多代理（並行，獨立記憶）──
     @app.route("/ai/true_multi", methods=["POST"])
     def ai_true_multi():
@@ -104,6 +90,7 @@ def register_role_routes(app):
         text             = (data.get("message") or "").strip()
         role_ids         = data.get("role_ids", [])
         rag_doc_ids      = data.get("rag_doc_ids", [])
+        retriever        = data.get("retriever")
         do_search        = data.get("search", False)
         do_reset         = data.get("reset_memory", False)
         moderator_prompt = (data.get("moderator_prompt") or
@@ -201,7 +188,7 @@ def register_role_routes(app):
         # RAG / 搜尋 context（共用，不重複感知）
         context_parts = []
         if rag_doc_ids:
-            rc = rag_search(text, rag_doc_ids)
+            rc = rag_search(text, rag_doc_ids, mode=retriever)
             if rc: context_parts.append(rc)
         if do_search:
             sr = web_search(text)
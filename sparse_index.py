@@ -0,0 +1,194 @@
+"""
+sparse_index.py — 稀疏矩陣檢索引擎（NumPy，選配）
+- 列 = 文件或段落，欄 = 詞彙；權重在建索引時算好（IDF、BM25 飽和、L2 正規化由呼叫端決定）
+- 查詢 = 一次 CSR 矩陣 × 查詢向量（有 SciPy 用 csr_matrix，否則 np.add.reduceat）+ argpartition 取 top-k
+- 存在 data/index/<名稱>.v<版本>/ 下的 .npy，np.load(mmap_mode='r') 載入，多個 worker 共用 page cache
+  （.npz 是 zip，成員無法 memory-map，所以拆成個別 .npy）
+- 版本號來自 database.change_versions；版本變了才重建。重建在全域鎖外進行，同一個名稱只有一個
+  執行緒在建，其他查詢先用舊版本（take_stale() 讓查詢快取知道這次結果不能存）
+- 沒有 NumPy（或 RETRIEVAL_BACKEND=postings）時 enabled() 為 False，呼叫端走 SQL postings
+"""
+import os
+import re
+import json
+import shutil
+import threading
+
+try:
+    import numpy as np
+    AVAILABLE = True
+except ImportError:
+    np = None
+    AVAILABLE = False
+
+try:
+    from scipy.sparse import csr_matrix
+except ImportError:
+    csr_matrix = None
+
+INDEX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "index")
+BACKEND   = os.environ.get("RETRIEVAL_BACKEND", "auto")   # auto | sparse | postings
+
+def enabled():
+    return AVAILABLE and BACKEND != "postings"
+
+class SparseIndex:
+    """CSR 矩陣 + 詞彙表 + 每列的 key；extra 為與列對齊的附加陣列（例如所屬文件）"""
+
+    def __init__(self, data, indices, indptr, vocab, rows, extra=None, meta=None):
+        self.data, self.indices, self.indptr = data, indices, indptr
+        self.vocab = vocab
+        self.rows  = rows
+        self.extra = extra or {}
+        self.meta  = meta or {}
+        self._csr  = None
+        if csr_matrix is not None and len(rows):
+            self._csr = csr_matrix((data, indices, indptr), shape=(len(rows), max(len(vocab), 1)))
+
+    @classmethod
+    def build(cls, rows, vectors, extra=None, meta=None, l2=False):
+        """rows：列 key；vectors：與 rows 對齊的 {term: weight}"""
+        vocab = {}
+        data, indices, indptr = [], [], [0]
+        for vec in vectors:
+            norm = sum(w * w for w in vec.values()) ** 0.5 if l2 else 1.0
+            for term, w in vec.items():
+                indices.append(vocab.setdefault(term, len(vocab)))
+                data.append(w / norm if norm else 0.0)
+            indptr.append(len(data))
+        extra = {k: np.asarray(v) for k, v in (extra or {}).items()}
+        return cls(np.asarray(data, dtype=np.float32), np.asarray(indices, dtype=np.int32),
+                   np.asarray(indptr, dtype=np.int64), vocab, list(rows), extra, meta)
+
+    # ── 存取 ──
+    def save(self, path):
+        tmp = f"{path}.tmp{os.getpid()}"
+        os.makedirs(tmp, exist_ok=True)
+        for name, arr in [("data", self.data), ("indices", self.indices), ("indptr", self.indptr)] + \
+                         [(f"x_{k}", v) for k, v in self.extra.items()]:
+            np.save(os.path.join(tmp, f"{name}.npy"), arr)
+        terms = sorted(self.vocab, key=self.vocab.get)
+        with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"vocab": terms, "rows": self.rows, "extra": list(self.extra),
+                       "meta": self.meta}, f, ensure_ascii=False)
+        try:
+            os.replace(tmp, path)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)   # 其他行程已經建好同版本
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            m = json.load(f)
+        arr = lambda name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+        return cls(arr("data"), arr("indices"), arr("indptr"),
+                   {t: i for i, t in enumerate(m["vocab"])}, m["rows"],
+                   {k: arr(f"x_{k}") for k in m["extra"]}, m["meta"])
+
+    def stats(self):
+        return {"version": self.meta.get("version"), "rows": len(self.rows),
+                "vocab": len(self.vocab), "nnz": int(len(self.data))}
+
+    # ── 查詢 ──
+    def matvec(self, query):
+        """query：{term: weight} → 每列分數（ndarray）；沒有任何已知詞時回傳 None"""
+        q = np.zeros(max(len(self.vocab), 1), dtype=np.float32)
+        for term, w in query.items():
+            col = self.vocab.get(term)
+            if col is not None:
+                q[col] += w
+        if not q.any():
+            return None
+        if self._csr is not None:
+            return np.asarray(self._csr @ q, dtype=np.float32)
+        scores = np.zeros(len(self.rows), dtype=np.float32)
+        starts = np.asarray(self.indptr[:-1])
+        nonempty = starts < np.asarray(self.indptr[1:])
+        if nonempty.any():
+            contrib = self.data * q[self.indices]
+            scores[nonempty] = np.add.reduceat(contrib, starts[nonempty])
+        return scores
+
+    @staticmethod
+    def topk(scores, k, mask=None):
+        """分數 > 0 的前 k 列 [(列序, 分數)]；同分時列序小的在前"""
+        if mask is not None:
+            scores = np.where(mask, scores, 0)
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        idx = np.argpartition(-scores, k - 1)[:k]
+        idx = idx[np.lexsort((idx, -scores[idx]))]
+        return [(int(i), float(scores[i])) for i in idx if scores[i] > 0]
+
+# ══════════════════════════════════════
+# 依名稱 + 版本快取
+# ══════════════════════════════════════
+_loaded   = {}
+_lock     = threading.Lock()      # 只保護 _loaded / _builders，不在持有時做 I/O 或重建
+_builders = {}                    # name → 重建鎖（同一個名稱同時只有一個執行緒在建）
+_tls      = threading.local()
+
+def _safe(name):
+    return re.sub(r"[^\w-]", "_", name)
+
+def take_stale():
+    """這個執行緒從上次呼叫以來是否拿到過舊版索引（有人正在重建，先用舊的頂著）；呼叫後歸零"""
+    stale = getattr(_tls, "stale", False)
+    _tls.stale = False
+    return stale
+
+def get_index(name, version, builder, cls=None):
+    """
+    取得 name 的索引；記憶體 / 磁碟上都沒有這個版本才呼叫 builder() 重建
+    cls：有 load(path) / save(path) / meta 的索引類別（預設 SparseIndex，dense_index 也共用）
+    別的執行緒正在重建時：記憶體有舊版本就直接回傳舊的，沒有才等它建完
+    """
+    cls = cls or SparseIndex
+    name = _safe(name)
+    path = os.path.join(INDEX_DIR, f"{name}.v{version}")
+    with _lock:
+        cur = _loaded.get(name)
+        build_lock = _builders.setdefault(name, threading.Lock())
+    if cur is not None and cur.meta.get("version") == version:
+        return cur
+    if not build_lock.acquire(blocking=cur is None):
+        _tls.stale = True
+        return cur
+    try:
+        with _lock:
+            cur = _loaded.get(name)
+        if cur is not None and cur.meta.get("version") == version:
+            return cur                # 等待期間別人已經建好
+        if os.path.isdir(path):
+            idx = cls.load(path)
+        else:
+            idx = builder()
+            idx.meta["version"] = version
+            os.makedirs(INDEX_DIR, exist_ok=True)
+            idx.save(path)
+            _cleanup(name, version)
+        with _lock:
+            _loaded[name] = idx
+        return idx
+    finally:
+        build_lock.release()
+
+def _cleanup(name, version):
+    """只刪比上一個版本更舊的目錄；上一版可能還有其他 worker 正在載入 / 使用"""
+    prefix = f"{name}.v"
+    older = []
+    for fn in os.listdir(INDEX_DIR):
+        if fn.startswith(prefix) and ".tmp" not in fn:
+            try:
+                v = int(fn[len(prefix):])
+            except ValueError:
+                continue
+            if v < version:
+                older.append(v)
+    for v in sorted(older)[:-1]:
+        shutil.rmtree(os.path.join(INDEX_DIR, f"{prefix}{v}"), ignore_errors=True)
+
+def index_stats():
+    with _lock:
+        return {name: idx.stats() for name, idx in _loaded.items()}
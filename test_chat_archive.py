@@ -0,0 +1,67 @@
+"""chat_archive 封存：搬移 / 合併讀取 / 還原 / 刪除，搬移期間的新訊息不會遺失"""
+import os
+import database
+import chat_archive
+from db_pool import get_pool
+
+def make_session(sid, n, last_active="2020-01-15 10:00:00"):
+    database.create_session(sid)
+    for i in range(n):
+        database.save_chat_message(sid, "user", f"{sid}-{i}")
+    with database.transaction() as conn:
+        conn.execute("UPDATE chat_history SET created_at=? WHERE session_id=?", (last_active, sid))
+        conn.execute("UPDATE chat_sessions SET updated_at=? WHERE session_id=?", (last_active, sid))
+
+def main_count(sid):
+    with database.connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM chat_history WHERE session_id=?", (sid,)).fetchone()[0]
+
+def contents(sid, **kw):
+    return [m["content"] for m in database.get_chat_history(sid, **kw)]
+
+def test_run_archive_moves_idle_sessions_only(db):
+    make_session("old", 5)
+    make_session("new", 2, last_active="2999-01-01 00:00:00")
+    r = chat_archive.run_archive(days=30, batch=10, log=None)
+    assert r == {"sessions": 1, "messages": 5, "batches": 1}
+    assert main_count("old") == 0 and main_count("new") == 2
+    assert os.path.exists(chat_archive.archive_path("chat_202001"))
+    s = database.get_session("old")
+    assert s["archived_in"] == "chat_202001" and s["msg_count"] == 5
+
+def test_archived_history_reads_and_pages_like_before(db):
+    make_session("s", 6)
+    before = contents("s")
+    chat_archive.archive_session("s")
+    assert contents("s") == before
+    page = database.get_chat_history("s", limit=2)
+    older = database.get_chat_history("s", limit=2, before_id=page[0]["id"])
+    assert [m["content"] for m in older + page] == before[-4:]
+    database.save_chat_message("s", "user", "after archive")
+    assert contents("s") == before + ["after archive"]
+
+def test_messages_written_during_archive_are_kept(db, monkeypatch):
+    make_session("s", 3)
+    real_exit = chat_archive._attached.__exit__
+
+    def exit_then_write(self, *exc):
+        real_exit(self, *exc)
+        database.save_chat_message("s", "user", "late")   # 複製完、刪除前寫入
+
+    monkeypatch.setattr(chat_archive._attached, "__exit__", exit_then_write)
+    assert chat_archive.archive_session("s") == 3
+    assert main_count("s") == 1
+    assert contents("s")[-1] == "late"
+
+def test_restore_and_delete(db):
+    make_session("a", 3)
+    make_session("b", 2)
+    chat_archive.archive_session("a")
+    chat_archive.archive_session("b")
+    assert chat_archive.restore_session("a") == 3
+    assert main_count("a") == 3 and database.get_session("a")["archived_in"] is None
+    database.delete_chat_session("b")
+    path = chat_archive.archive_path("chat_202001")
+    with get_pool(path).connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM chat_history").fetchone()[0] == 0
+    assert chat_archive.archive_stats()["archived_sessions"] == 0
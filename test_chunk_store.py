@@ -0,0 +1,67 @@
+"""chunk_store：句子 / 段落感知切段、內容沒變不重切、KB / RAG 段落只存一份"""
+import chunk_store
+import kb_manager as kb
+import rag_store
+from chunk_store import split_text, split_chunks, ensure_chunks
+from database import transaction
+
+# ══════════════════════════════════════
+# 切段
+# ══════════════════════════════════════
+EN = "The quick brown fox jumps. It lands softly! Does it run? Yes it does. "
+ZH = "今天天氣很好。我們去公園散步！你要一起來嗎？「好啊。」"
+
+def test_chunks_end_on_sentence_boundaries():
+    for text in (EN * 20, ZH * 20):
+        spans = split_text(text, size=60)
+        assert all(e - s <= 60 for s, e in spans)
+        for s, e in spans[:-1]:
+            assert text[e - 1] in ".!?。！？」"
+        assert [c.strip() for c in split_chunks(text, 60)] == split_chunks(text, 60)
+
+def test_chunks_cover_the_text_in_order():
+    text = (EN * 5) + "\n\n" + (ZH * 5)
+    spans = split_text(text, size=80)
+    assert all(a[1] <= b[0] for a, b in zip(spans, spans[1:]))
+    covered = "".join(text[s:e] for s, e in spans)
+    assert covered.replace(" ", "") == "".join(text.split())
+
+def test_overlong_sentence_is_hard_split():
+    spans = split_text("x" * 250, size=100)
+    assert spans == [(0, 100), (100, 200), (200, 250)]
+
+def test_overlap_repeats_whole_trailing_sentences():
+    text = EN * 10
+    spans = split_text(text, size=100, overlap=40)
+    for (s1, e1), (s2, e2) in zip(spans, spans[1:]):
+        assert s1 < s2 < e1 < e2
+        assert e1 - s2 <= 40
+
+# ══════════════════════════════════════
+# 段落表
+# ══════════════════════════════════════
+def test_ensure_chunks_reuses_rows_until_content_changes(db):
+    count = lambda c: len(c.split())
+    with transaction() as conn:
+        first = ensure_chunks(conn, "kb", 1, EN * 10, count, size=100)
+        again = ensure_chunks(conn, "kb", 1, EN * 10, count, size=100)
+        changed = ensure_chunks(conn, "kb", 1, ZH * 10, count, size=100)
+    assert again == first
+    assert [c[1] for c in changed] == split_chunks(ZH * 10, 100)
+    assert chunk_store.chunk_count("kb", 1) == len(changed)
+
+def test_kb_docs_are_chunked_once_and_dropped_on_delete(db):
+    doc = kb.add_doc("title", EN * 20, "note")
+    before = chunk_store.get_chunks("kb", [doc])[str(doc)]
+    kb.update_doc(doc, title="renamed", category="tech")
+    assert chunk_store.get_chunks("kb", [doc])[str(doc)] == before
+    assert [c["text"] for c in before] == split_chunks(EN * 20, kb.CHUNK_SIZE)
+    kb.delete_doc(doc)
+    assert chunk_store.get_chunks("kb", [doc]) == {}
+
+def test_rag_duplicate_uploads_share_one_set_of_chunks(db):
+    a = rag_store.add_doc("a.txt", ZH * 30)
+    b = rag_store.add_doc("b.txt", ZH * 30)
+    assert b["duplicate"] and a["blob_hash"] == b["blob_hash"]
+    chunks = chunk_store.get_chunks("rag", [a["blob_hash"]])[a["blob_hash"]]
+    assert len(chunks) == a["chunks"] == b["chunks"] > 1
@@ -0,0 +1,79 @@
+"""context_packer：token 估算、句子邊界截斷、依預算打包（分數正規化 / 重疊 / 近似重複 / 來源上限）、對話歷史預算"""
+import pytest
+import context_packer
+from context_packer import estimate_tokens, trim_to_sentences, pack, budget_for
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("台北天氣") == 4
+    assert estimate_tokens("abcdefgh") == 2
+    assert estimate_tokens("台北 weather") == 2 + 2
+
+def test_budget_for_model():
+    assert budget_for("llama-3.1-8b-instant") == 1500
+    assert budget_for("unknown") == context_packer.DEFAULT_BUDGET
+    assert budget_for("mine", [{"id": "mine", "context_budget": 777}]) == 777
+
+def test_trim_keeps_whole_sentences():
+    text = "第一句。第二句比較長一點。第三句。"
+    assert trim_to_sentences(text, 100) == text
+    assert trim_to_sentences(text, 9) == "第一句。"
+    assert trim_to_sentences(text, 2) == ""
+
+# ══════════════════════════════════════
+# pack
+# ══════════════════════════════════════
+def c(source, text, score, **kw):
+    return dict(source=source, text=text, score=score, **kw)
+
+def test_pack_stays_within_budget_and_orders_by_normalised_score():
+    cands = [c("kb", "甲" * 40, 10.0), c("kb", "乙" * 40, 5.0),
+             c("rag", "丙" * 40, 0.3), c("rag", "丁" * 40, 0.1)]
+    packed, report = pack(cands, budget=100, shares={})
+    # kb 10 → 1.0、rag 0.3 → 1.0 同分依原順序；接著 kb 0.5
+    assert [p["text"][0] for p in packed] == ["甲", "丙"]
+    assert report["used"] == 80 <= 100
+    assert report["sources"]["kb"]["over_budget"] == 1
+    assert report["sources"]["rag"]["over_budget"] == 1
+
+def test_pack_trims_the_last_piece_to_a_sentence():
+    long = "。".join(["一二三四五六七八九"] * 10) + "。"
+    packed, report = pack([c("kb", "甲" * 60, 2.0), c("kb", long, 1.0)], budget=90, shares={})
+    assert packed[1]["trimmed"] and packed[1]["text"].endswith("。")
+    assert report["used"] <= 90 and report["sources"]["kb"]["trimmed"] == 1
+
+def test_pack_cuts_overlapping_ranges_of_the_same_document():
+    text = "".join(f"第{i}句話在這裡。" for i in range(20))
+    a = c("rag", text[0:60], 2.0, doc="d", start=0, end=60)
+    b = c("rag", text[40:100], 1.0, doc="d", start=40, end=100)
+    inside = c("rag", text[10:30], 0.5, doc="d", start=10, end=30)
+    packed, report = pack([a, b, inside], budget=1000)
+    assert [p["text"] for p in packed] == [text[0:60], text[60:100]]
+    assert report["sources"]["rag"]["duplicates"] == 1
+
+def test_pack_drops_near_duplicates_across_sources():
+    body = "the quick brown fox jumps over the lazy dog " * 3
+    packed, report = pack([c("kb", body, 1.0), c("rag", body + "!", 1.0)], budget=1000)
+    assert len(packed) == 1 and report["sources"]["rag"]["duplicates"] == 1
+
+def test_source_share_caps_one_source():
+    cands = [c("world", "世" * 50, 1.0), c("world", "界" * 50, 0.9), c("kb", "知" * 50, 0.1)]
+    packed, report = pack(cands, budget=100, shares={"world": 0.6})
+    assert report["sources"]["world"]["tokens"] <= 60
+    assert any(p["source"] == "kb" for p in packed)
+
+# ══════════════════════════════════════
+# 對話歷史
+# ══════════════════════════════════════
+def test_history_is_oldest_first_and_budgeted(db, monkeypatch):
+    ai_utils = pytest.importorskip("ai_utils")
+    import database
+    monkeypatch.setattr(context_packer, "HISTORY_BUDGET", 25)
+    database.create_session("s")
+    for i in range(6):
+        database.save_chat_message("s", "user" if i % 2 == 0 else "assistant", f"{i}" + "字" * 9)
+    msgs = ai_utils._get_messages("s", "SYS")
+    assert msgs[0] == {"role": "system", "content": "SYS"}
+    assert [m["content"][0] for m in msgs[1:]] == ["4", "5"]
+    monkeypatch.setattr(context_packer, "HISTORY_BUDGET", 1)
+    assert [m["content"][0] for m in ai_utils._get_messages("s", "SYS")[1:]] == ["5"]
@@ -0,0 +1,253 @@
+"""database：session 摘要欄位、游標分頁、自訂資料表全文搜尋 / 欄位索引 / 筆數、設定快取"""
+import pytest
+import database
+
+# ══════════════════════════════════════
+# session 摘要（trigger 維護）
+# ══════════════════════════════════════
+def session(sid):
+    return next(s for s in database.list_chat_sessions() if s["session_id"] == sid)
+
+def test_session_summary_follows_inserts_and_deletes(db):
+    database.create_session("s1", "標題")
+    assert session("s1")["msg_count"] == 0
+    for i in range(3):
+        database.save_chat_message("s1", "user", f"訊息 {i}")
+    s = session("s1")
+    assert s["msg_count"] == 3 and s["last_preview"] == "訊息 2"
+    with database.transaction() as conn:
+        conn.execute("DELETE FROM chat_history WHERE session_id='s1' AND content='訊息 2'")
+    s = session("s1")
+    assert s["msg_count"] == 2 and s["last_preview"] == "訊息 1"
+
+def test_session_created_after_messages_backfills_summary(db):
+    database.save_chat_message("late", "user", "先有訊息")
+    database.create_session("late")
+    s = session("late")
+    assert s["msg_count"] == 1 and s["last_preview"] == "先有訊息"
+
+def test_preview_is_truncated(db):
+    database.create_session("s1")
+    database.save_chat_message("s1", "user", "x" * 500)
+    assert len(session("s1")["last_preview"]) == database.SESSION_PREVIEW_CHARS
+
+def test_delete_session_removes_history(db):
+    database.create_session("s1")
+    database.save_chat_message("s1", "user", "hi")
+    database.delete_chat_session("s1")
+    assert database.get_chat_history("s1") == []
+    assert all(s["session_id"] != "s1" for s in database.list_chat_sessions())
+
+# ══════════════════════════════════════
+# 游標分頁
+# ══════════════════════════════════════
+def test_cursor_roundtrip_and_rejects_garbage():
+    assert database.decode_cursor(database.encode_cursor("before", 42)) == {"before_id": 42}
+    assert database.decode_cursor(database.encode_cursor("after", 7)) == {"after_id": 7}
+    for bad in ("", "not-a-cursor", database.encode_cursor("before", 1)[:-2] + "!!"):
+        with pytest.raises(ValueError):
+            database.decode_cursor(bad)
+
+def test_chat_history_pages_backwards_and_forwards(db):
+    database.create_session("s1")
+    for i in range(10):
+        database.save_chat_message("s1", "user", str(i))
+    page = database.get_chat_history("s1", limit=4)
+    assert [m["content"] for m in page] == ["6", "7", "8", "9"]        # 最新一頁，舊到新
+    older = database.get_chat_history("s1", limit=4, before_id=page[0]["id"])
+    assert [m["content"] for m in older] == ["2", "3", "4", "5"]
+    newer = database.get_chat_history("s1", limit=4, after_id=older[-1]["id"])
+    assert [m["content"] for m in newer] == ["6", "7", "8", "9"]
+
+def test_events_and_records_page_without_gaps(db):
+    for i in range(7):
+        database.add_event(f"e{i}", event_type="t")
+        database.add_record("tbl", {"n": i})
+    seen, before = [], None
+    while True:
+        page = database.get_events("t", limit=3, before_id=before)
+        if not page:
+            break
+        seen += [e["title"] for e in page]
+        before = page[-1]["id"]
+    assert seen == [f"e{i}" for i in reversed(range(7))]
+    first = database.get_records("tbl", limit=3)
+    after = database.get_records("tbl", limit=3, after_id=first[0]["id"])
+    assert [r["data"]["n"] for r in first] == [6, 5, 4]
+    assert after == []
+    rest = database.get_records("tbl", limit=10, before_id=first[-1]["id"])
+    assert [r["data"]["n"] for r in rest] == [3, 2, 1, 0]
+
+# ══════════════════════════════════════
+# 自訂資料表全文搜尋
+# ══════════════════════════════════════
+def fresh_db(tmp_path, monkeypatch, tokenizer):
+    """用指定的 FTS tokenizer（None = 沒有 FTS5）另建一個資料庫"""
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / f"fts_{tokenizer}.db"))
+    monkeypatch.setattr(database, "_fts_tokenizer", lambda conn: tokenizer)
+    monkeypatch.setattr(database, "_fts_mode", None)
+    database.init_db()
+
+def seed_records():
+    database.add_record("notes", {"title": "台北天氣", "body": "今天下雨"})
+    database.add_record("notes", {"title": "weather report", "body": "sunny tomorrow"})
+    database.add_record("notes", {"title": "購物清單", "body": "牛奶 雞蛋"})
+    database.add_record("other", {"title": "台北", "body": "不同資料表"})
+
+def titles(rows):
+    return sorted(r["data"]["title"] for r in rows)
+
+@pytest.mark.parametrize("tokenizer", ["trigram", "unicode61", None])
+def test_record_search_across_fts_modes(db, tmp_path, monkeypatch, tokenizer):
+    if tokenizer == "trigram":
+        with database.connection() as conn:
+            if database._fts_tokenizer(conn) != "trigram":
+                pytest.skip("SQLite 沒有 trigram tokenizer")
+    fresh_db(tmp_path, monkeypatch, tokenizer)
+    seed_records()
+    assert titles(database.get_records("notes", search="台北")) == ["台北天氣"]
+    assert titles(database.get_records("notes", search="weather")) == ["weather report"]
+    assert database.get_records("notes", search="不存在的詞") == []
+
+def test_trigram_search_matches_substrings_but_not_json_keys(db):
+    with database.connection() as conn:
+        if database._records_fts_mode(conn) != "trigram":
+            pytest.skip("SQLite 沒有 trigram tokenizer")
+    seed_records()
+    assert titles(database.get_records("notes", search="eathe")) == ["weather report"]
+    assert titles(database.get_records("notes", search="牛奶 雞蛋")) == ["購物清單"]
+    assert database.get_records("notes", search="title") == []
+
+def test_search_index_follows_updates_and_deletes(db):
+    seed_records()
+    rid = database.get_records("notes", search="購物")[0]["id"]
+    database.update_record(rid, {"title": "待辦", "body": "繳電費"})
+    assert database.get_records("notes", search="購物") == []
+    assert titles(database.get_records("notes", search="電費")) == ["待辦"]
+    database.delete_record(rid)
+    assert database.get_records("notes", search="電費") == []
+
+# ══════════════════════════════════════
+# 欄位運算式索引 / query_records
+# ══════════════════════════════════════
+FIELDS = [
+    {"name": "price",   "type": "number"},
+    {"name": "city",    "type": "text"},
+    {"name": "my note", "type": "textarea"},
+    {"name": "カナ-名",  "type": "select"},
+    {"name": 'q"uote',  "type": "text"},
+]
+
+@pytest.fixture
+def shop(db):
+    database.create_custom_table("shop", "商店", FIELDS)
+    for i, city in enumerate(["台北", "台中", "台北", "高雄", "台北"]):
+        database.add_record("shop", {"price": i * 10, "city": city, "my note": f"n{i}",
+                                     "カナ-名": f"k{i % 2}", 'q"uote': f"q{i}"})
+    return "shop"
+
+def plan(sql):
+    with database.connection() as conn:
+        return " ".join(r[3] for r in conn.execute("EXPLAIN QUERY PLAN " + sql))
+
+def test_declared_fields_get_expression_indexes_used_by_queries(shop):
+    with database.connection() as conn:
+        names = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE name LIKE 'idx_cf_%'")}
+    indexed = {database._field_index_name("shop", f["name"]) for f in FIELDS}
+    # textarea 與含 " 的名稱不建索引
+    assert names == indexed - {database._field_index_name("shop", "my note"),
+                               database._field_index_name("shop", 'q"uote')}
+    expr = database._field_expr(FIELDS[0])
+    assert "idx_cf_" in plan(f"SELECT id FROM custom_records WHERE table_name='shop' AND {expr} > 10")
+
+def test_query_records_filters_sorts_and_aggregates(shop):
+    r = database.query_records("shop", filters=[{"field": "price", "op": "gte", "value": "20"}],
+                               sort=[{"field": "price", "dir": "desc"}])
+    assert [x["data"]["price"] for x in r["records"]] == [40, 30, 20]
+    r = database.query_records("shop", filters=[{"field": "city", "op": "in", "value": ["台中", "高雄"]}])
+    assert sorted(x["data"]["city"] for x in r["records"]) == ["台中", "高雄"]
+    g = database.query_records("shop", aggregate=[{"fn": "sum", "field": "price"}, {"fn": "count"}],
+                               group_by="city")["groups"]
+    assert {x["city"]: (x["sum_price"], x["count"]) for x in g} == \
+        {"台中": (10.0, 1), "台北": (60.0, 3), "高雄": (30.0, 1)}
+
+@pytest.mark.parametrize("name", ["my note", "カナ-名", 'q"uote'])
+def test_any_field_name_can_be_queried(shop, name):
+    value = {"my note": "n3", "カナ-名": "k1", 'q"uote': "q3"}[name]
+    r = database.query_records("shop", filters=[{"field": name, "op": "eq", "value": value}])
+    assert {x["data"]["price"] for x in r["records"]} == ({10, 30} if name == "カナ-名" else {30})
+
+def test_query_records_rejects_unknown_fields_and_ops(shop):
+    with pytest.raises(ValueError):
+        database.query_records("shop", filters=[{"field": "nope", "op": "eq", "value": 1}])
+    with pytest.raises(ValueError):
+        database.query_records("shop", filters=[{"field": "price", "op": "drop", "value": 1}])
+    with pytest.raises(ValueError):
+        database.query_records("shop", filters=[{"field": "price", "op": "eq", "value": "abc"}])
+
+def test_dropping_table_drops_its_indexes(shop):
+    database.delete_custom_table("shop")
+    with database.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name LIKE 'idx_cf_%'").fetchone()[0] == 0
+
+# ══════════════════════════════════════
+# 資料表筆數（trigger 維護）
+# ══════════════════════════════════════
+def record_count(name):
+    return next(t["record_count"] for t in database.list_custom_tables() if t["name"] == name)
+
+def test_record_count_follows_inserts_and_deletes(db):
+    database.create_custom_table("t", "t", [{"name": "a", "type": "text"}])
+    ids = [database.add_record("t", {"a": i}) for i in range(4)]
+    assert record_count("t") == 4
+    database.delete_record(ids[0])
+    assert record_count("t") == 3
+
+def test_table_created_after_records_counts_existing_ones(db):
+    database.add_record("late", {"a": 1})
+    database.add_record("late", {"a": 2})
+    database.create_custom_table("late", "late", [{"name": "a", "type": "text"}])
+    assert record_count("late") == 2
+
+# ══════════════════════════════════════
+# 設定快取
+# ══════════════════════════════════════
+def test_set_setting_is_visible_immediately(db):
+    database.set_setting("k", "v1")
+    assert database.get_setting("k") == "v1"
+    database.set_setting("k", "v2")
+    assert database.get_setting("k") == "v2"
+    assert database.get_setting("missing", "d") == "d"
+
+def test_other_process_writes_are_seen_after_check_interval(db, monkeypatch):
+    monkeypatch.setattr(database, "SETTINGS_CHECK_SECONDS", 0)
+    database.set_setting("k", "v1")
+    assert database.get_setting("k") == "v1"
+    with database.transaction() as conn:     # 模擬別的 worker 直接寫入（不經本行程的 invalidate）
+        conn.execute("UPDATE settings SET value='v2' WHERE key='k'")
+    assert database.get_setting("k") == "v2"
+
+def test_reload_started_before_invalidate_is_not_cached(db, monkeypatch):
+    import threading
+    database.set_setting("k", "old")
+    cache = database._settings_cache
+    cache.invalidate()
+    started, release = threading.Event(), threading.Event()
+    real = database.get_version
+
+    def slow_version(name, conn=None):
+        v = real(name, conn)
+        started.set()
+        release.wait(5)
+        return v
+
+    monkeypatch.setattr(database, "get_version", slow_version)
+    t = threading.Thread(target=cache.values)
+    t.start()
+    started.wait(5)
+    monkeypatch.setattr(database, "get_version", real)
+    database.set_setting("k", "new")
+    release.set()
+    t.join(5)
+    assert database.get_setting("k") == "new"
+    assert cache.stats["dropped"] == 1
@@ -0,0 +1,68 @@
+"""db_bulk 匯入 / 匯出：NDJSON / CSV 解析、逐行錯誤回報、分批 commit、匯出再匯入"""
+import io
+import json
+import pytest
+import database
+import db_bulk
+from db_bulk import iter_input, import_stream, export_stream, RecordsSpec, TasksSpec, ChatSpec
+
+def run_import(spec, text, fmt="ndjson"):
+    events = list(import_stream(spec, iter_input(io.BytesIO(text.encode("utf-8")), fmt)))
+    return events[-1], events[:-1]
+
+def export(spec, fmt="ndjson"):
+    return "".join(export_stream(spec, fmt))
+
+def test_ndjson_reports_bad_lines_without_stopping(db):
+    text = "\n".join([
+        json.dumps({"title": "ok 1"}),
+        "{not json",
+        "[1, 2]",
+        json.dumps({"title": 123}),
+        json.dumps({"title": "  "}),
+        "",
+        json.dumps({"title": "ok 2", "tags": "a, b"}),
+    ])
+    done, _ = run_import(TasksSpec(), text)
+    assert done["imported"] == 3 and done["errors"] == 3
+    assert [e["line"] for e in done["error_samples"]] == [2, 3, 5]
+    tasks = {t["title"]: t for t in database.get_tasks()}
+    assert set(tasks) == {"ok 1", "123", "ok 2"}
+    assert tasks["ok 2"]["tags"] == ["a", "b"]
+
+def test_import_commits_in_batches_and_reports_progress(db, monkeypatch):
+    monkeypatch.setattr(db_bulk, "BATCH_ROWS", 10)
+    text = "\n".join(json.dumps({"role": "user", "content": f"m{i}", "session_id": "s"}) for i in range(25))
+    done, progress = run_import(ChatSpec(), text)
+    assert done["imported"] == 25
+    assert [p["imported"] for p in progress] == [10, 20]
+    s = next(x for x in database.list_chat_sessions() if x["session_id"] == "s")
+    assert s["msg_count"] == 25
+
+def test_records_csv_coerces_number_fields(db):
+    database.create_custom_table("t", "t", [{"name": "name", "type": "text"},
+                                            {"name": "price", "type": "number"}])
+    done, _ = run_import(RecordsSpec("t"), "name,price\n蘋果,12\n香蕉,3.5\n空白,\n", fmt="csv")
+    assert done["imported"] == 3
+    data = sorted((r["data"]["name"], r["data"]["price"]) for r in database.get_records("t"))
+    assert data == [("空白", ""), ("蘋果", 12), ("香蕉", 3.5)]
+
+@pytest.mark.parametrize("fmt", ["ndjson", "csv"])
+def test_export_then_import_roundtrips_records(db, monkeypatch, fmt):
+    monkeypatch.setattr(db_bulk, "EXPORT_BATCH", 3)
+    fields = [{"name": "name", "type": "text"}, {"name": "n", "type": "number"}]
+    database.create_custom_table("src", "src", fields)
+    database.create_custom_table("dst", "dst", fields)
+    for i in range(7):
+        database.add_record("src", {"name": f"r{i}", "n": i})
+    out = export(RecordsSpec("src"), fmt)
+    done, _ = run_import(RecordsSpec("dst"), out, fmt)
+    assert done["imported"] == 7 and done["errors"] == 0
+    assert sorted(r["data"]["n"] for r in database.get_records("dst")) == list(range(7))
+
+def test_chat_export_filters_by_session(db):
+    for sid in ("a", "b"):
+        database.create_session(sid)
+        database.save_chat_message(sid, "user", f"hi {sid}")
+    lines = export(ChatSpec("a")).splitlines()
+    assert [json.loads(l)["content"] for l in lines] == ["hi a"]
@@ -0,0 +1,88 @@
+"""db_pool 連線池：重入共用連線、transaction commit / rollback、池滿等待"""
+import threading
+import sqlite3
+import pytest
+import db_pool
+from db_pool import ConnectionPool
+
+@pytest.fixture
+def pool(tmp_path):
+    p = ConnectionPool(str(tmp_path / "t.db"), size=2)
+    with p.transaction() as conn:
+        conn.execute("CREATE TABLE t (v INTEGER)")
+    yield p
+    p.close_all()
+
+def count(pool):
+    with pool.connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM t").fetchone()[0]
+
+def test_pragmas_applied_once_per_connection(pool):
+    with pool.connection() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == db_pool.BUSY_TIMEOUT_MS
+
+def test_reentrant_use_shares_one_connection(pool):
+    with pool.connection() as outer:
+        with pool.transaction() as inner:
+            assert inner is outer
+    assert pool.stats()["reentrant"] >= 1
+
+def test_transaction_commits_and_rolls_back(pool):
+    with pool.transaction() as conn:
+        conn.execute("INSERT INTO t VALUES (1)")
+    assert count(pool) == 1
+    with pytest.raises(RuntimeError):
+        with pool.transaction() as conn:
+            conn.execute("INSERT INTO t VALUES (2)")
+            raise RuntimeError("boom")
+    assert count(pool) == 1
+
+def test_nested_transaction_commits_only_at_outermost(pool):
+    with pytest.raises(RuntimeError):
+        with pool.transaction() as conn:
+            with pool.transaction() as inner:
+                inner.execute("INSERT INTO t VALUES (1)")
+            # 內層結束不 commit，外層例外整批 rollback
+            raise RuntimeError("boom")
+    assert count(pool) == 0
+
+def test_uncommitted_changes_are_not_leaked_to_next_borrower(pool):
+    with pool.connection() as conn:
+        conn.execute("INSERT INTO t VALUES (1)")
+    assert count(pool) == 0
+
+def test_waits_for_idle_connection_when_full(pool):
+    both_held = threading.Barrier(3, timeout=5)
+    done = threading.Event()
+
+    def hold():
+        with pool.connection():
+            both_held.wait()
+            done.wait(5)
+
+    threads = [threading.Thread(target=hold) for _ in range(2)]
+    for t in threads:
+        t.start()
+    both_held.wait()
+    threading.Timer(0.1, done.set).start()
+    assert count(pool) == 0          # 池滿 → 等到有人歸還
+    for t in threads:
+        t.join()
+    s = pool.stats()
+    assert s["open"] == 2 and s["waits"] >= 1
+
+def test_get_pool_shares_instance_per_path(tmp_path):
+    a = db_pool.get_pool(str(tmp_path / "x.db"))
+    b = db_pool.get_pool(str(tmp_path / "." / "x.db"))
+    assert a is b
+    assert isinstance(a, ConnectionPool)
+    with a.connection() as conn:
+        assert isinstance(conn, sqlite3.Connection)
+
+def test_database_and_kb_manager_share_one_pool(db):
+    import database
+    import kb_manager
+    with database.connection() as a:
+        with kb_manager.connection() as b:
+            assert a is b
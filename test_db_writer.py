@@ -0,0 +1,107 @@
+"""db_writer 寫入合併：批次 commit、flush / stop、停止後改同步寫入、讀己之寫"""
+import os
+import threading
+import pytest
+import db_writer
+from db_pool import get_pool
+from db_writer import WriteBehindWriter
+
+@pytest.fixture
+def path(tmp_path):
+    p = str(tmp_path / "w.db")
+    with get_pool(p).transaction() as conn:
+        conn.execute("CREATE TABLE t (v INTEGER UNIQUE)")
+    return p
+
+def rows(path):
+    with get_pool(path).connection() as conn:
+        return [r[0] for r in conn.execute("SELECT v FROM t ORDER BY v")]
+
+def test_flush_makes_queued_writes_visible(path):
+    w = WriteBehindWriter(path, flush_ms=1000, batch_rows=1000)
+    futs = [w.submit("INSERT INTO t VALUES (?)", (i,)) for i in range(50)]
+    assert w.pending() == 50
+    assert w.flush(timeout=5)
+    assert rows(path) == list(range(50))
+    assert all(f.result(0) for f in futs)
+    assert w.pending() == 0
+    s = w.stats()
+    assert s["written"] == 50 and s["batches"] == 1
+    w.stop()
+
+def test_batch_rows_limits_group_size(path):
+    w = WriteBehindWriter(path, flush_ms=1000, batch_rows=10)
+    for i in range(25):
+        w.submit("INSERT INTO t VALUES (?)", (i,))
+    w.flush(timeout=5)
+    assert w.stats()["batch_max"] == 10
+    w.stop()
+
+def test_failing_row_only_fails_itself(path):
+    w = WriteBehindWriter(path, flush_ms=1000)
+    ok  = w.submit("INSERT INTO t VALUES (?)", (1,))
+    dup = w.submit("INSERT INTO t VALUES (?)", (1,))
+    ok2 = w.submit("INSERT INTO t VALUES (?)", (2,))
+    w.flush(timeout=5)
+    assert ok.result(0) and ok2.result(0)
+    with pytest.raises(Exception):
+        dup.result(0)
+    assert rows(path) == [1, 2]
+    assert w.stats()["errors"] == 1
+    w.stop()
+
+def test_stop_drains_queue_and_later_submits_write_synchronously(path):
+    w = WriteBehindWriter(path, flush_ms=1000, batch_rows=1000)
+    for i in range(10):
+        w.submit("INSERT INTO t VALUES (?)", (i,))
+    w.stop()
+    assert rows(path) == list(range(10))
+    fut = w.submit("INSERT INTO t VALUES (?)", (99,))
+    assert fut.done() and fut.result(0)
+    assert 99 in rows(path)
+    assert w.stats()["sync_fallbacks"] == 1
+    assert w.flush(timeout=1)
+
+def test_submit_racing_stop_never_loses_a_write(path):
+    w = WriteBehindWriter(path, flush_ms=1)
+    futs, lock = [], threading.Lock()
+
+    def submit(base):
+        for i in range(100):
+            f = w.submit("INSERT INTO t VALUES (?)", (base + i,))
+            with lock:
+                futs.append(f)
+
+    threads = [threading.Thread(target=submit, args=(k * 1000,)) for k in range(5)]
+    for t in threads:
+        t.start()
+    w.stop()
+    for t in threads:
+        t.join()
+    assert all(f.result(5) for f in futs)
+    assert len(rows(path)) == 500
+
+def test_flush_racing_stop_does_not_hang(path):
+    for _ in range(50):
+        w = WriteBehindWriter(path, flush_ms=1)
+        result = []
+        t = threading.Thread(target=lambda: result.append(w.flush()))
+        t.start()
+        w.stop()
+        t.join(5)
+        assert not t.is_alive()
+        assert result == [True]
+
+def test_database_reads_see_pending_writes(db, monkeypatch):
+    import database
+    monkeypatch.setattr(db_writer, "ENABLED", True)
+    try:
+        database.create_session("s1")
+        for i in range(5):
+            database.save_chat_message("s1", "user", f"m{i}")
+        history = database.get_chat_history("s1")
+        assert [m["content"] for m in history] == [f"m{i}" for i in range(5)]
+    finally:
+        w = db_writer._writers.pop(os.path.abspath(db), None)
+        if w:
+            w.stop()
@@ -0,0 +1,90 @@
+"""dense_index：hashed embedding、暴力 / LSH 檢索、混合分數融合、KB / RAG 的 dense / hybrid 模式"""
+import random
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import dense_index
+from dense_index import DenseIndex, embed, fuse, resolve_mode
+import kb_manager as kb
+import rag_store
+
+TEXTS = ["台北明天會下雨嗎", "高雄天氣晴朗", "how to train a neural network",
+         "training deep neural networks quickly", "今天晚餐吃牛肉麵"]
+
+def test_embedding_is_normalised_and_deterministic():
+    v = embed("台北天氣")
+    assert v.dtype == np.float32 and v.shape == (dense_index.DIM,)
+    assert float(np.linalg.norm(v)) == pytest.approx(1.0)
+    assert np.array_equal(v, embed("台北天氣"))
+    assert not embed("，。！").any()
+
+def test_similar_texts_score_higher():
+    q = embed("台北天氣")
+    assert float(embed("台北明天天氣") @ q) > float(embed("高雄晚餐") @ q)
+    q = embed("neural network training")
+    assert float(embed(TEXTS[3]) @ q) > float(embed(TEXTS[1]) @ q)
+
+def test_resolve_mode(monkeypatch):
+    assert resolve_mode("hybrid") == "hybrid"
+    assert resolve_mode("bogus") == dense_index.DEFAULT_MODE
+    monkeypatch.setattr(dense_index, "AVAILABLE", False)
+    assert resolve_mode("dense") == "keyword"
+
+# ══════════════════════════════════════
+# 索引
+# ══════════════════════════════════════
+def test_search_ranks_by_cosine_and_respects_mask():
+    idx = DenseIndex.build(list(range(len(TEXTS))), TEXTS, extra={"doc": [0, 0, 1, 1, 2]})
+    top = idx.search("neural network", 2)
+    assert {i for i, _ in top} == {2, 3}
+    assert top[0][1] >= top[1][1] > 0
+    mask = idx.extra["doc"] == 0
+    assert {i for i, _ in idx.search("neural network", 5, mask)} <= {0, 1}
+    assert idx.search("，。", 3) == []
+
+def test_lsh_candidates_find_near_duplicates(monkeypatch):
+    rnd = random.Random(0)
+    words = [f"w{i}" for i in range(300)]
+    texts = [" ".join(rnd.choices(words, k=20)) for _ in range(400)]
+    idx = DenseIndex.build(list(range(len(texts))), texts)
+    monkeypatch.setattr(dense_index, "BRUTE_FORCE_ROWS", 0)
+    found = 0
+    for i in range(0, 400, 20):
+        query = " ".join(texts[i].split()[:-2])        # 去掉最後兩個詞
+        top = idx.search(query, 1)
+        found += bool(top) and top[0][0] == i
+    assert found >= 18
+
+def test_save_and_load_roundtrip(tmp_path):
+    idx = DenseIndex.build(["a", "b", "c"], TEXTS[:3], extra={"doc": [1, 2, 3]})
+    path = str(tmp_path / "d.v1")
+    idx.save(path)
+    loaded = DenseIndex.load(path)
+    assert loaded.rows == ["a", "b", "c"] and loaded.extra["doc"].tolist() == [1, 2, 3]
+    assert loaded.search("台北下雨", 3) == idx.search("台北下雨", 3)
+
+def test_fuse_normalises_each_side():
+    fused = dict(fuse({"a": 10.0, "b": 5.0}, {"b": 0.8, "c": 0.4}, alpha=0.5))
+    assert fused == pytest.approx({"a": 0.5, "b": 0.75, "c": 0.25})
+    assert [k for k, _ in fuse({"x": 1.0}, {}, alpha=0.5)] == ["x"]
+    assert fuse({}, {}) == []
+
+# ══════════════════════════════════════
+# KB / RAG 模式
+# ══════════════════════════════════════
+def test_kb_dense_mode_matches_partial_overlap(db):
+    a = kb.add_doc("天氣", "台北明天午後雷陣雨，記得帶傘", "note")
+    kb.add_doc("食物", "牛肉麵與滷肉飯", "note")
+    assert [r["id"] for r in kb.semantic_search("台北雷雨", mode="dense")][:1] == [a]
+    hybrid = kb.semantic_search("台北雷雨", mode="hybrid")
+    assert hybrid[0]["id"] == a and hybrid[0]["chunk"]
+
+def test_rag_modes_only_return_selected_docs(db):
+    a = rag_store.add_doc("a.txt", "neural network training tips. " * 10)
+    b = rag_store.add_doc("b.txt", "deep neural networks and their training. " * 10)
+    for mode in ("dense", "hybrid"):
+        got = rag_store.search("neural network training", [a["blob_hash"]], mode=mode)
+        assert got and {r["doc_id"] for r in got} == {a["blob_hash"]}
+    both = rag_store.search("neural network training", [a["blob_hash"], b["blob_hash"]], mode="dense")
+    assert {r["doc_id"] for r in both} == {a["blob_hash"], b["blob_hash"]}
@@ -0,0 +1,411 @@
+"""engine_manager：背景健康探測、路由不在請求路徑上抓模型清單、模型清單快取（條件請求 / 磁碟）、
+自動模式 fallback 與斷路器"""
+import time
+import threading
+import pytest
+import requests
+import engine_manager as em
+import engine_router
+from engine_manager import BaseEngine, EngineManager, EngineStatus, ModelCatalog
+from test_http_client import Server
+
+class FakeEngine(BaseEngine):
+    """
+    可設定健康檢查結果 / 延遲與模型清單網址的假引擎
+    script：串流時依序處理，字串 = 吐出 token、數字 = 等幾秒、例外 = 丟出
+    """
+    def __init__(self, engine_id, up=True, ping_delay=0.0, configured=True, url=None,
+                 local=False, paid=False, assume_up=True, script=("hi",)):
+        self.engine_id, self.name = engine_id, engine_id
+        self.up, self.ping_delay, self.is_configured, self.url = up, ping_delay, configured, url
+        self.local, self.paid, self.assume_up = local, paid, assume_up
+        self.script = list(script)
+        self.pings = self.streams = 0
+
+    def configured(self):
+        return self.is_configured
+
+    def _ping(self):
+        self.pings += 1
+        time.sleep(self.ping_delay)
+        return self.up
+
+    def models_url(self):
+        return self.url
+
+    def parse_models(self, data):
+        return [{"id": m} for m in data["models"]]
+
+    def default_models(self):
+        return [{"id": f"{self.engine_id}-default"}]
+
+    def _stream(self, messages, model=None, **kw):
+        self.streams += 1
+        full = ""
+        for step in self.script:
+            if isinstance(step, BaseException):
+                raise step
+            if isinstance(step, (int, float)):
+                time.sleep(step)
+                continue
+            full += step
+            yield step, full
+
+def wait_until(cond, timeout=3.0):
+    end = time.time() + timeout
+    while time.time() < end:
+        if cond():
+            return True
+        time.sleep(0.01)
+    return cond()
+
+@pytest.fixture
+def isolated(tmp_path, monkeypatch):
+    """引擎狀態與模型清單快取換成這個測試專用的（清單存在 tmp_path）"""
+    monkeypatch.setattr(em, "_status", EngineStatus())
+    catalog = ModelCatalog(path=str(tmp_path / "catalog.json"))
+    monkeypatch.setattr(em, "_catalog", catalog)
+    return catalog
+
+@pytest.fixture
+def server():
+    s = Server()
+    yield s
+    s.close()
+
+def manager(monkeypatch, *engines, prober=False):
+    mgr = EngineManager()
+    mgr.engines = {e.engine_id: e for e in engines}
+    monkeypatch.setattr(mgr, "policy", lambda: "fast")
+    if not prober:
+        monkeypatch.setattr(mgr, "start_prober", lambda: None)
+    return mgr
+
+# ══════════════════════════════════════
+# 健康探測
+# ══════════════════════════════════════
+def test_probe_all_pings_configured_engines_in_parallel(isolated, monkeypatch):
+    a = FakeEngine("a", up=True, ping_delay=0.3)
+    b = FakeEngine("b", up=False, ping_delay=0.3)
+    c = FakeEngine("c", configured=False)
+    mgr = manager(monkeypatch, a, b, c)
+    t0 = time.time()
+    assert mgr.probe_all() == {"a": True, "b": False}
+    assert time.time() - t0 < 0.55
+    assert (a.pings, b.pings, c.pings) == (1, 1, 0)
+    assert a.available() and not b.available() and not c.available()
+    assert em._status.get("a")["latency_ms"] >= 250
+
+def test_only_one_probe_round_runs_at_a_time(isolated, monkeypatch):
+    a = FakeEngine("a", ping_delay=0.3)
+    mgr = manager(monkeypatch, a)
+    t = threading.Thread(target=mgr.probe_all)
+    t.start()
+    assert wait_until(lambda: a.pings == 1)
+    assert mgr.probe_all() is None
+    t.join()
+    assert a.pings == 1
+
+def test_availability_and_status_read_cached_state_only(isolated, monkeypatch):
+    cloud = FakeEngine("cloud", assume_up=True)
+    local = FakeEngine("local", assume_up=False)
+    mgr = manager(monkeypatch, cloud, local)
+    assert cloud.available() and not local.available()     # 還沒探測過
+    st = mgr.status()
+    assert st["cloud"]["available"] and st["cloud"]["ok"] is None
+    assert cloud.pings == local.pings == 0
+    em._status.mark("cloud", False, error="auth")             # 實際請求失敗直接寫入
+    assert not cloud.available() and mgr.status()["cloud"]["error"] == "auth"
+
+def test_ping_engines_never_blocks_the_request(isolated, monkeypatch):
+    slow = FakeEngine("slow", ping_delay=0.5)
+    mgr = manager(monkeypatch, slow, prober=True)
+    monkeypatch.setattr(em, "manager", mgr)
+    monkeypatch.setattr(em, "HEALTH_TTL", 3600)
+    t0 = time.time()
+    em.ping_engines()
+    assert time.time() - t0 < 0.1
+    assert mgr._prober.is_alive()
+    assert wait_until(lambda: mgr._last_ping > 0)
+    pings = slow.pings
+    em.ping_engines()                                         # 剛探測過：不再補一輪
+    time.sleep(0.1)
+    assert slow.pings == pings
+
+# ══════════════════════════════════════
+# 路由只讀模型清單快取
+# ══════════════════════════════════════
+def test_routing_with_a_model_does_not_fetch_catalogs(isolated, monkeypatch, server):
+    server.script = [(200, {}, b'{"models": ["m1", "m2"]}', 1.0)]
+    remote = FakeEngine("remote", url=server.url)
+    other = FakeEngine("other")
+    mgr = manager(monkeypatch, remote, other)
+    t0 = time.time()
+    plan = mgr.plan(model="m1")
+    assert time.time() - t0 < 0.3
+    # 清單還沒抓到：沒有引擎宣告提供 m1，照常排序
+    assert {e.engine_id for e, _ in plan} == {"remote", "other"}
+    assert wait_until(lambda: isolated.info(remote) is not None)
+    assert [e.engine_id for e, _ in mgr.plan(model="m1")] == ["remote"]
+    assert server.hits == 1
+
+def test_peek_returns_defaults_then_cached_list(isolated, server):
+    server.script = [(200, {}, b'{"models": ["m1"]}', 0.3)]
+    eng = FakeEngine("e", url=server.url)
+    assert isolated.peek(eng) == [{"id": "e-default"}]
+    assert isolated.peek(eng) == [{"id": "e-default"}]         # 背景更新中不重複送
+    assert wait_until(lambda: isolated.info(eng) is not None)
+    assert isolated.peek(eng) == [{"id": "m1"}] and server.hits == 1
+
+# ══════════════════════════════════════
+# 模型清單快取（ETag / 磁碟）
+# ══════════════════════════════════════
+MODELS_V1 = (200, {"ETag": '"v1"', "Last-Modified": "Wed, 01 Jan 2025 00:00:00 GMT"},
+             b'{"models": ["m1", "m2"]}', 0)
+
+def test_cold_get_fetches_once_and_persists_to_disk(isolated, server):
+    server.script = [MODELS_V1]
+    eng = FakeEngine("e", url=server.url)
+    assert isolated.get(eng) == [{"id": "m1"}, {"id": "m2"}]
+    assert isolated.get(eng) == [{"id": "m1"}, {"id": "m2"}]
+    assert server.hits == 1 and isolated.stats["hits"] == 1
+    reloaded = ModelCatalog(path=isolated.path)                # 新行程：讀磁碟，不連網路
+    assert reloaded.get(eng) == [{"id": "m1"}, {"id": "m2"}] and server.hits == 1
+    assert reloaded.info(eng)["etag"]
+
+def test_stale_list_is_served_while_revalidating_with_304(isolated, server):
+    server.script = [MODELS_V1, (304, {}, b"", 0.3)]
+    eng = FakeEngine("e", url=server.url)
+    isolated.get(eng)
+    isolated.ttl = 0                                          # 立刻過期
+    t0 = time.time()
+    assert isolated.get(eng) == [{"id": "m1"}, {"id": "m2"}]
+    assert time.time() - t0 < 0.2 and isolated.stats["stale"] == 1
+    assert wait_until(lambda: isolated.stats["not_modified"] == 1)
+    headers = server.requests[1]
+    assert headers["If-None-Match"] == '"v1"'
+    assert headers["If-Modified-Since"] == "Wed, 01 Jan 2025 00:00:00 GMT"
+    assert isolated.get(eng) == [{"id": "m1"}, {"id": "m2"}]
+
+def test_failed_refresh_keeps_the_old_list_and_backs_off(isolated, server, monkeypatch):
+    monkeypatch.setattr(em, "CATALOG_RETRY", 60)
+    server.script = [MODELS_V1, (500, {}, b"", 0)]
+    eng = FakeEngine("e", url=server.url)
+    isolated.get(eng)
+    isolated.ttl = 1
+    isolated.refresh(eng)
+    assert isolated.info(eng)["error"] == "HTTP 500"
+    assert isolated.get(eng) == [{"id": "m1"}, {"id": "m2"}]
+    assert not isolated.stale(eng)                            # CATALOG_RETRY 內不再試
+
+def test_changed_url_discards_the_cached_list(isolated, server):
+    server.script = [MODELS_V1, (200, {}, b'{"models": ["other"]}', 0)]
+    eng = FakeEngine("e", url=server.url)
+    isolated.get(eng)
+    eng.url = server.url + "?host=2"
+    assert isolated.info(eng) is None
+    assert isolated.get(eng) == [{"id": "other"}]
+    assert "If-None-Match" not in server.requests[1]
+
+def test_unavailable_engine_gets_defaults_without_waiting(isolated, server):
+    server.script = [(200, {}, b'{"models": ["m1"]}', 0.5)]
+    eng = FakeEngine("e", url=server.url, assume_up=False)
+    t0 = time.time()
+    assert isolated.get(eng) == [{"id": "e-default"}]
+    assert time.time() - t0 < 0.2
+    assert wait_until(lambda: isolated.info(eng) is not None)   # 背景抓到後下次就有
+    assert isolated.get(eng) == [{"id": "m1"}]
+
+def test_probe_refreshes_stale_catalogs_of_healthy_engines_only(isolated, monkeypatch, server):
+    server.script = [MODELS_V1]
+    up = FakeEngine("up", url=server.url)
+    down = FakeEngine("down", up=False, url=server.url + "?down")
+    manager(monkeypatch, up, down).probe_all()
+    assert server.hits == 1 and isolated.info(up)["count"] == 2
+    assert isolated.info(down) is None
+
+# ══════════════════════════════════════
+# 自動模式 fallback / 斷路器
+# ══════════════════════════════════════
+MSGS = [{"role": "user", "content": "hi"}]
+
+def run(mgr, **kw):
+    return [(tok, eid) for tok, _, eid in mgr.stream(MSGS, hedge=False, **kw)]
+
+def breaker(mgr, eid):
+    return mgr.router.snapshot()["engines"][eid]["breaker"]
+
+@pytest.mark.parametrize("error", [
+    requests.exceptions.ChunkedEncodingError("stream cut"),
+    requests.HTTPError("502 Bad Gateway"),
+    requests.ConnectionError("refused"),
+    ValueError("⏳ rate limited"),
+    KeyError("choices"),
+])
+def test_error_before_first_token_falls_back(isolated, monkeypatch, error):
+    bad = FakeEngine("ollama", script=[error])
+    good = FakeEngine("groq", script=["a", "b"])
+    mgr = manager(monkeypatch, bad, good)
+    assert run(mgr) == [("a", "groq"), ("b", "groq")]
+    assert mgr.router.snapshot()["engines"]["ollama"]["error_rate"] == 1.0
+    assert mgr.router.snapshot()["engines"]["groq"]["samples"] == 1
+
+def test_error_after_first_token_is_raised(isolated, monkeypatch):
+    bad = FakeEngine("ollama", script=["partial", requests.exceptions.ChunkedEncodingError("cut")])
+    good = FakeEngine("groq")
+    mgr = manager(monkeypatch, bad, good)
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        run(mgr)
+    assert good.streams == 0
+
+def test_explicit_engine_never_falls_back(isolated, monkeypatch):
+    bad = FakeEngine("ollama", script=[requests.HTTPError("500")])
+    good = FakeEngine("groq")
+    mgr = manager(monkeypatch, bad, good)
+    with pytest.raises(requests.HTTPError):
+        run(mgr, engine_id="ollama")
+    assert good.streams == 0
+
+def test_connection_errors_mark_the_engine_down(isolated, monkeypatch):
+    bad = FakeEngine("ollama", script=[requests.ConnectionError("refused")])
+    mgr = manager(monkeypatch, bad, FakeEngine("groq"))
+    run(mgr)
+    assert not bad.available()
+    assert [e.engine_id for e, _ in mgr.plan()] == ["groq"]
+
+def test_repeated_failures_open_the_breaker(isolated, monkeypatch):
+    bad = FakeEngine("ollama", script=[requests.HTTPError("500")])
+    good = FakeEngine("groq")
+    mgr = manager(monkeypatch, bad, good)
+    run(mgr)
+    assert [e.engine_id for e, _ in mgr.plan()] == ["groq", "ollama"]   # 失敗一次就排到後面
+    for _ in range(engine_router.BREAKER_FAILURES - 1):
+        with pytest.raises(requests.HTTPError):
+            run(mgr, engine_id="ollama")
+    assert breaker(mgr, "ollama") == "open"
+    assert [e.engine_id for e, _ in mgr.plan()] == ["groq"]
+    assert bad.streams == engine_router.BREAKER_FAILURES
+
+def test_cancelled_trial_releases_the_half_open_slot(isolated, monkeypatch):
+    eng = FakeEngine("ollama", script=["a", "b", "c"])
+    mgr = manager(monkeypatch, eng)
+    for _ in range(engine_router.BREAKER_FAILURES):
+        mgr.router.record_failure("ollama", None)
+    b = mgr.router._breaker("ollama")
+    b.opened_at -= b.cooldown                                 # 冷卻結束 → 半開
+    gen = mgr.stream(MSGS, hedge=False)
+    next(gen)
+    assert breaker(mgr, "ollama") == "open"                   # 試探進行中
+    gen.close()                                               # client 斷線
+    assert breaker(mgr, "ollama") == "half_open"
+    assert mgr.router.ttft_percentile("ollama") is not None
+
+def test_preferred_engine_goes_first_then_routing(isolated, monkeypatch):
+    mgr = manager(monkeypatch, FakeEngine("ollama"), FakeEngine("groq"))
+    mgr.set_preferred("groq")
+    assert mgr.get_preferred() == "groq"
+    assert [e.engine_id for e, _ in mgr.plan()] == ["groq", "ollama"]
+    mgr.set_preferred("auto")
+    assert mgr.get_preferred() == "auto" and mgr._preferred is None
+    mgr.set_preferred(None)
+    assert mgr.get_preferred() is None
+    with pytest.raises(ValueError):
+        mgr.set_preferred("nope")
+
+# ══════════════════════════════════════
+# 對沖串流
+# ══════════════════════════════════════
+import http_client
+
+class HttpEngine(FakeEngine):
+    """真的對本機 server 送串流請求的引擎（取消時要能關掉還在等回應標頭的連線）"""
+    def __init__(self, engine_id, stream_url, **kw):
+        super().__init__(engine_id, **kw)
+        self.stream_url, self.ended, self.error = stream_url, None, None
+
+    def _stream(self, messages, model=None, **kw):
+        self.streams += 1
+        try:
+            r = http_client.post(self.stream_url, json={}, stream=True, retries=0, timeout=10)
+            full = ""
+            for line in r.iter_lines():
+                full += line.decode()
+                yield line.decode(), full
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            self.ended = time.time()
+
+@pytest.fixture
+def hedging(monkeypatch):
+    monkeypatch.setattr(em, "HEDGE_DEFAULT", 0.1)
+    monkeypatch.setattr(em, "HEDGE_MIN", 0.05)
+
+def hedged(mgr):
+    return [(tok, eid) for tok, _, eid in mgr.stream(MSGS, hedge=True)]
+
+def test_slow_primary_is_hedged_and_its_connection_cut(isolated, monkeypatch, server, hedging):
+    server.script = [(200, {}, b"late\n", 3.0)]
+    primary = HttpEngine("ollama", server.url)
+    backup = FakeEngine("groq", script=["x", "y"])
+    mgr = manager(monkeypatch, primary, backup)
+    t0 = time.time()
+    assert hedged(mgr) == [("x", "groq"), ("y", "groq")]
+    assert wait_until(lambda: primary.ended is not None, timeout=1.0)
+    assert primary.ended - t0 < 1.0 and primary.error is not None
+    h = mgr.hedge_stats
+    assert (h["eligible"], h["hedged"], h["hedge_won"], h["saved_unmeasured"]) == (1, 1, 1, 1)
+    assert not mgr.router.snapshot()["engines"].get("ollama", {}).get("error_rate")   # 取消不算失敗
+    assert mgr.routing()["hedging"]["hedge_rate"] == 1.0
+
+def test_saved_time_is_measured_from_slow_ttft_samples(isolated, monkeypatch, hedging):
+    monkeypatch.setattr(em, "HEDGE_MAX", 0.1)
+    primary = FakeEngine("ollama", script=[1.0, "late"])
+    backup = FakeEngine("groq", script=["x"])
+    mgr = manager(monkeypatch, primary, backup)
+    for _ in range(5):
+        mgr.router.record_ttft("ollama", None, 2.0)
+    assert mgr.hedge_delay("ollama") == 0.1
+    assert hedged(mgr) == [("x", "groq")]
+    h = mgr.hedge_stats
+    assert h["saved_samples"] == 1 and 1500 < h["saved_ms_total"] < 2000
+    assert mgr.routing()["hedging"]["avg_saved_ms"] == h["saved_ms_total"]
+
+def test_fast_primary_is_not_hedged(isolated, monkeypatch, hedging):
+    primary = FakeEngine("ollama", script=["a"])
+    backup = FakeEngine("groq")
+    mgr = manager(monkeypatch, primary, backup)
+    assert hedged(mgr) == [("a", "ollama")]
+    assert backup.streams == 0 and mgr.hedge_stats["hedged"] == 0
+
+def test_failed_primary_falls_back_without_counting_a_hedge(isolated, monkeypatch, hedging):
+    primary = FakeEngine("ollama", script=[requests.HTTPError("500")])
+    backup = FakeEngine("groq", script=["b"])
+    mgr = manager(monkeypatch, primary, backup)
+    assert hedged(mgr) == [("b", "groq")]
+    assert mgr.hedge_stats["hedged"] == 0 and mgr.hedge_stats["hedge_won"] == 0
+
+def test_all_engines_failing_raises_the_last_error(isolated, monkeypatch, hedging):
+    mgr = manager(monkeypatch, FakeEngine("ollama", script=[requests.HTTPError("a")]),
+                  FakeEngine("groq", script=[requests.HTTPError("b")]))
+    with pytest.raises(requests.HTTPError):
+        hedged(mgr)
+
+def test_client_disconnect_cancels_every_request(isolated, monkeypatch, server, hedging):
+    server.script = [(200, {}, b"late\n", 3.0)]
+    primary = HttpEngine("ollama", server.url)
+    backup = FakeEngine("groq", script=["x", 0.3, "y"])
+    mgr = manager(monkeypatch, primary, backup)
+    gen = mgr.stream(MSGS, hedge=True)
+    assert next(gen)[0] == "x"
+    gen.close()
+    assert wait_until(lambda: primary.ended is not None, timeout=1.0)
+
+def test_manual_engine_choice_disables_hedging(isolated, monkeypatch, hedging):
+    primary = FakeEngine("ollama", script=[0.3, "a"])
+    backup = FakeEngine("groq")
+    mgr = manager(monkeypatch, primary, backup)
+    mgr.set_preferred("ollama")
+    assert hedged(mgr) == [("a", "ollama")]
+    assert backup.streams == 0 and mgr.hedge_stats["eligible"] == 0
@@ -0,0 +1,161 @@
+"""engine_router：EWMA 延遲統計、預期延遲排序 / 探索、政策過濾、斷路器（半開只放行一個試探）"""
+import types
+import pytest
+import engine_router
+from engine_router import Router
+
+class Clock:
+    def __init__(self):
+        self.now = 10_000.0
+
+    def time(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr(engine_router, "time", types.SimpleNamespace(time=c.time))
+    return c
+
+class Eng:
+    def __init__(self, local=False, paid=False, up=True, configured=True, models=()):
+        self.local, self.paid, self.up, self.is_configured = local, paid, up, configured
+        self.models = [{"id": m} for m in models]
+
+    def configured(self):
+        return self.is_configured
+
+    def available(self):
+        return self.up
+
+    def cached_models(self):
+        return self.models
+
+def ids(ranked, engines):
+    names = {id(e): k for k, e in engines.items()}
+    return [names[id(e)] for e, _ in ranked]
+
+def warm(router, eid, ttft, tps=50.0, n=3, model=None):
+    for _ in range(n):
+        router.record_success(eid, model, ttft, 101, ttft + 100 / tps)
+
+# ══════════════════════════════════════
+# 統計
+# ══════════════════════════════════════
+def test_ewma_of_ttft_tps_and_error_rate(clock):
+    r = Router()
+    r.record_success("a", None, 1.0, 11, 2.0)          # tps = 10 / (2 - 1)
+    r.record_success("a", None, 2.0, 11, 3.0)
+    r.record_failure("a", None)
+    v = r.snapshot()["engines"]["a"]
+    assert v["ttft_s"] == pytest.approx(0.3 * 2.0 + 0.7 * 1.0)
+    assert v["tps"] == pytest.approx(10.0)
+    assert v["error_rate"] == pytest.approx(0.3)
+    assert v["samples"] == 3
+
+def test_ttft_percentile_and_tail_mean(clock):
+    r = Router()
+    assert r.ttft_percentile("a") is None
+    for t in (0.1, 0.2, 0.3, 0.4, 2.0):
+        r.record_ttft("a", None, t)
+    assert r.ttft_percentile("a", 0.9) == 2.0
+    assert r.ttft_percentile("a", 0.5) == 0.3
+    assert r.ttft_tail_mean("a", 0.25) == pytest.approx((0.3 + 0.4 + 2.0) / 3)
+    assert r.ttft_tail_mean("a", 5) is None
+
+# ══════════════════════════════════════
+# 排序
+# ══════════════════════════════════════
+def test_rank_by_expected_latency_after_exploring(clock):
+    engines = {"slow": Eng(), "fast": Eng(), "new": Eng()}
+    r = Router()
+    warm(r, "slow", ttft=3.0)
+    warm(r, "fast", ttft=0.5)
+    assert ids(r.rank(engines, policy="fast"), engines) == ["new", "fast", "slow"]   # 沒樣本的先試
+    warm(r, "new", ttft=1.0)
+    assert ids(r.rank(engines, policy="fast"), engines) == ["fast", "new", "slow"]
+    assert r.last_decision["chosen"] == "fast"
+    clock.now += engine_router.EXPLORE_AFTER + 1
+    warm(r, "fast", ttft=0.5)
+    warm(r, "new", ttft=1.0)
+    assert ids(r.rank(engines, policy="fast"), engines)[0] == "slow"               # 太久沒樣本：再探索一次
+
+def test_error_rate_penalises_expected_latency(clock):
+    engines = {"a": Eng(), "b": Eng()}
+    r = Router()
+    warm(r, "a", ttft=0.5)
+    warm(r, "b", ttft=0.8)
+    for _ in range(2):
+        r.record_failure("a", None)
+    assert ids(r.rank(engines, policy="fast"), engines) == ["b", "a"]
+
+def test_policies_filter_engines(clock):
+    engines = {"local": Eng(local=True), "cloud": Eng(), "paid": Eng(paid=True),
+               "down": Eng(up=False), "unset": Eng(configured=False)}
+    r = Router()
+    for eid in engines:
+        warm(r, eid, ttft=1.0)
+    assert ids(r.rank(engines, policy="privacy"), engines) == ["local"]
+    assert set(ids(r.rank(engines, policy="balanced"), engines)) == {"local", "cloud"}
+    assert ids(r.rank(engines, policy="balanced"), engines)[0] == "local"          # 本機加分
+    assert set(ids(r.rank(engines, policy="fast"), engines)) == {"local", "cloud", "paid"}
+    excluded = {c["engine"]: c["excluded"] for c in r.last_decision["candidates"] if "excluded" in c}
+    assert set(excluded) == {"down", "unset"}
+
+def test_model_is_only_routed_to_engines_that_serve_it(clock):
+    engines = {"a": Eng(models=["llama"]), "b": Eng(models=["gpt"]), "c": Eng(models=["llama", "gpt"])}
+    r = Router()
+    assert set(ids(r.rank(engines, model="llama", policy="fast"), engines)) == {"a", "c"}
+    assert all(m == "llama" for _, m in r.rank(engines, model="llama", policy="fast"))
+    # 沒有引擎列出的模型（自訂 ID）照常排序
+    assert len(r.rank(engines, model="custom", policy="fast")) == 3
+
+# ══════════════════════════════════════
+# 斷路器
+# ══════════════════════════════════════
+def breaker(r, eid):
+    return r.snapshot()["engines"][eid]["breaker"]
+
+def test_breaker_opens_half_opens_and_closes(clock):
+    engines = {"a": Eng(), "b": Eng()}
+    r = Router()
+    for _ in range(engine_router.BREAKER_FAILURES):
+        r.record_failure("a", None)
+    assert breaker(r, "a") == "open"
+    assert ids(r.rank(engines, policy="fast"), engines) == ["b"]
+    clock.now += engine_router.BREAKER_COOLDOWN
+    assert breaker(r, "a") == "half_open"
+    trial = r.acquire("a")
+    assert trial is not None and breaker(r, "a") == "open"        # 只放行一個試探
+    assert r.acquire("a") is None
+    r.record_success("a", None, 0.5, 10, 1.0)
+    assert breaker(r, "a") == "closed"
+
+def test_failed_trial_reopens_with_doubled_cooldown(clock):
+    r = Router()
+    for _ in range(engine_router.BREAKER_FAILURES):
+        r.record_failure("a", None)
+    clock.now += engine_router.BREAKER_COOLDOWN
+    r.acquire("a")
+    r.record_failure("a", None)
+    assert breaker(r, "a") == "open"
+    clock.now += engine_router.BREAKER_COOLDOWN
+    assert breaker(r, "a") == "open"
+    clock.now += engine_router.BREAKER_COOLDOWN
+    assert breaker(r, "a") == "half_open"
+
+def test_release_only_frees_its_own_trial(clock):
+    r = Router()
+    for _ in range(engine_router.BREAKER_FAILURES):
+        r.record_failure("a", None)
+    clock.now += engine_router.BREAKER_COOLDOWN
+    old = r.acquire("a")
+    clock.now += engine_router.TRIAL_TIMEOUT                      # 試探沒回報：逾時後放行下一個
+    new = r.acquire("a")
+    assert new is not None and new != old
+    r.release("a", old)                                           # 舊的晚到的 release 不能放掉新的名額
+    assert breaker(r, "a") == "open"
+    r.release("a", new)
+    assert breaker(r, "a") == "half_open"
+    r.release("a", None)
+    assert breaker(r, "a") == "half_open"
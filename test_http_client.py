@@ -0,0 +1,145 @@
+"""http_client：429 / 5xx / 連線失敗重試、Retry-After、讀取逾時不重試、連線池重用與統計"""
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import requests
+import http_client
+
+class Server:
+    """本機 HTTP/1.1 server；script 依序回應 (status, headers, body, delay)，用完後一律 200；requests 記下各次請求標頭"""
+    def __init__(self):
+        self.script, self.hits, self.requests = [], 0, []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.hits += 1
+                server.requests.append(dict(self.headers))
+                status, headers, body, delay = server.script.pop(0) if server.script else (200, {}, b"ok", 0)
+                time.sleep(delay)
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_POST = do_GET
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+        self.host = f"127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(http_client, "BACKOFF_BASE", 0.001)
+    s = Server()
+    yield s
+    s.close()
+
+def counters(server):
+    return {k: http_client.stats()[server.host][k] for k in ("requests", "retries", "errors")}
+
+# ══════════════════════════════════════
+# 重試
+# ══════════════════════════════════════
+def test_retries_5xx_and_429_until_success(server):
+    server.script = [(503, {}, b"busy", 0), (429, {}, b"slow down", 0), (502, {}, b"", 0)]
+    seen = []
+    r = http_client.get(server.url, on_retry=lambda resp, exc: seen.append(resp.status_code))
+    assert r.status_code == 200 and r.text == "ok"
+    assert seen == [503, 429, 502] and server.hits == 4
+    assert counters(server) == {"requests": 4, "retries": 3, "errors": 0}
+
+def test_gives_up_after_max_retries_and_returns_last_response(server):
+    server.script = [(500, {}, b"", 0)] * 5
+    r = http_client.get(server.url, retries=2)
+    assert r.status_code == 500 and server.hits == 3
+
+def test_retries_zero_fails_fast(server):
+    server.script = [(429, {"Retry-After": "0"}, b"", 0)]
+    assert http_client.post(server.url, retries=0, json={}).status_code == 429
+    assert server.hits == 1
+
+def test_long_retry_after_is_returned_to_the_caller(server, monkeypatch):
+    monkeypatch.setattr(http_client, "MAX_RETRY_AFTER", 5)
+    server.script = [(429, {"Retry-After": "120"}, b"", 0)]
+    t0 = time.monotonic()
+    r = http_client.get(server.url)
+    assert r.status_code == 429 and server.hits == 1 and time.monotonic() - t0 < 2
+
+def test_client_errors_are_not_retried(server):
+    server.script = [(400, {}, b"bad", 0)]
+    assert http_client.get(server.url).status_code == 400 and server.hits == 1
+
+def test_read_timeout_is_not_retried(server):
+    server.script = [(200, {}, b"late", 1.0)]
+    with pytest.raises(requests.ReadTimeout):
+        http_client.get(server.url, timeout=0.2)
+    assert server.hits == 1
+
+def test_connection_refused_is_retried_then_raised(monkeypatch):
+    monkeypatch.setattr(http_client, "BACKOFF_BASE", 0.001)
+    s = Server()
+    url, host = s.url, s.host
+    s.close()                                        # 埠已關閉
+    with pytest.raises(requests.ConnectionError):
+        http_client.get(url, retries=2)
+    c = http_client.stats()[host]
+    assert (c["requests"], c["retries"], c["errors"]) == (3, 2, 1)
+
+# ══════════════════════════════════════
+# Retry-After / 退避
+# ══════════════════════════════════════
+def fake_response(retry_after):
+    r = requests.Response()
+    if retry_after is not None:
+        r.headers["Retry-After"] = retry_after
+    return r
+
+def test_retry_after_parses_seconds_and_http_dates():
+    from email.utils import formatdate
+    assert http_client.retry_after(fake_response("7")) == 7.0
+    assert http_client.retry_after(fake_response("-3")) == 0.0
+    assert http_client.retry_after(fake_response(None)) is None
+    assert http_client.retry_after(fake_response("soon")) is None
+    wait = http_client.retry_after(fake_response(formatdate(time.time() + 30, usegmt=True)))
+    assert 28 <= wait <= 31
+
+def test_backoff_uses_retry_after_or_capped_full_jitter(monkeypatch):
+    monkeypatch.setattr(http_client, "BACKOFF_BASE", 1.0)
+    monkeypatch.setattr(http_client, "BACKOFF_MAX", 4.0)
+    assert 10 <= http_client.backoff(0, fake_response("10")) <= 11
+    for attempt in range(8):
+        assert 0 <= http_client.backoff(attempt) <= min(4.0, 2 ** attempt)
+
+# ══════════════════════════════════════
+# 連線池
+# ══════════════════════════════════════
+def test_keep_alive_connections_are_reused(server):
+    for _ in range(5):
+        http_client.get(server.url).content
+    s = http_client.stats()[server.host]
+    assert s["connections_opened"] == 1 and s["pool_hits"] == 4 and s["pool_hit_rate"] == 0.8
+
+def test_configure_rebuilds_the_session_with_new_limits(server):
+    before = http_client.session_for(server.url)
+    http_client.configure(server.host, pool_size=2, read_timeout=0.2)
+    assert http_client.session_for(server.url) is not before
+    assert http_client.stats()[server.host]["pool_size"] == 2
+    server.script = [(200, {}, b"late", 1.0)]
+    with pytest.raises(requests.ReadTimeout):
+        http_client.get(server.url)
+    assert http_client._timeout(server.host, None) == (0.2, 0.2)
@@ -0,0 +1,115 @@
+"""ingest 批次匯入：收檔 / zip 展開、平行切段、單一 transaction 合併與整批 rollback、工作記錄只存狀態"""
+import io
+import os
+import zipfile
+import pytest
+import ingest
+import kb_manager as kb
+import rag_store
+
+def stage(job_id, uploads):
+    files = []
+    for name, data in uploads:
+        ingest.stage_upload(job_id, name, io.BytesIO(data), files)
+    return files
+
+def make_zip(entries):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        for name, data in entries.items():
+            zf.writestr(name, data)
+    return buf.getvalue()
+
+def statuses(job):
+    return {f["name"]: f["status"] for f in job["files"]}
+
+# ══════════════════════════════════════
+# 收檔
+# ══════════════════════════════════════
+def test_stage_expands_zip_and_rejects_bad_entries(db, monkeypatch):
+    monkeypatch.setattr(ingest, "MAX_FILE_BYTES", 100)
+    job = ingest.create_job("kb")
+    z = make_zip({"docs/a.md": "# A", "docs/": "", "__MACOSX/._a.md": "x", ".hidden.txt": "x",
+                  "img.png": "x", "big.txt": "y" * 200})
+    files = stage(job, [("pack.zip", z), ("../../etc/evil.txt", b"ok"), ("broken.zip", b"nope")])
+    got = {f["name"]: (f["status"], f.get("error", "")) for f in files}
+    assert got["pack.zip/docs/a.md"] == ("queued", "")
+    assert got["pack.zip/img.png"][0] == "error"
+    assert got["pack.zip/big.txt"][0] == "error"
+    assert got["../../etc/evil.txt"][0] == "queued"
+    assert got["broken.zip"][0] == "error" and "zip" in got["broken.zip"][1]
+    assert len(files) == 5
+    staged = [f["path"] for f in files if "path" in f]
+    assert all(os.path.dirname(p) == ingest._job_dir(job) for p in staged)
+    with pytest.raises(ValueError):
+        ingest.create_job("nope")
+
+# ══════════════════════════════════════
+# 處理 + 合併
+# ══════════════════════════════════════
+@pytest.mark.parametrize("workers", [1, 2])
+def test_kb_job_imports_every_good_file(db, monkeypatch, workers):
+    monkeypatch.setattr(ingest, "WORKERS", workers)
+    job = ingest.create_job("kb")
+    files = stage(job, [("one.txt", "第一份文件，談台北天氣。".encode()),
+                        ("two.md", b"second document about zebras"),
+                        ("bin.txt", b"\x00\x01binary"),
+                        ("empty.txt", b"   ")])
+    ingest.run_job(job, "kb", files, {"category": "tech"})
+    j = ingest.get_job(job)
+    assert j["status"] == "done" and (j["total"], j["imported"], j["failed"]) == (4, 2, 2)
+    assert statuses(j) == {"one.txt": "ok", "two.md": "ok", "bin.txt": "error", "empty.txt": "error"}
+    assert {d["title"] for d in kb.list_docs(category="tech")} == {"one", "two"}
+    assert [r["title"] for r in kb.semantic_search("zebras")] == ["two"]
+    assert not os.path.exists(ingest._job_dir(job))
+
+def test_rag_job_marks_duplicates_and_indexes_content(db, monkeypatch):
+    monkeypatch.setattr(ingest, "WORKERS", 1)
+    job = ingest.create_job("rag")
+    files = stage(job, [("a.txt", b"alpha beta gamma. " * 30), ("b.txt", b"alpha beta gamma. " * 30)])
+    ingest.run_job(job, "rag", files)
+    j = ingest.get_job(job)
+    assert statuses(j) == {"a.txt": "ok", "b.txt": "duplicate"}
+    docs = rag_store.list_docs()
+    assert len(docs) == 2 and docs[0]["blob_hash"] == docs[1]["blob_hash"]
+    assert all(f["chunks"] == docs[0]["chunks"] > 0 for f in j["files"])
+    assert rag_store.search("gamma", [docs[0]["blob_hash"]])
+
+def test_merge_failure_rolls_back_the_whole_batch(db, monkeypatch):
+    monkeypatch.setattr(ingest, "WORKERS", 1)
+    real, calls = kb.add_doc, []
+
+    def flaky(*args, **kw):
+        calls.append(1)
+        if len(calls) == 2:
+            raise RuntimeError("disk full")
+        return real(*args, **kw)
+
+    monkeypatch.setattr(kb, "add_doc", flaky)
+    job = ingest.create_job("kb")
+    files = stage(job, [(f"{i}.txt", f"document {i}".encode()) for i in range(3)])
+    ingest.run_job(job, "kb", files)
+    j = ingest.get_job(job)
+    assert j["status"] == "failed" and "disk full" in j["error"]
+    assert set(statuses(j).values()) == {"error"}
+    assert kb.list_docs() == [] and kb.semantic_search("document") == []
+
+def test_job_record_never_stores_text_or_chunks(db, monkeypatch):
+    monkeypatch.setattr(ingest, "WORKERS", 1)
+    monkeypatch.setattr(ingest, "PROGRESS_EVERY", 0)       # 每個檔案都寫一次進度
+    saved, real = [], ingest._save_job
+
+    def save_and_read_back(job_id, files, **fields):
+        real(job_id, files, **fields)
+        saved.append(ingest.get_job(job_id)["files"])
+
+    monkeypatch.setattr(ingest, "_save_job", save_and_read_back)
+    job = ingest.create_job("kb")
+    files = stage(job, [("a.txt", b"secret body " * 100), ("b.txt", b"more text")])
+    ingest.run_job(job, "kb", files)
+    assert len(saved) >= 3
+    for snapshot in saved:
+        for f in snapshot:
+            assert set(f) <= set(ingest.FILE_FIELDS)
+    assert any(f["status"] == "prepared" for snap in saved[:-1] for f in snap)
+    assert ingest.list_jobs()[0]["id"] == job
@@ -0,0 +1,76 @@
+"""kb_manager：倒排索引增量維護、BM25F 排序、查詢快取失效"""
+from collections import Counter
+import kb_manager as kb
+
+def snapshot():
+    with kb.connection() as conn:
+        postings = Counter(tuple(r) for r in conn.execute(
+            "SELECT term, category, doc_id, tf FROM kb_postings"))
+        terms = {tuple(r) for r in conn.execute("SELECT term, category, df FROM kb_term_stats")}
+        corpus = {tuple(r) for r in conn.execute(
+            "SELECT category, n_docs, title_len, body_len, n_chunks FROM kb_corpus_stats WHERE n_docs > 0")}
+    return postings, terms, corpus
+
+def ids(results):
+    return [r["id"] for r in results]
+
+# ══════════════════════════════════════
+# 倒排索引
+# ══════════════════════════════════════
+def test_incremental_index_matches_full_rebuild(db):
+    a = kb.add_doc("台北美食", "牛肉麵 小籠包 夜市", "note")
+    b = kb.add_doc("Python tips", "list comprehension and generators " * 30, "tech")
+    c = kb.add_doc("旅行", "台北 東京 大阪", "note")
+    kb.update_doc(a, content="滷肉飯 珍珠奶茶")
+    kb.update_doc(b, category="note")
+    kb.update_doc(c, is_active=0)
+    kb.delete_doc(kb.add_doc("暫時", "很快就刪掉", "note"))
+    incremental = snapshot()
+    kb.rebuild_index()
+    assert snapshot() == incremental
+
+def test_semantic_search_follows_edits(db):
+    a = kb.add_doc("早餐", "蛋餅 豆漿", "note")
+    b = kb.add_doc("晚餐", "火鍋 豆漿", "note")
+    assert set(ids(kb.semantic_search("豆漿"))) == {a, b}
+    kb.update_doc(a, is_active=0)
+    assert ids(kb.semantic_search("豆漿")) == [b]
+    kb.update_doc(b, content="火鍋 烤肉")
+    assert kb.semantic_search("豆漿") == []
+    kb.delete_doc(b)
+    assert kb.semantic_search("火鍋") == []
+
+def test_category_filter(db):
+    a = kb.add_doc("A", "shared words here", "note")
+    b = kb.add_doc("B", "shared words here", "tech")
+    assert ids(kb.semantic_search("shared", category="tech")) == [b]
+    assert set(ids(kb.semantic_search("shared"))) == {a, b}
+
+# ══════════════════════════════════════
+# BM25F
+# ══════════════════════════════════════
+FILLER = "lorem ipsum dolor sit amet "
+
+def test_title_match_outranks_body_match(db):
+    body = kb.add_doc("Notes", "zebra " + FILLER * 5, "note")
+    title = kb.add_doc("Zebra", FILLER * 5 + "stripes", "note")
+    assert ids(kb.semantic_search("zebra")) == [title, body]
+
+def test_shorter_body_wins_at_equal_term_frequency(db):
+    long_ = kb.add_doc("A", "zebra " + FILLER * 40, "note")
+    short = kb.add_doc("B", "zebra " + FILLER * 2, "note")
+    assert ids(kb.semantic_search("zebra")) == [short, long_]
+
+def test_rare_terms_weigh_more_than_common_ones(db):
+    for i in range(5):
+        kb.add_doc(f"filler {i}", "common " + FILLER, "note")
+    rare = kb.add_doc("R", "rare " + FILLER, "note")
+    results = kb.semantic_search("common rare", top_k=10)
+    assert results[0]["id"] == rare
+    assert results[0]["score"] > 2 * results[1]["score"]
+
+def test_best_chunk_is_the_matching_one(db):
+    text = (FILLER * 20) + "the needle sentence is here. " + (FILLER * 20)
+    doc = kb.add_doc("long", text, "note")
+    r = kb.semantic_search("needle")[0]
+    assert r["id"] == doc and "needle" in r["chunk"] and r["chunk_score"] > 0
@@ -0,0 +1,121 @@
+"""query_cache：命中 / TTL / LRU 淘汰 / 不可快取的結果、KB / RAG 查詢依語料版本失效"""
+import pytest
+import query_cache
+from query_cache import QueryCache, normalize_query
+import kb_manager as kb
+import rag_store
+import sparse_index
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr(query_cache.time, "monotonic", c)
+    return c
+
+def counter():
+    calls = []
+    return calls, lambda: calls.append(1) or len(calls)
+
+# ══════════════════════════════════════
+# QueryCache
+# ══════════════════════════════════════
+def test_hit_after_miss(clock):
+    c = QueryCache("t", capacity=4, ttl=10)
+    calls, compute = counter()
+    assert c.get_or_compute("k", compute) == 1
+    assert c.get_or_compute("k", compute) == 1
+    s = c.stats()
+    assert (s["hits"], s["misses"], s["size"], s["hit_rate"]) == (1, 1, 1, 0.5)
+
+def test_entries_expire_after_ttl(clock):
+    c = QueryCache("t", capacity=4, ttl=10)
+    calls, compute = counter()
+    c.get_or_compute("k", compute)
+    clock.now += 9.9
+    assert c.get_or_compute("k", compute) == 1
+    clock.now += 0.2
+    assert c.get_or_compute("k", compute) == 2
+    assert c.stats()["expired"] == 1
+
+def test_least_recently_used_is_evicted(clock):
+    c = QueryCache("t", capacity=2, ttl=10)
+    for k in ("a", "b"):
+        c.get_or_compute(k, lambda: k)
+    c.get_or_compute("a", lambda: "x")               # a 變成最近使用
+    c.get_or_compute("c", lambda: "c")               # 擠掉 b
+    assert c.get_or_compute("a", lambda: "new") == "a"
+    assert c.get_or_compute("b", lambda: "new") == "new"
+    assert c.stats()["evictions"] == 2
+
+def test_uncacheable_results_are_returned_but_not_stored(clock):
+    c = QueryCache("t", capacity=4, ttl=10)
+    calls, compute = counter()
+    assert c.get_or_compute("k", compute, cacheable=lambda: False) == 1
+    assert c.get_or_compute("k", compute) == 2
+    assert c.get_or_compute("k", compute) == 2
+
+@pytest.mark.parametrize("capacity,ttl", [(0, 10), (4, 0)])
+def test_disabled_cache_always_computes(clock, capacity, ttl):
+    c = QueryCache("t", capacity=capacity, ttl=ttl)
+    calls, compute = counter()
+    c.get_or_compute("k", compute)
+    assert c.get_or_compute("k", compute) == 2 and c.stats()["size"] == 0
+
+def test_normalize_query():
+    assert normalize_query("  Hello   WORLD\n") == normalize_query("hello world") == "hello world"
+    assert normalize_query(None) == ""
+
+# ══════════════════════════════════════
+# KB / RAG 查詢
+# ══════════════════════════════════════
+def test_kb_search_is_cached_until_the_corpus_changes(db, monkeypatch):
+    calls = []
+    real = kb._semantic_search
+    monkeypatch.setattr(kb, "_semantic_search", lambda *a: calls.append(a) or real(*a))
+    a = kb.add_doc("早餐", "蛋餅 豆漿", "note")
+    first = kb.semantic_search("豆漿")
+    assert kb.semantic_search("  豆漿 ") == first and len(calls) == 1
+    first[0]["score"] = -1                           # 呼叫端改結果不影響快取
+    assert kb.semantic_search("豆漿")[0]["score"] > 0
+    kb.update_doc(a, content="蛋餅 紅茶")
+    assert kb.semantic_search("豆漿") == [] and len(calls) == 2
+    kb.semantic_search("豆漿", category="tech")
+    assert len(calls) == 3
+
+def test_rag_search_is_cached_per_document_set(db, monkeypatch):
+    calls = []
+    real = rag_store._search
+    monkeypatch.setattr(rag_store, "_search", lambda *a: calls.append(a) or real(*a))
+    a = rag_store.add_doc("a.txt", "alpha beta. " * 20)["blob_hash"]
+    b = rag_store.add_doc("b.txt", "alpha gamma. " * 20)["blob_hash"]
+    rag_store.search("alpha", [a, b])
+    rag_store.search("ALPHA", [b, a])
+    assert len(calls) == 1
+    rag_store.search("alpha", [a])
+    assert len(calls) == 2
+    rag_store.add_doc("c.txt", "delta. " * 20)       # rag_index 版本加一
+    rag_store.search("alpha", [a])
+    assert len(calls) == 3
+
+def test_results_from_a_stale_index_are_not_cached(db, monkeypatch):
+    monkeypatch.setattr(sparse_index, "BACKEND", "postings")
+    kb.add_doc("doc", "zebra stripes", "note")
+    calls = []
+    real = kb._semantic_search
+
+    def stale_search(*a):
+        calls.append(a)
+        sparse_index._tls.stale = True               # 模擬這次拿到重建中的舊索引
+        return real(*a)
+
+    monkeypatch.setattr(kb, "_semantic_search", stale_search)
+    kb.semantic_search("zebra")
+    kb.semantic_search("zebra")
+    assert len(calls) == 2
@@ -0,0 +1,162 @@
+"""rag_store：上傳時建 postings、查詢只讀選定文件、文件索引 LRU 失效、內容定址 blob 與舊版搬移"""
+import os
+import json
+import math
+import threading
+import random
+from collections import Counter
+import pytest
+import rag_store
+import sparse_index
+import chunk_store
+from database import connection, transaction
+
+WORDS = "apple banana cherry grape lemon mango orange peach pear plum 蘋 果 香 蕉 葡 萄".split()
+
+def make_text(seed, n=300):
+    rnd = random.Random(seed)
+    return ". ".join(" ".join(rnd.choices(WORDS, k=rnd.randint(3, 12))) for _ in range(n // 6)) + "."
+
+@pytest.fixture
+def postings(db, monkeypatch):
+    monkeypatch.setattr(sparse_index, "BACKEND", "postings")
+    return db
+
+def tfidf_scores(query, chunks):
+    """ai_utils.tfidf_search 的公式（語料 = 給定段落），回傳每段分數"""
+    q = Counter(rag_store.tokenize(query))
+    tfs = [Counter(rag_store.tokenize(c)) for c in chunks]
+    df = Counter(t for tf in tfs for t in tf)
+    n = len(chunks)
+    return [sum(tf[t] / (sum(tf.values()) or 1) * (math.log((n + 1) / (df[t] + 1)) + 1) * qc
+                for t, qc in q.items()) for tf in tfs]
+
+# ══════════════════════════════════════
+# 上傳時建索引
+# ══════════════════════════════════════
+def test_upload_writes_postings_for_every_chunk(postings):
+    doc = rag_store.add_doc("a.txt", make_text(1))
+    h = doc["blob_hash"]
+    chunks = chunk_store.get_chunks("rag", [h])[h]
+    with connection() as conn:
+        rows = conn.execute("SELECT chunk_id, term, tf FROM rag_postings WHERE doc_id=?", (h,)).fetchall()
+    by_chunk = {}
+    for r in rows:
+        by_chunk.setdefault(r["chunk_id"], {})[r["term"]] = r["tf"]
+    for c in chunks:
+        tf = {}
+        for t in rag_store.tokenize(c["text"]):
+            tf[t] = tf.get(t, 0) + 1
+        assert by_chunk[c["id"]] == tf
+        assert c["n_tokens"] == sum(tf.values())
+
+@pytest.mark.parametrize("query", ["apple", "mango pear", "蘋果 香蕉", "plum plum lemon"])
+def test_postings_search_matches_full_tfidf(postings, query):
+    docs = [rag_store.add_doc(f"{i}.txt", make_text(i)) for i in range(3)]
+    keys = [d["blob_hash"] for d in docs[:2]]
+    chunks = [c for h in keys for c in chunk_store.get_chunks("rag", [h])[h]]
+    expected = dict(zip((c["id"] for c in chunks), tfidf_scores(query, [c["text"] for c in chunks])))
+    got = rag_store.search(query, keys, top_k=5)
+    assert [r["score"] for r in got] == pytest.approx(sorted(expected.values(), reverse=True)[:5])
+    for r in got:
+        assert r["score"] == pytest.approx(expected[r["chunk_id"]])
+
+def test_search_only_reads_selected_documents(postings):
+    a = rag_store.add_doc("a.txt", "alpha beta gamma. " * 20)
+    b = rag_store.add_doc("b.txt", "delta epsilon. " * 20)
+    assert rag_store.search("alpha", [b["blob_hash"]]) == []
+    got = rag_store.search("alpha delta", [a["blob_hash"]])
+    assert got and {r["doc_id"] for r in got} == {a["blob_hash"]}
+    text = rag_store.read_blob(a["blob_hash"])
+    assert all(text[r["char_start"]:r["char_end"]] == r["text"] for r in got)
+
+# ══════════════════════════════════════
+# 文件索引 LRU
+# ══════════════════════════════════════
+def test_doc_index_lru_hits_and_invalidation(postings):
+    doc = rag_store.add_doc("a.txt", make_text(7))
+    h = doc["blob_hash"]
+    rag_store.search("apple", [h])
+    s1 = rag_store.cache_stats()
+    rag_store.search("banana", [h])                 # 不同查詢，同一份文件索引
+    s2 = rag_store.cache_stats()
+    assert s2["hits"] == s1["hits"] + 1 and s2["misses"] == s1["misses"]
+    rag_store.delete_docs([doc["id"]])
+    assert rag_store.search("cherry", [h]) == []
+    assert rag_store.cache_stats()["docs"] == 0
+
+def test_lru_evicts_least_recently_used():
+    lru = rag_store._LRU(capacity=2)
+    a = lru.get("a", "v1", 1)
+    lru.get("b", "v1", 1)
+    assert lru.get("a", "v1", 1) is a
+    lru.get("c", "v1", 1)                           # 擠掉 b
+    assert lru.get("a", "v1", 1) is a
+    assert lru.get("b", "v1", 1) is not None and lru.stats()["misses"] == 4
+    assert lru.get("a", "v2", 1) is not a           # 內容 hash 變了就重新載入
+
+def test_unindexed_content_is_indexed_on_demand(postings):
+    doc = rag_store.add_doc("a.txt", make_text(3))
+    h = doc["blob_hash"]
+    rag_store.drop_doc(h)                           # 模擬舊版上傳搬進來、還沒建索引
+    assert rag_store.unindexed([h]) == [h]
+    rag_store.ensure_indexed([h])
+    assert rag_store.unindexed([h]) == []
+    assert rag_store.search("apple", [h])
+
+# ══════════════════════════════════════
+# 內容定址 blob
+# ══════════════════════════════════════
+def blob_files():
+    if not os.path.isdir(rag_store.BLOB_DIR):
+        return []
+    return sorted(f for _, _, files in os.walk(rag_store.BLOB_DIR) for f in files)
+
+def test_same_content_is_stored_once_and_removed_with_the_last_reference(db):
+    a = rag_store.add_doc("a.txt", "same text. " * 50)
+    b = rag_store.add_doc("copy.txt", "same text. " * 50)
+    c = rag_store.add_doc("other.txt", "other text. " * 50)
+    assert not a["duplicate"] and b["duplicate"] and a["id"] != b["id"]
+    assert blob_files() == sorted([f"{a['blob_hash']}.txt", f"{c['blob_hash']}.txt"])
+    assert rag_store.delete_docs([a["id"]]) == 1
+    assert rag_store.read_blob(b["blob_hash"]) == "same text. " * 50
+    assert rag_store.unindexed([b["blob_hash"]]) == []
+    assert rag_store.delete_docs([b["id"], c["id"], "missing"]) == 2
+    assert blob_files() == [] and rag_store.list_docs() == []
+    assert rag_store.unindexed([a["blob_hash"]]) == [a["blob_hash"]]
+
+def test_legacy_json_index_is_migrated(db):
+    os.makedirs(rag_store.LEGACY_DIR)
+    with open(os.path.join(rag_store.LEGACY_DIR, "old.txt"), "w", encoding="utf-8") as f:
+        f.write("legacy document body")
+    with open(rag_store.LEGACY_INDEX, "w", encoding="utf-8") as f:
+        json.dump([{"id": "doc_1", "name": "old.txt", "filename": "old.txt", "chunks": 1},
+                   {"id": "doc_2", "name": "gone.txt", "filename": "gone.txt"}], f)
+    with transaction() as conn:
+        rag_store._m_rag_docs(conn)
+    docs = rag_store.list_docs()
+    assert [(d["id"], d["name"]) for d in docs] == [("doc_1", "old.txt")]
+    assert rag_store.read_blob(docs[0]["blob_hash"]) == "legacy document body"
+    assert os.path.exists(rag_store.LEGACY_INDEX + ".migrated")
+
+def test_concurrent_upload_and_delete_never_lose_a_blob(db):
+    text = "shared content. " * 20
+    errors = []
+
+    def churn():
+        try:
+            for _ in range(30):
+                rag_store.delete_docs([rag_store.add_doc("x.txt", text)["id"]])
+        except Exception as e:          # noqa: BLE001 — 交給主執行緒檢查
+            errors.append(e)
+
+    threads = [threading.Thread(target=churn) for _ in range(4)]
+    for t in threads:
+        t.start()
+    keeper = rag_store.add_doc("keep.txt", text)
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert [d["id"] for d in rag_store.list_docs()] == [keeper["id"]]
+    assert os.path.exists(rag_store._blob_path(keeper["blob_hash"]))
+    assert rag_store.search("shared", [keeper["blob_hash"]])
@@ -0,0 +1,125 @@
+"""sparse_index：CSR 矩陣查詢、磁碟存取、依版本重建 / 重建中先用舊版、NumPy 與 postings 排序一致"""
+import os
+import threading
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import sparse_index
+from sparse_index import SparseIndex, get_index, take_stale
+import kb_manager as kb
+import rag_store
+from test_rag_store import make_text
+
+VECS = [{"a": 1.0, "b": 2.0}, {}, {"b": 1.0, "c": 3.0}, {"a": 0.5}]
+
+def build():
+    return SparseIndex.build(["r0", "r1", "r2", "r3"], VECS, extra={"doc": [0, 0, 1, 1]})
+
+# ══════════════════════════════════════
+# 矩陣
+# ══════════════════════════════════════
+def test_matvec_matches_dot_products():
+    idx = build()
+    q = {"a": 1.0, "c": 2.0, "unknown": 5.0}
+    expected = [sum(v.get(t, 0) * w for t, w in q.items()) for v in VECS]
+    assert idx.matvec(q).tolist() == pytest.approx(expected)
+    assert idx.matvec({"unknown": 1.0}) is None
+
+def test_l2_normalised_rows():
+    idx = SparseIndex.build(["x", "y"], [{"a": 3.0, "b": 4.0}, {"a": 1.0}], l2=True)
+    assert idx.matvec({"a": 1.0}).tolist() == pytest.approx([0.6, 1.0])
+
+def test_topk_orders_by_score_then_row_and_respects_mask():
+    scores = np.array([1.0, 3.0, 0.0, 3.0, 2.0], dtype=np.float32)
+    assert SparseIndex.topk(scores, 3) == [(1, 3.0), (3, 3.0), (4, 2.0)]
+    assert SparseIndex.topk(scores, 10) == [(1, 3.0), (3, 3.0), (4, 2.0), (0, 1.0)]
+    mask = np.array([True, False, True, False, True])
+    assert SparseIndex.topk(scores, 3, mask) == [(4, 2.0), (0, 1.0)]
+
+def test_save_and_memory_mapped_load(tmp_path):
+    idx = build()
+    path = str(tmp_path / "x.v1")
+    idx.save(path)
+    loaded = SparseIndex.load(path)
+    assert loaded.rows == idx.rows and loaded.vocab == idx.vocab
+    assert isinstance(loaded.data, np.memmap)
+    assert loaded.extra["doc"].tolist() == [0, 0, 1, 1]
+    assert loaded.matvec({"b": 1.0}).tolist() == idx.matvec({"b": 1.0}).tolist()
+
+# ══════════════════════════════════════
+# 依版本快取
+# ══════════════════════════════════════
+@pytest.fixture
+def index_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(sparse_index, "INDEX_DIR", str(tmp_path / "index"))
+    sparse_index._loaded.clear()
+    yield str(tmp_path / "index")
+    sparse_index._loaded.clear()
+
+def test_get_index_builds_once_per_version(index_dir):
+    calls = []
+    builder = lambda: calls.append(1) or build()
+    a = get_index("t", 1, builder)
+    assert get_index("t", 1, builder) is a and len(calls) == 1
+    sparse_index._loaded.clear()
+    assert get_index("t", 1, builder).rows == a.rows and len(calls) == 1   # 從磁碟載入
+    get_index("t", 2, builder)
+    assert len(calls) == 2
+
+def test_old_version_served_while_another_thread_rebuilds(index_dir):
+    old = get_index("t", 1, build)
+    take_stale()
+    started, release = threading.Event(), threading.Event()
+
+    def slow_build():
+        started.set()
+        release.wait(5)
+        return build()
+
+    t = threading.Thread(target=get_index, args=("t", 2, slow_build))
+    t.start()
+    started.wait(5)
+    assert get_index("t", 2, build) is old
+    assert take_stale() and not take_stale()
+    release.set()
+    t.join(5)
+    new = get_index("t", 2, build)
+    assert new is not old and new.meta["version"] == 2 and not take_stale()
+
+def test_cleanup_keeps_the_previous_version(index_dir):
+    for v in (1, 2, 3, 4):
+        get_index("t", v, build)
+    assert sorted(os.listdir(index_dir)) == ["t.v3", "t.v4"]
+
+# ══════════════════════════════════════
+# NumPy 與 SQL postings 排序一致
+# ══════════════════════════════════════
+QUERIES = ["apple", "mango pear", "蘋果 香蕉", "plum plum lemon", "nothing"]
+
+def both_backends(monkeypatch, search):
+    out = {}
+    for backend in ("postings", "sparse"):
+        monkeypatch.setattr(sparse_index, "BACKEND", backend)
+        out[backend] = search()
+    return out["postings"], out["sparse"]
+
+def same(a, b, key):
+    """KB 的 BM25 權重以 float32 存在矩陣裡，分數只比到相對誤差"""
+    assert [r[key] for r in a] == [r[key] for r in b]
+    assert [r["score"] for r in a] == pytest.approx([r["score"] for r in b], rel=1e-4)
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_rag_backends_rank_identically(db, monkeypatch, query):
+    keys = [rag_store.add_doc(f"{i}.txt", make_text(i))["blob_hash"] for i in range(4)]
+    sel = keys[1:3]
+    a, b = both_backends(monkeypatch, lambda: rag_store._search(query, sorted(sel), 8, "keyword"))
+    assert a == b                       # 兩條路徑的運算順序相同，分數完全一致
+
+@pytest.mark.parametrize("query", QUERIES)
+@pytest.mark.parametrize("category", [None, "tech"])
+def test_kb_backends_rank_identically(db, monkeypatch, query, category):
+    for i in range(12):
+        kb.add_doc(make_text(100 + i, 30), make_text(i, 600), "tech" if i % 3 else "note")
+    a, b = both_backends(monkeypatch, lambda: kb._semantic_search(query, category, 6, "keyword"))
+    same(a, b, "id")
@@ -2,12 +2,12 @@
 # 新增：Rate limit 偵測 → 自動切換排隊模式
 
 import threading, time, json, requests, queue, os
+import http_client
 
 GROQ_API_KEY   = os.environ.get("GROQ_API_KEY")
 GROQ_API_URL   = "https://api.groq.com/openai/v1/chat/completions"
 GROQ_MODEL     = "llama-3.3-70b-versatile"
 MAX_RETRIES    = 4
-BASE_WAIT      = 5
 MAX_TOKENS     = 800
 SUMMARY_TOKENS = 1200
 
@@ -85,41 +85,36 @@ def call_groq_with_retry(
     use_queue=True：用全域 Semaphore 確保只有一個請求同時跑
     回傳 (content, error)
     """
-    wait = BASE_WAIT
+    def on_retry(resp, exc):
+        if resp is not None and resp.status_code == 429:
+            record_rate_hit()  # 記錄這次 429
 
     def do_call():
-        nonlocal wait
-        for attempt in range(MAX_RETRIES):
-            try:
-                r = requests.post(
-                    GROQ_API_URL,
-                    headers={
-                        "Authorization": f"Bearer {GROQ_API_KEY}",
-                        "Content-Type":  "application/json"
-                    },
-                    json={
-                        "model":       GROQ_MODEL,
-                        "messages":    messages,
-                        "max_tokens":  max_tokens,
-                        "temperature": 0.7,
-                    },
-                    timeout=60
-                )
-                if r.status_code == 429:
-                    record_rate_hit()  # 記錄這次 429
-                    retry_after = int(r.headers.get("retry-after", wait))
-                    time.sleep(retry_after)
-                    wait *= 2
-                    continue
-                r.raise_for_status()
-                return r.json()["choices"][0]["message"]["content"], None
-            except requests.exceptions.HTTPError as e:
-                return "", f"HTTP {e.response.status_code}"
-            except Exception as e:
-                if attempt < MAX_RETRIES - 1:
-                    time.sleep(wait); wait *= 2; continue
-                return "", str(e)
-        return "", "超過重試次數"
+        # 重試 / Retry-After / 退避由 http_client 統一處理
+        try:
+            r = http_client.post(
+                GROQ_API_URL,
+                headers={
+                    "Authorization": f"Bearer {GROQ_API_KEY}",
+                    "Content-Type":  "application/json"
+                },
+                json={
+                    "model":       GROQ_MODEL,
+                    "messages":    messages,
+                    "max_tokens":  max_tokens,
+                    "temperature": 0.7,
+                },
+                timeout=60, retries=MAX_RETRIES - 1, on_retry=on_retry,
+            )
+            if r.status_code == 429:
+                record_rate_hit()
+                return "", "超過重試次數"
+            r.raise_for_status()
+            return r.json()["choices"][0]["message"]["content"], None
+        except requests.exceptions.HTTPError as e:
+            return "", f"HTTP {e.response.status_code}"
+        except Exception as e:
+            return "", str(e)
 
     if use_queue:
         # 排隊模式：等候取得鎖才呼叫
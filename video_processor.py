@@ -7,6 +7,7 @@ video_processor.py — 影片分析核心
   4. 整合結果供 AI 分析
 """
 import os, subprocess, base64, json, time, requests, tempfile, shutil
+import http_client
 from pathlib import Path
 
 # ── 設定 ──
@@ -162,9 +163,10 @@ def transcribe_audio(audio_path, language=None):
     try:
         with open(audio_path,"rb") as f:
             files = {"file": (os.path.basename(audio_path), f, "audio/mpeg")}
-            r = requests.post(
+            # 上傳的檔案串流無法重送，只共用連線池、不重試
+            r = http_client.post(
                 f"{GROQ_API_URL}/audio/transcriptions",
-                headers=headers, data=data, files=files, timeout=120
+                headers=headers, data=data, files=files, timeout=120, retries=0
             )
         if r.status_code == 200:
             result = r.json()
@@ -6,6 +6,7 @@ world_context_builder.py — 世界狀態注入策略
 策略 C：自主代理  → 感知式（perception）
 """
 import json, os, time, requests
+import http_client
 from pathlib import Path
 
 BASE       = Path(__file__).parent
@@ -232,7 +233,7 @@ def build_perception(char_id: str) -> dict:
 }}"""
 
     try:
-        r = requests.post(
+        r = http_client.post(
             "https://api.groq.com/openai/v1/chat/completions",
             headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
             json={
@@ -7,6 +7,7 @@ world_engine.py — 世界引擎
   4. 場景狀態更新（天氣影響室外場景）
 """
 import os, json, time, datetime, requests
+import http_client
 from pathlib import Path
 
 # ── 路徑 ──
@@ -282,7 +283,6 @@ def ai_update_chars_after_tick(hours: int = 1) -> dict:
         return _basic_auto_update(world, hours)
 
     try:
-        import requests as req
         weather = meta.get("weather", {})
         time_str = meta.get("time", "?")
         date_str = meta.get("date", "?")
@@ -321,7 +321,7 @@ def ai_update_chars_after_tick(hours: int = 1) -> dict:
   "private_notes": "..."
 }}"""
 
-            r = req.post(
+            r = http_client.post(
                 "https://api.groq.com/openai/v1/chat/completions",
                 headers={"Authorization": f"Bearer {api_key}",
                          "Content-Type": "application/json"},